@@ -4,6 +4,9 @@ import os
 
 def create_admin_user():
     with app.app_context():
+        # Importing the app no longer creates tables, so make sure this one exists
+        User.__table__.create(db.engine, checkfirst=True)
+        
         # Check if admin user already exists
         admin = User.query.filter_by(username='admin').first()
         if not admin:
@@ -1,65 +1,90 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort
+import time
+
+# Taken before anything else is imported, so the startup time create_app()
+# logs includes loading Flask, SQLAlchemy and this module
+IMPORT_STARTED = time.perf_counter()
+
+from flask import (Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash,
+                   jsonify, abort, Response, stream_with_context)
+from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
+import ipaddress
 import logging
-from network_scanner import scan_network
+import threading
+import click
 import json
-from flask_migrate import Migrate, upgrade
+import hashlib
+import base64
 from urllib.parse import urlparse
-from sqlalchemy import text, inspect
+from scan_jobs import ScanJobManager, ScanJobLimitError
+from search import search_records, DEFAULT_PER_PAGE as SEARCH_PER_PAGE
+from cache import FragmentCache, TTLCache, GLOBAL_SCOPE, customer_scope
+from db_pool import engine_options, pool_stats
+import metrics
+from profiler import profiler, SQL_PROFILER
+from markupsafe import Markup
+from sqlalchemy import text, inspect, or_, select, insert, update, delete, func, bindparam, event, true
+from sqlalchemy.engine import Engine
+import sqlite3
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import validates, selectinload
+from collections import defaultdict
 from functools import wraps
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', os.urandom(24))
-
-# Database configuration
-database_url = os.environ.get('DATABASE_URL')
-if database_url:
-    # Parse the DATABASE_URL to ensure it's in the correct format
-    parsed = urlparse(database_url)
-    if parsed.scheme == 'postgres':
-        database_url = database_url.replace('postgres://', 'postgresql://', 1)
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-    logger.info(f"Using PostgreSQL database: {database_url}")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///it_management.db'
+def database_uri():
+    """Return the database URL from DATABASE_URL, or the local SQLite file."""
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        # Parse the DATABASE_URL to ensure it's in the correct format
+        parsed = urlparse(database_url)
+        if parsed.scheme == 'postgres':
+            database_url = database_url.replace('postgres://', 'postgresql://', 1)
+        logger.info(f"Using PostgreSQL database: {database_url}")
+        return database_url
     logger.info("Using SQLite database")
+    return 'sqlite:///it_management.db'
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys, and so ON DELETE CASCADE, unless asked per connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
 
-# Initialize database
-with app.app_context():
-    try:
-        logger.info("Creating database tables...")
-        db.create_all()
-        logger.info("Database tables created successfully")
-    except Exception as e:
-        logger.error(f"Error creating database tables: {str(e)}")
-        raise
+# Extensions are bound to an app by create_app()
+db = SQLAlchemy()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+main = Blueprint('main', __name__)
+scan_jobs = ScanJobManager()
 
 # Error handlers
-@app.errorhandler(500)
+@main.app_errorhandler(500)
 def internal_error(error):
     logger.error(f"500 Error: {str(error)}")
     return render_template('500.html'), 500
 
-@app.errorhandler(404)
+@main.app_errorhandler(404)
 def not_found_error(error):
     logger.error(f"404 Error: {str(error)}")
     return render_template('404.html'), 404
 
+def ip_address_to_int(ip_address):
+    """Return a dotted IPv4 address as an integer, or None if it is not one."""
+    try:
+        return int(ipaddress.IPv4Address(ip_address.strip()))
+    except (AttributeError, ValueError):
+        return None
+
 # Database Models
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -68,6 +93,10 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
 
 class Customer(db.Model):
+    __table_args__ = (
+        db.Index('ix_customer_name_id', 'name', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     address = db.Column(db.String(200))
@@ -75,15 +104,25 @@ class Customer(db.Model):
     phone = db.Column(db.String(20))
     email = db.Column(db.String(120))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    network_info = db.relationship('NetworkInfo', backref='customer', lazy=True)
-    credentials = db.relationship('Credential', backref='customer', lazy=True)
-    cctv_users = db.relationship('CCTVUser', backref='customer', lazy=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Child rows are removed by ON DELETE CASCADE in the database
+    network_info = db.relationship('NetworkInfo', backref='customer', lazy=True,
+                                   order_by='NetworkInfo.ip_int', passive_deletes=True)
+    credentials = db.relationship('Credential', backref='customer', lazy=True, passive_deletes=True)
+    cctv_users = db.relationship('CCTVUser', backref='customer', lazy=True, passive_deletes=True)
+    scan_runs = db.relationship('ScanRun', backref='customer', lazy=True, passive_deletes=True)
 
 class NetworkInfo(db.Model):
+    __table_args__ = (
+        db.Index('ix_network_info_customer_id_ip_int', 'customer_id', 'ip_int'),
+        db.Index('uq_network_info_customer_id_ip_address', 'customer_id', 'ip_address', unique=True),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id', ondelete='CASCADE'), nullable=False)
     device_name = db.Column(db.String(100), nullable=False)
     ip_address = db.Column(db.String(15), nullable=False)
+    ip_int = db.Column(db.BigInteger)  # ip_address as an integer, for sorting and range queries
     subnet_mask = db.Column(db.String(15))
     gateway = db.Column(db.String(15))
     dns_servers = db.Column(db.String(200))
@@ -94,34 +133,310 @@ class NetworkInfo(db.Model):
     system_type = db.Column(db.String(50))
     cctv_type = db.Column(db.String(50))
     cctv_manufacturer = db.Column(db.String(100))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    @validates('ip_address')
+    def sync_ip_int(self, key, ip_address):
+        self.ip_int = ip_address_to_int(ip_address)
+        return ip_address
+
+    @classmethod
+    def in_targets(cls, targets):
+        """Condition matching devices whose address falls inside a TargetSpec."""
+        return or_(*(cls.ip_int.between(first, last) for first, last in targets.ranges))
 
 class Credential(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id', ondelete='CASCADE'), nullable=False, index=True)
     service_name = db.Column(db.String(100))
     username = db.Column(db.String(100))
     password = db.Column(db.String(200))  # Will be encrypted in production
     notes = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class CCTVUser(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id', ondelete='CASCADE'), nullable=False, index=True)
     username = db.Column(db.String(100), nullable=False)
     password = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+class Tombstone(db.Model):
+    """A deleted Customer, NetworkInfo, Credential or CCTVUser, kept so sync clients see the delete."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # Key of SYNC_MODELS
+    record_id = db.Column(db.Integer, nullable=False)
+    customer_id = db.Column(db.Integer, nullable=False)  # No foreign key: the customer may be gone too
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+class ScanRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id', ondelete='CASCADE'), nullable=False, index=True)
+    ip_range = db.Column(db.Text, nullable=False)
+    exclude = db.Column(db.Text)
+    ports = db.Column(db.Text)
+    rescan = db.Column(db.Boolean, default=False)
+    hosts_scanned = db.Column(db.Integer)
+    devices_found = db.Column(db.Integer)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    results = db.relationship('ScanResult', backref='run', lazy=True, passive_deletes=True)
+
+class ScanResult(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('scan_run.id', ondelete='CASCADE'), nullable=False, index=True)
+    ip_address = db.Column(db.String(15), nullable=False)
+    hostname = db.Column(db.String(255))
+    mac_address = db.Column(db.String(17))
+    ports = db.Column(db.Text)  # Comma-separated open ports
+
+    @property
+    def port_list(self):
+        return [int(port) for port in self.ports.split(',')] if self.ports else []
+
+    def to_device(self):
+        """Return the result in the same shape as scan_network() devices."""
+        return {
+            'ip': self.ip_address,
+            'hostname': self.hostname,
+            'mac_address': self.mac_address,
+            'ports': self.port_list
+        }
+
+# Logged-in users kept in memory per process, and for how many seconds, so
+# authenticated requests do not each query the user table
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 256))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+
+def get_user_cache():
+    """The current app's cache of logged-in users, created by create_app()."""
+    return current_app.extensions['user_cache']
+
+class CachedUser(UserMixin):
+    """Read-only copy of the User fields requests need, safe to share between threads."""
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.is_admin = bool(user.is_admin)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    cached = get_user_cache().get(user_id)
+    if cached is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        cached = CachedUser(user)
+        get_user_cache().set(user_id, cached)
+    return cached
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    get_user_cache().delete(target.id)
+
+def get_fragment_cache():
+    """The current app's FragmentCache, created by create_app()."""
+    return current_app.extensions['fragment_cache']
+
+def invalidate_customer(customer_id):
+    """Drop cached pages that show this customer; call after committing a change."""
+    get_fragment_cache().bump(customer_scope(customer_id), GLOBAL_SCOPE)
+
+# Records the sync API hands out, by the kind name clients see
+SYNC_MODELS = {
+    'customer': Customer,
+    'device': NetworkInfo,
+    'credential': Credential,
+    'cctv_user': CCTVUser
+}
+
+# Days a delete is remembered for sync clients. A client whose cursor is
+# older than this gets a full copy instead of a delta.
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', 90))
+
+def record_deletes(kind, customer_id, record_ids):
+    """
+    Add tombstones for deleted records to the session, to commit with the delete.
+    
+    Deleting a customer only needs a tombstone for the customer itself:
+    clients drop its devices, passwords and CCTV users along with it, just
+    as ON DELETE CASCADE does here.
+    
+    Args:
+        kind (str): Key of SYNC_MODELS
+        customer_id (int): Customer the records belonged to
+        record_ids (list): Ids of the deleted records
+    """
+    if not record_ids:
+        return
+    now = datetime.utcnow()
+    db.session.execute(insert(Tombstone), [
+        {'kind': kind, 'record_id': record_id, 'customer_id': customer_id, 'deleted_at': now}
+        for record_id in record_ids
+    ])
+    db.session.execute(
+        delete(Tombstone).where(Tombstone.deleted_at < now - timedelta(days=TOMBSTONE_RETENTION_DAYS))
+    )
+
+# Customers shown per page on the index, unless ?per_page= asks otherwise
+CUSTOMERS_PER_PAGE = 24
+MAX_CUSTOMERS_PER_PAGE = 100
+
+def child_count(model):
+    """Correlated COUNT(*) of a model's rows belonging to the outer Customer."""
+    return (
+        select(func.count(model.id))
+        .where(model.customer_id == Customer.id)
+        .correlate(Customer)
+        .scalar_subquery()
+    )
+
+def page_cursor(customer):
+    """Opaque ?after=/?before= value holding a customer's place in name order."""
+    value = json.dumps([customer.name, customer.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+def parse_page_cursor(value):
+    """
+    Decode a page_cursor() value.
+    
+    Returns:
+        tuple: (name, id), or None if the value is missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        name, customer_id = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(name, str) or not isinstance(customer_id, int) or isinstance(customer_id, bool):
+        return None
+    return name, customer_id
+
+def customer_page(per_page, after=None, before=None):
+    """
+    Fetch one page of customers ordered by name, with their record counts.
+    
+    Uses keyset pagination on (name, id): the page starts after, or ends
+    before, the given sort key, so deep pages cost the same as the first
+    one. The key is carried in the cursor rather than looked up by id, so
+    paging still works after the cursor's customer is deleted. Counts come
+    from correlated subqueries in the same query.
+    
+    Args:
+        per_page (int): Customers per page
+        after (tuple): (name, id) of the last customer on the previous page
+        before (tuple): (name, id) of the first customer on the next page
+    
+    Returns:
+        tuple: (customers, counts by customer id, has_prev, has_next)
+    """
+    query = select(
+        Customer,
+        child_count(NetworkInfo).label('devices'),
+        child_count(Credential).label('credentials'),
+        child_count(CCTVUser).label('cctv_users')
+    )
+    
+    cursor = after if after is not None else before
+    if cursor is not None:
+        cursor_name, cursor_id = cursor
+        if after is not None:
+            query = query.where(or_(
+                Customer.name > cursor_name,
+                (Customer.name == cursor_name) & (Customer.id > cursor_id)
+            ))
+        else:
+            query = query.where(or_(
+                Customer.name < cursor_name,
+                (Customer.name == cursor_name) & (Customer.id < cursor_id)
+            ))
+    
+    # Fetch one extra row to learn whether there is another page
+    if before is not None:
+        query = query.order_by(Customer.name.desc(), Customer.id.desc())
+    else:
+        query = query.order_by(Customer.name, Customer.id)
+    rows = db.session.execute(query.limit(per_page + 1)).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before is not None:
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after is not None, more
+    
+    customers = [row.Customer for row in rows]
+    counts = {
+        row.Customer.id: {
+            'devices': row.devices,
+            'credentials': row.credentials,
+            'cctv_users': row.cctv_users
+        }
+        for row in rows
+    }
+    return customers, counts, has_prev, has_next
 
 # Routes
-@app.route('/')
+@main.route('/')
 @login_required
 def index():
-    customers = Customer.query.all()
-    return render_template('index.html', customers=customers)
+    per_page = request.args.get('per_page', CUSTOMERS_PER_PAGE, type=int)
+    per_page = max(1, min(per_page, MAX_CUSTOMERS_PER_PAGE))
+    after = parse_page_cursor(request.args.get('after'))
+    before = parse_page_cursor(request.args.get('before'))
+    
+    def render_cards():
+        customers, counts, has_prev, has_next = customer_page(per_page, after=after, before=before)
+        return render_template('customer_cards.html', customers=customers, counts=counts,
+                               per_page=per_page, has_prev=has_prev, has_next=has_next,
+                               page_cursor=page_cursor)
+    
+    cards = get_fragment_cache().get_or_render('customer_cards', [GLOBAL_SCOPE], render_cards,
+                                               (per_page, after, before))
+    return render_template('index.html', cards=Markup(cards))
+
+def search_result_url(hit):
+    """Link a search hit to the page where the record is shown or edited."""
+    if hit['kind'] == 'device':
+        return url_for('main.edit_network_info', customer_id=hit['customer_id'], network_id=hit['record_id'])
+    if hit['kind'] == 'credential':
+        return url_for('main.customer_details', customer_id=hit['customer_id']) + '#credentials'
+    return url_for('main.customer_details', customer_id=hit['customer_id'])
+
+@main.route('/search')
+@login_required
+def search_api():
+    """Search customers, devices and password service names, ranked and paginated."""
+    query = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = request.args.get('per_page', SEARCH_PER_PAGE, type=int)
+    try:
+        found = search_records(db.session, query, page, per_page)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Search failed for {query!r}: {str(e)}")
+        return jsonify({
+            'error': f'Error searching: {str(e)}'
+        }), 500
+    
+    for hit in found['results']:
+        hit['url'] = search_result_url(hit)
+    return jsonify({
+        'query': query,
+        'page': page,
+        'results': found['results'],
+        'has_next': found['has_next']
+    })
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -137,7 +452,7 @@ def login():
                 next_page = request.args.get('next')
                 if next_page:
                     return redirect(next_page)
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
             else:
                 logger.warning("Invalid password")
         else:
@@ -146,13 +461,14 @@ def login():
         flash('Invalid username or password')
     return render_template('login.html')
 
-@app.route('/logout')
+@main.route('/logout')
 @login_required
 def logout():
+    get_user_cache().delete(current_user.id)
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/customer/add', methods=['GET', 'POST'])
+@main.route('/customer/add', methods=['GET', 'POST'])
 @login_required
 def add_customer():
     if request.method == 'POST':
@@ -165,25 +481,45 @@ def add_customer():
         )
         db.session.add(customer)
         db.session.commit()
+        invalidate_customer(customer.id)
         flash('Customer added successfully')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     return render_template('add_customer.html')
 
-@app.route('/customer/<int:customer_id>')
+@main.route('/customer/<int:customer_id>')
 @login_required
 def customer_details(customer_id):
-    customer = Customer.query.get_or_404(customer_id)
+    customer = db.get_or_404(Customer, customer_id)
     check_access(customer)
     
-    # Get CCTV devices
-    cctv_devices = [device for device in customer.network_info if device.system_type == 'CCTV System']
-    
-    # Get all CCTV users for this customer
-    cctv_users = CCTVUser.query.filter_by(customer_id=customer_id).all()
+    def render_content():
+        # Load the customer's collections in a fixed number of queries,
+        # however many devices, passwords and CCTV users it has
+        loaded = db.session.execute(
+            db.select(Customer)
+            .options(
+                selectinload(Customer.network_info),
+                selectinload(Customer.credentials),
+                selectinload(Customer.cctv_users)
+            )
+            .filter_by(id=customer_id)
+        ).scalar_one()
+        
+        # Group devices by system type once, in address order
+        devices_by_type = defaultdict(list)
+        for device in loaded.network_info:
+            devices_by_type[device.system_type].append(device)
+        
+        return render_template('customer_details_content.html', customer=loaded,
+                               devices_by_type=devices_by_type,
+                               cctv_devices=devices_by_type['CCTV System'],
+                               cctv_users=loaded.cctv_users)
     
-    return render_template('customer_details.html', customer=customer, cctv_devices=cctv_devices, cctv_users=cctv_users)
+    content = get_fragment_cache().get_or_render('customer_details', [customer_scope(customer_id)],
+                                                 render_content)
+    return render_template('customer_details.html', content=Markup(content))
 
-@app.route('/customer/<int:customer_id>/network/add', methods=['GET', 'POST'])
+@main.route('/customer/<int:customer_id>/network/add', methods=['GET', 'POST'])
 @login_required
 def add_network_info(customer_id):
     if request.method == 'POST':
@@ -198,11 +534,12 @@ def add_network_info(customer_id):
         )
         db.session.add(network_info)
         db.session.commit()
+        invalidate_customer(customer_id)
         flash('Network information added successfully')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     return render_template('add_network_info.html', customer_id=customer_id)
 
-@app.route('/customer/<int:customer_id>/credential/add', methods=['GET', 'POST'])
+@main.route('/customer/<int:customer_id>/credential/add', methods=['GET', 'POST'])
 @login_required
 def add_credential(customer_id):
     if request.method == 'POST':
@@ -215,19 +552,21 @@ def add_credential(customer_id):
         )
         db.session.add(credential)
         db.session.commit()
+        invalidate_customer(customer_id)
         flash('Password added successfully')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     return render_template('add_credential.html', customer_id=customer_id)
 
-@app.route('/scan-network/<int:customer_id>', methods=['GET', 'POST'])
+@main.route('/scan-network/<int:customer_id>', methods=['GET', 'POST'])
 def scan_network_route(customer_id):
+    from network_scanner import ip_to_int
     if request.method == 'POST':
         try:
             # Get devices from form data
             devices = request.form.getlist('devices[]')
             if not devices:
                 flash('No devices found on the network.', 'warning')
-                return redirect(url_for('scan_network_route', customer_id=customer_id))
+                return redirect(url_for('main.scan_network_route', customer_id=customer_id))
             
             # Parse devices from JSON
             formatted_devices = []
@@ -242,14 +581,14 @@ def scan_network_route(customer_id):
                 formatted_devices.append(formatted_device)
             
             # Sort devices by IP address
-            formatted_devices.sort(key=lambda x: [int(i) for i in x['ip_address'].split('.')])
+            formatted_devices.sort(key=lambda x: ip_to_int(x['ip_address']))
             
             return render_template('scan_network.html', 
                                 customer_id=customer_id,
                                 devices=formatted_devices)
         except Exception as e:
             flash(f'Error processing network scan results: {str(e)}', 'danger')
-            return redirect(url_for('scan_network_route', customer_id=customer_id))
+            return redirect(url_for('main.scan_network_route', customer_id=customer_id))
     
     return render_template('scan_network.html', customer_id=customer_id)
 
@@ -260,71 +599,144 @@ def check_access(customer):
     # Add additional access control logic here if needed
     return True
 
-@app.route('/customer/<int:customer_id>/add_all_network_info', methods=['POST'])
+def known_value(value):
+    """Return a scanned field, or None if the scanner could not work it out."""
+    return None if value in (None, '', 'Unknown') else value
+
+def upsert_network_devices(customer_id, devices, update_existing=False):
+    """
+    Add scanned devices to a customer's NetworkInfo in one transaction.
+    
+    Fetches the customer's existing addresses once, inserts the new devices
+    in a single bulk statement and, if asked, refreshes the MAC address and
+    name of devices that are already recorded.
+    
+    Args:
+        customer_id (int): Customer the devices belong to
+        devices (list): Dicts with ip_address, hostname and mac_address
+        update_existing (bool): Update MAC address and name on existing rows
+            from the scan instead of skipping them
+    
+    Returns:
+        tuple: (added, updated, skipped) device counts; updated only counts
+            rows whose MAC address or name changed
+    """
+    rows = {}
+    for device in devices:
+        ip_address = (device.get('ip_address') or '').strip()
+        if not ip_address or ip_address in rows:
+            continue
+        rows[ip_address] = {
+            'customer_id': customer_id,
+            'device_name': device.get('hostname', 'Unknown Device'),
+            'ip_address': ip_address,
+            'ip_int': ip_address_to_int(ip_address),
+            'mac_address': device.get('mac_address'),
+            'system_type': 'Undefined'  # Default system type
+        }
+    
+    existing = {
+        row.ip_address: row
+        for row in db.session.execute(
+            select(NetworkInfo.ip_address, NetworkInfo.mac_address, NetworkInfo.device_name)
+            .where(NetworkInfo.customer_id == customer_id)
+        )
+    }
+    new_rows = [row for ip_address, row in rows.items() if ip_address not in existing]
+    existing_rows = [row for ip_address, row in rows.items() if ip_address in existing]
+    table = NetworkInfo.__table__
+    
+    if new_rows:
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            # Another request may add the same address between the lookup and the
+            # insert; let the unique index settle it instead of failing the batch
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            statement = dialect_insert(table).on_conflict_do_nothing(
+                index_elements=['customer_id', 'ip_address'])
+            # Rows the conflict clause skipped return nothing, so count what came back
+            added_count = len(db.session.execute(statement.returning(table.c.id), new_rows).all())
+        else:
+            # No portable ON CONFLICT or RETURNING (e.g. MySQL): insert what the
+            # lookup did not find, and let a concurrent duplicate fail the batch
+            db.session.execute(table.insert(), new_rows)
+            added_count = len(new_rows)
+    else:
+        added_count = 0
+    
+    updated_count = 0
+    if update_existing and existing_rows:
+        changes = []
+        for row in existing_rows:
+            current = existing[row['ip_address']]
+            new_mac = known_value(row['mac_address'])
+            new_name = known_value(row['device_name'])
+            change = {
+                'match_ip': row['ip_address'],
+                'new_mac': new_mac if new_mac != current.mac_address else None,
+                'new_name': new_name if new_name != current.device_name else None
+            }
+            if change['new_mac'] or change['new_name']:
+                changes.append(change)
+        if changes:
+            db.session.execute(
+                update(table)
+                .where(table.c.customer_id == customer_id)
+                .where(table.c.ip_address == bindparam('match_ip'))
+                .values(
+                    mac_address=func.coalesce(bindparam('new_mac'), table.c.mac_address),
+                    device_name=func.coalesce(bindparam('new_name'), table.c.device_name)
+                ),
+                changes
+            )
+            updated_count = len(changes)
+    
+    db.session.commit()
+    invalidate_customer(customer_id)
+    # Addresses another request inserted first count as skipped
+    skipped_count = len(existing_rows) - updated_count + len(new_rows) - added_count
+    logger.info(f"Customer {customer_id}: added {added_count}, updated {updated_count}, "
+                f"skipped {skipped_count} scanned devices")
+    return added_count, updated_count, skipped_count
+
+@main.route('/customer/<int:customer_id>/add_all_network_info', methods=['POST'])
 @login_required
 def add_all_network_info(customer_id):
     customer = Customer.query.get_or_404(customer_id)
     
     if not check_access(customer):
         flash('You do not have permission to access this customer.', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
+    
+    update_existing = request.form.get('update_existing') == '1'
+    devices = []
+    for device_json in request.form.getlist('devices[]'):
+        try:
+            devices.append(json.loads(device_json))
+        except json.JSONDecodeError as e:
+            current_app.logger.error(f"Error parsing device data: {e}")
     
     try:
-        devices = request.form.getlist('devices[]')
-        added_count = 0
-        skipped_count = 0
-        
-        for device_json in devices:
-            try:
-                device = json.loads(device_json)
-                
-                # Check if device already exists
-                existing_device = NetworkInfo.query.filter_by(
-                    customer_id=customer_id,
-                    ip_address=device.get('ip_address')
-                ).first()
-                
-                if existing_device:
-                    app.logger.info(f"Skipping existing device: {device.get('ip_address')}")
-                    skipped_count += 1
-                    continue
-                
-                # Create new network info entry
-                network_info = NetworkInfo(
-                    customer_id=customer_id,
-                    device_name=device.get('hostname', 'Unknown Device'),
-                    ip_address=device.get('ip_address'),
-                    mac_address=device.get('mac_address'),
-                    system_type='Undefined'  # Default system type
-                )
-                
-                db.session.add(network_info)
-                added_count += 1
-                
-            except json.JSONDecodeError as e:
-                app.logger.error(f"Error parsing device data: {e}")
-                continue
-            except Exception as e:
-                app.logger.error(f"Error processing device: {e}")
-                continue
-        
-        db.session.commit()
+        added_count, updated_count, skipped_count = upsert_network_devices(
+            customer_id, devices, update_existing)
         
         if added_count > 0:
             flash(f'Successfully added {added_count} new devices.', 'success')
+        if updated_count > 0:
+            flash(f'Updated {updated_count} existing devices.', 'info')
         if skipped_count > 0:
             flash(f'Skipped {skipped_count} existing devices.', 'info')
-        if added_count == 0 and skipped_count == 0:
+        if added_count == 0 and updated_count == 0 and skipped_count == 0:
             flash('No new devices were added.', 'info')
             
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Error adding network info: {e}")
+        current_app.logger.error(f"Error adding network info: {e}")
         flash('An error occurred while adding devices.', 'error')
     
-    return redirect(url_for('customer_details', customer_id=customer_id))
+    return redirect(url_for('main.customer_details', customer_id=customer_id))
 
-@app.route('/customer/<int:customer_id>/network/<int:network_id>/edit', methods=['GET', 'POST'])
+@main.route('/customer/<int:customer_id>/network/<int:network_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_network_info(customer_id, network_id):
     customer = Customer.query.get_or_404(customer_id)
@@ -333,7 +745,7 @@ def edit_network_info(customer_id, network_id):
     # Ensure the network info belongs to the customer
     if network_info.customer_id != customer_id:
         flash('Network information not found for this customer.', 'error')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     
     if request.method == 'POST':
         try:
@@ -357,8 +769,9 @@ def edit_network_info(customer_id, network_id):
                 network_info.cctv_manufacturer = None
             
             db.session.commit()
+            invalidate_customer(customer_id)
             flash('Network information updated successfully!', 'success')
-            return redirect(url_for('customer_details', customer_id=customer_id))
+            return redirect(url_for('main.customer_details', customer_id=customer_id))
         except Exception as e:
             db.session.rollback()
             flash(f'Error updating network information: {str(e)}', 'error')
@@ -368,7 +781,7 @@ def edit_network_info(customer_id, network_id):
                          customer_id=customer_id, 
                          network_info=network_info)
 
-@app.route('/customer/<int:customer_id>/network/<int:network_id>/delete', methods=['POST'])
+@main.route('/customer/<int:customer_id>/network/<int:network_id>/delete', methods=['POST'])
 @login_required
 def delete_network_info(customer_id, network_id):
     customer = Customer.query.get_or_404(customer_id)
@@ -377,19 +790,21 @@ def delete_network_info(customer_id, network_id):
     # Ensure the network info belongs to the customer
     if network_info.customer_id != customer_id:
         flash('Network information not found for this customer.', 'error')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     
     try:
         db.session.delete(network_info)
+        record_deletes('device', customer_id, [network_id])
         db.session.commit()
+        invalidate_customer(customer_id)
         flash('Network device deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'Error deleting network device: {str(e)}', 'error')
     
-    return redirect(url_for('customer_details', customer_id=customer_id))
+    return redirect(url_for('main.customer_details', customer_id=customer_id))
 
-@app.route('/get-network-info')
+@main.route('/get-network-info')
 @login_required
 def get_network_info():
     try:
@@ -421,77 +836,284 @@ def get_network_info():
             'error': f'Error getting network information: {str(e)}'
         }), 500
 
-@app.route('/scan-network')
-@login_required
-def scan_network_api():
-    try:
-        # Get parameters from query string
-        ip_range = request.args.get('ip_range', '')
-        ports_str = request.args.get('ports', '')
+def parse_ports(ports_str):
+    """Parse a comma-separated port list, skipping invalid entries."""
+    port_list = []
+    if ports_str and ports_str.strip():
+        # Split by comma and filter out empty strings
+        port_parts = [p.strip() for p in ports_str.split(',') if p.strip()]
         
-        # Parse ports
-        port_list = []
-        if ports_str and ports_str.strip():
-            # Split by comma and filter out empty strings
-            port_parts = [p.strip() for p in ports_str.split(',') if p.strip()]
-            
-            # Convert each part to an integer
-            for part in port_parts:
-                try:
-                    port_list.append(int(part))
-                except ValueError:
-                    # Skip invalid port numbers
-                    continue
-        
-        # Scan the network
-        devices = scan_network(ip_range, port_list)
-        
-        return jsonify({
-            'devices': devices
+        # Convert each part to an integer
+        for part in port_parts:
+            try:
+                port_list.append(int(part))
+            except ValueError:
+                # Skip invalid port numbers
+                continue
+    return port_list
+
+def latest_scan_run(customer_id):
+    return ScanRun.query.filter_by(customer_id=customer_id).order_by(ScanRun.id.desc()).first()
+
+def rescan_priority(previous_run):
+    """Map each host found by a previous run to the ports it had open."""
+    return {result.ip_address: result.port_list for result in previous_run.results}
+
+def record_scan_run(customer_id, ip_range, port_list, devices, stats, rescan=False, exclude=None):
+    """Store a finished scan and its devices in the customer's scan history."""
+    from network_scanner import DEFAULT_PORTS
+    run = ScanRun(
+        customer_id=customer_id,
+        ip_range=ip_range,
+        exclude=exclude or None,
+        ports=','.join(str(port) for port in (port_list or DEFAULT_PORTS)),
+        rescan=rescan,
+        hosts_scanned=stats.get('hosts_scanned'),
+        devices_found=len(devices),
+        finished_at=datetime.utcnow()
+    )
+    db.session.add(run)
+    db.session.flush()
+    db.session.add_all([
+        ScanResult(
+            run_id=run.id,
+            ip_address=device['ip'],
+            hostname=device.get('hostname'),
+            mac_address=device.get('mac_address'),
+            ports=','.join(str(port) for port in device.get('ports', []))
+        )
+        for device in devices
+    ])
+    db.session.commit()
+    return run
+
+def scan_diffs(customer_id, ip_range, devices, previous_run, exclude=None):
+    """Diff scanned devices against the previous run and the customer's NetworkInfo."""
+    from network_scanner import diff_scans, TargetSpec
+    scope = TargetSpec(ip_range, exclude)
+    known_devices = [
+        {'ip': info.ip_address, 'mac_address': info.mac_address, 'ports': None}
+        for info in NetworkInfo.query.filter_by(customer_id=customer_id)
+                                     .filter(NetworkInfo.in_targets(scope)).all()
+    ]
+    diffs = {
+        'previous_run_id': previous_run.id if previous_run else None,
+        'previous_run': None,
+        'network_info': diff_scans(known_devices, devices, scope)
+    }
+    if previous_run:
+        previous_devices = [result.to_device() for result in previous_run.results]
+        diffs['previous_run'] = diff_scans(previous_devices, devices, scope)
+    return diffs
+
+def recorded_scan_events(events, customer_id, ip_range, port_list, previous_run, rescan, exclude=None):
+    """Pass scan events through, saving the run and adding a diff event at the end."""
+    devices = []
+    for event in events:
+        if event['event'] == 'device':
+            devices.append(event['device'])
+        elif event['event'] == 'done' and not event['stats']['cancelled']:
+            run = record_scan_run(customer_id, ip_range, port_list, devices, event['stats'], rescan, exclude)
+            yield {
+                'event': 'diff',
+                'run_id': run.id,
+                'diff': scan_diffs(customer_id, ip_range, devices, previous_run, exclude)
+            }
+        yield event
+
+def scan_response(ip_range, port_list):
+    """Run a scan and return its devices as JSON, or stream them if requested.
+
+    With ?customer_id= the scan is saved to that customer's history and the
+    response includes a diff against the previous run and NetworkInfo; adding
+    rescan=1 sweeps the hosts and ports found last time first. ip_range may list
+    several comma-separated ranges, and ?exclude= takes addresses to skip in
+    the same format.
+    """
+    from network_scanner import (scan_network, iter_scan, format_ndjson, format_sse, ScanStats,
+                                 detect_ip_range)
+    customer_id = request.args.get('customer_id', type=int)
+    rescan = request.args.get('rescan') == '1'
+    exclude = request.args.get('exclude', '')
+    ip_range = ip_range or detect_ip_range()
+    previous_run = None
+    priority = None
+    if customer_id is not None:
+        if db.session.get(Customer, customer_id) is None:
+            return jsonify({
+                'error': 'Customer not found'
+            }), 404
+        previous_run = latest_scan_run(customer_id)
+        if rescan and previous_run:
+            priority = rescan_priority(previous_run)
+    
+    stream = request.args.get('stream', '').lower()
+    if stream in ('ndjson', 'sse'):
+        events = iter_scan(ip_range, port_list, priority=priority, exclude=exclude)
+        if customer_id is not None:
+            events = recorded_scan_events(events, customer_id, ip_range, port_list, previous_run,
+                                          rescan, exclude)
+        if stream == 'sse':
+            body = (format_sse(event) for event in events)
+            mimetype = 'text/event-stream'
+        else:
+            body = (format_ndjson(event) for event in events)
+            mimetype = 'application/x-ndjson'
+        return Response(stream_with_context(body), mimetype=mimetype, headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
         })
+    
+    try:
+        stats = ScanStats()
+        devices = scan_network(ip_range, port_list, stats=stats, priority=priority, exclude=exclude)
+        result = {
+            'devices': devices,
+            'stats': stats.to_dict()
+        }
+        if customer_id is not None:
+            run = record_scan_run(customer_id, ip_range, port_list, devices, result['stats'],
+                                  rescan, exclude)
+            result['run_id'] = run.id
+            result['diff'] = scan_diffs(customer_id, ip_range, devices, previous_run, exclude)
+        
+        return jsonify(result)
     except ValueError as e:
         return jsonify({
             'error': str(e)
         }), 400
     except Exception as e:
+        db.session.rollback()
         return jsonify({
             'error': f'Error scanning network: {str(e)}'
         }), 500
 
-@app.route('/scan-network/<ip_range>/<ports>')
+@main.route('/scan-network')
+@login_required
+def scan_network_api():
+    # Get parameters from query string
+    ip_range = request.args.get('ip_range', '')
+    port_list = parse_ports(request.args.get('ports', ''))
+    return scan_response(ip_range, port_list)
+
+@main.route('/scan-network/<ip_range>/<ports>')
 @login_required
 def scan_network_path_params(ip_range, ports):
-    try:
-        # Parse ports
-        port_list = []
-        if ports and ports.strip():
-            # Split by comma and filter out empty strings
-            port_parts = [p.strip() for p in ports.split(',') if p.strip()]
-            
-            # Convert each part to an integer
-            for part in port_parts:
-                try:
-                    port_list.append(int(part))
-                except ValueError:
-                    # Skip invalid port numbers
-                    continue
-        
-        # Scan the network
-        devices = scan_network(ip_range, port_list)
-        
+    return scan_response(ip_range, parse_ports(ports))
+
+@main.route('/scan-jobs', methods=['POST'])
+@login_required
+def submit_scan_job():
+    from network_scanner import detect_ip_range, ip_to_int, TargetSpec
+    params = request.get_json(silent=True) or request.values
+    ip_range = params.get('ip_range') or detect_ip_range()
+    ports = params.get('ports', '')
+    if isinstance(ports, str):
+        port_list = parse_ports(ports)
+    else:
+        try:
+            port_list = [int(port) for port in ports]
+        except (TypeError, ValueError):
+            return jsonify({
+                'error': 'Ports must be a list of port numbers or a comma-separated string'
+            }), 400
+    if any(port < 1 or port > 65535 for port in port_list):
         return jsonify({
-            'devices': devices
-        })
+            'error': 'Ports must be between 1 and 65535'
+        }), 400
+    customer_id = params.get('customer_id')
+    if customer_id in (None, ''):
+        customer_id = None
+    else:
+        try:
+            customer_id = int(customer_id)
+        except (TypeError, ValueError):
+            return jsonify({
+                'error': 'Customer ID must be an integer'
+            }), 400
+    rescan = str(params.get('rescan', '')).lower() in ('1', 'true')
+    exclude = params.get('exclude') or ''
+    
+    try:
+        TargetSpec(ip_range, exclude)
     except ValueError as e:
         return jsonify({
             'error': str(e)
         }), 400
-    except Exception as e:
+    
+    previous_run_id = None
+    priority = None
+    if customer_id is not None:
+        if db.session.get(Customer, customer_id) is None:
+            return jsonify({
+                'error': 'Customer not found'
+            }), 404
+        previous_run = latest_scan_run(customer_id)
+        if previous_run:
+            previous_run_id = previous_run.id
+            if rescan:
+                priority = rescan_priority(previous_run)
+    
+    app = current_app._get_current_object()
+    
+    def on_finish(job):
+        # Runs on the scan thread, outside any request
+        if job.customer_id is None:
+            return None
+        with app.app_context():
+            devices = sorted(job.devices, key=lambda device: ip_to_int(device['ip']))
+            previous_run = db.session.get(ScanRun, previous_run_id) if previous_run_id else None
+            run = record_scan_run(job.customer_id, job.ip_range, job.ports, devices,
+                                  job.stats.to_dict(), rescan, exclude)
+            return {
+                'run_id': run.id,
+                'diff': scan_diffs(job.customer_id, job.ip_range, devices, previous_run, exclude)
+            }
+    
+    try:
+        job = scan_jobs.submit(ip_range, port_list, customer_id=customer_id,
+                               on_finish=on_finish, priority=priority, exclude=exclude)
+    except ScanJobLimitError as e:
         return jsonify({
-            'error': f'Error scanning network: {str(e)}'
-        }), 500
+            'error': str(e)
+        }), 429
+    
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = url_for('main.scan_job_status', job_id=job.id)
+    return response
 
-@app.route('/customer/<int:customer_id>/edit', methods=['GET', 'POST'])
+@main.route('/scan-jobs/<job_id>')
+@login_required
+def scan_job_status(job_id):
+    job = scan_jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            'error': 'Scan job not found'
+        }), 404
+    return jsonify(job.to_dict())
+
+@main.route('/scan-jobs/<job_id>/results')
+@login_required
+def scan_job_results(job_id):
+    job = scan_jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            'error': 'Scan job not found'
+        }), 404
+    return jsonify(job.to_dict(include_devices=True))
+
+@main.route('/scan-jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_scan_job(job_id):
+    job = scan_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({
+            'error': 'Scan job not found'
+        }), 404
+    return jsonify(job.to_dict())
+
+@main.route('/customer/<int:customer_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_customer(customer_id):
     customer = Customer.query.get_or_404(customer_id)
@@ -505,39 +1127,226 @@ def edit_customer(customer_id):
         customer.email = request.form.get('email')
         
         db.session.commit()
+        invalidate_customer(customer_id)
         flash('Customer updated successfully')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     
     return render_template('edit_customer.html', customer=customer)
 
-@app.route('/customer/<int:customer_id>/delete', methods=['POST'])
+@main.route('/customer/<int:customer_id>/delete', methods=['POST'])
 @login_required
 def delete_customer(customer_id):
     customer = Customer.query.get_or_404(customer_id)
     check_access(customer)
     
     try:
-        # Delete all associated CCTV users first
-        CCTVUser.query.filter_by(customer_id=customer_id).delete()
-        
-        # Delete all associated credentials
-        Credential.query.filter_by(customer_id=customer_id).delete()
-        
-        # Delete all associated network info
-        NetworkInfo.query.filter_by(customer_id=customer_id).delete()
-        
-        # Now delete the customer
-        db.session.delete(customer)
+        # Devices, passwords, CCTV users and scan history go with it through
+        # ON DELETE CASCADE
+        db.session.execute(delete(Customer).where(Customer.id == customer_id))
+        record_deletes('customer', customer_id, [customer_id])
         db.session.commit()
+        invalidate_customer(customer_id)
         
         flash('Customer and all associated data have been deleted successfully')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     except Exception as e:
         db.session.rollback()
         flash(f'Error deleting customer: {str(e)}', 'error')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
+
+# Record types the bulk delete endpoint accepts
+BULK_DELETE_MODELS = {
+    'device': NetworkInfo,
+    'credential': Credential
+}
+
+def is_record_id(value):
+    """True for an int or a string of ASCII digits; bools are not ids."""
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, str) and value.isascii() and value.isdigit())
+
+@main.route('/customer/<int:customer_id>/bulk-delete', methods=['POST'])
+@login_required
+def bulk_delete(customer_id):
+    """Delete a list of a customer's devices or passwords in one transaction.
+    
+    Takes JSON {"kind": "device"|"credential", "ids": [...]} and answers in
+    JSON, or the same fields as a form post and redirects back to the
+    customer. Ids that do not belong to the customer are ignored.
+    """
+    customer = db.get_or_404(Customer, customer_id)
+    check_access(customer)
+    
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        kind = payload.get('kind')
+        ids = payload.get('ids')
+    elif payload is not None:
+        kind = ids = None
+    else:
+        kind = request.form.get('kind')
+        ids = request.form.getlist('ids')
+    
+    def respond(message, category, status=200, **data):
+        if payload is not None:
+            if status != 200:
+                return jsonify({
+                    'error': message
+                }), status
+            return jsonify(data)
+        flash(message, category)
+        anchor = '#credentials' if kind == 'credential' else ''
+        return redirect(url_for('main.customer_details', customer_id=customer_id) + anchor)
+    
+    if payload is not None and not isinstance(payload, dict):
+        return respond('Expected a JSON object with kind and ids', 'error', 400)
+    model = BULK_DELETE_MODELS.get(kind)
+    if model is None:
+        return respond(f"Unknown record type '{kind}'", 'error', 400)
+    if not isinstance(ids, list) or not all(map(is_record_id, ids)):
+        return respond('Record ids must be a list of integers', 'error', 400)
+    ids = sorted({int(record_id) for record_id in ids})
+    
+    try:
+        # Look the ids up first so only records that really went get tombstones
+        deleted_ids = db.session.scalars(
+            select(model.id).where(model.customer_id == customer_id, model.id.in_(ids))
+        ).all()
+        db.session.execute(
+            delete(model)
+            .where(model.id.in_(deleted_ids))
+            .execution_options(synchronize_session=False)
+        )
+        record_deletes(kind, customer_id, deleted_ids)
+        db.session.commit()
+        invalidate_customer(customer_id)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Bulk delete of {kind} records for customer {customer_id} failed: {str(e)}")
+        return respond(f'Error deleting records: {str(e)}', 'error', 500)
+    
+    label = 'devices' if kind == 'device' else 'passwords'
+    return respond(f'Deleted {len(deleted_ids)} {label}.', 'success',
+                   kind=kind, requested=len(ids), deleted=len(deleted_ids))
+
+# Seconds the sync cursor stays behind the clock, so rows stamped just before
+# a slow transaction commits are sent on the next sync instead of skipped.
+# updated_at is stamped when a row is written, not when its transaction
+# commits, so a transaction that stays open longer than this can commit rows
+# older than a cursor already handed out, and clients holding that cursor
+# never receive them. Requests here commit within milliseconds; raise this
+# before running anything that holds a write transaction open for longer.
+SYNC_CURSOR_LAG = int(os.environ.get('SYNC_CURSOR_LAG', 5))
+
+# Internal columns left out of sync rows
+SYNC_EXCLUDED_COLUMNS = {'ip_int'}
+
+def sync_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def sync_fingerprint(since):
+    """
+    Summarise what a sync from a cursor would return, in one query.
+    
+    Returns:
+        list: Newest updated_at and row count per kind, then the newest
+            tombstone id and deleted_at (all None-able)
+    """
+    columns = []
+    for model in SYNC_MODELS.values():
+        changed = model.updated_at >= since if since else true()
+        columns.append(select(func.max(model.updated_at)).where(changed).scalar_subquery())
+        columns.append(select(func.count(model.id)).where(changed).scalar_subquery())
+    deleted = Tombstone.deleted_at >= since if since else true()
+    columns.append(select(func.max(Tombstone.id)).where(deleted).scalar_subquery())
+    columns.append(select(func.max(Tombstone.deleted_at)).where(deleted).scalar_subquery())
+    return list(db.session.execute(select(*columns)).one())
+
+@main.route('/api/sync')
+@login_required
+def sync_api():
+    """Customers, devices, passwords and CCTV users changed since a cursor.
+    
+    Pass ?since= the cursor from the previous response, or nothing for a
+    full copy. Rows changed at or after the cursor are returned under
+    "changes" by kind, deletes under "deleted"; "full" tells the client to
+    replace its copy rather than merge (no cursor, or one older than the
+    tombstone retention). Responses carry an ETag, and a matching
+    If-None-Match gets 304 after a single aggregate query. Rows at the
+    cursor itself may be sent again, so clients should upsert by id.
+    
+    The cursor is a timestamp held SYNC_CURSOR_LAG seconds behind the clock,
+    so rows from a write transaction open longer than that can be missed.
+    """
+    since_arg = request.args.get('since')
+    since = None
+    if since_arg:
+        try:
+            since = datetime.fromisoformat(since_arg)
+        except ValueError:
+            return jsonify({
+                'error': 'since must be a cursor returned by /api/sync'
+            }), 400
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    now = datetime.utcnow()
+    full = since is None or since < now - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    if full:
+        since = None
+    
+    fingerprint = sync_fingerprint(since)
+    etag = hashlib.sha1(json.dumps([since_arg, full, fingerprint], default=str).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    changes = {}
+    for kind, model in SYNC_MODELS.items():
+        columns = [column for column in model.__table__.columns if column.key not in SYNC_EXCLUDED_COLUMNS]
+        query = select(*columns).order_by(model.updated_at, model.id)
+        if since:
+            query = query.where(model.updated_at >= since)
+        changes[kind] = [
+            {key: sync_value(value) for key, value in row.items()}
+            for row in db.session.execute(query).mappings()
+        ]
+    
+    deleted = []
+    if not full:
+        tombstones = db.session.scalars(
+            select(Tombstone).where(Tombstone.deleted_at >= since).order_by(Tombstone.id)
+        )
+        deleted = [
+            {
+                'kind': tombstone.kind,
+                'id': tombstone.record_id,
+                'customer_id': tombstone.customer_id,
+                'deleted_at': sync_value(tombstone.deleted_at)
+            }
+            for tombstone in tombstones
+        ]
+    
+    latest = max((value for value in fingerprint if isinstance(value, datetime)), default=None)
+    horizon = now - timedelta(seconds=SYNC_CURSOR_LAG)
+    if latest is not None:
+        cursor = min(latest, horizon)
+    else:
+        cursor = since or horizon
+    
+    response = jsonify({
+        'cursor': sync_value(cursor),
+        'full': full,
+        'changes': changes,
+        'deleted': deleted
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
-@app.route('/customer/<int:customer_id>/cctv/user/add', methods=['GET', 'POST'])
+@main.route('/customer/<int:customer_id>/cctv/user/add', methods=['GET', 'POST'])
 @login_required
 def add_cctv_user(customer_id):
     customer = Customer.query.get_or_404(customer_id)
@@ -549,7 +1358,7 @@ def add_cctv_user(customer_id):
         
         if not username or not password:
             flash('Username and password are required', 'danger')
-            return redirect(url_for('add_cctv_user', customer_id=customer_id))
+            return redirect(url_for('main.add_cctv_user', customer_id=customer_id))
         
         user = CCTVUser(
             customer_id=customer_id,
@@ -559,13 +1368,14 @@ def add_cctv_user(customer_id):
         
         db.session.add(user)
         db.session.commit()
+        invalidate_customer(customer_id)
         
         flash('CCTV user added successfully', 'success')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     
     return render_template('add_cctv_user.html', customer=customer)
 
-@app.route('/customer/<int:customer_id>/cctv/user/<int:user_id>/edit', methods=['GET', 'POST'])
+@main.route('/customer/<int:customer_id>/cctv/user/<int:user_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_cctv_user(customer_id, user_id):
     customer = Customer.query.get_or_404(customer_id)
@@ -579,19 +1389,20 @@ def edit_cctv_user(customer_id, user_id):
         
         if not username or not password:
             flash('Username and password are required', 'danger')
-            return redirect(url_for('edit_cctv_user', customer_id=customer_id, user_id=user_id))
+            return redirect(url_for('main.edit_cctv_user', customer_id=customer_id, user_id=user_id))
         
         user.username = username
         user.password = password
         
         db.session.commit()
+        invalidate_customer(customer_id)
         
         flash('CCTV user updated successfully', 'success')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     
     return render_template('edit_cctv_user.html', customer=customer, user=user)
 
-@app.route('/customer/<int:customer_id>/cctv/user/<int:user_id>/delete', methods=['POST'])
+@main.route('/customer/<int:customer_id>/cctv/user/<int:user_id>/delete', methods=['POST'])
 @login_required
 def delete_cctv_user(customer_id, user_id):
     customer = Customer.query.get_or_404(customer_id)
@@ -600,12 +1411,14 @@ def delete_cctv_user(customer_id, user_id):
     user = CCTVUser.query.filter_by(id=user_id, customer_id=customer_id).first_or_404()
     
     db.session.delete(user)
+    record_deletes('cctv_user', customer_id, [user_id])
     db.session.commit()
+    invalidate_customer(customer_id)
     
     flash('CCTV user deleted successfully', 'success')
-    return redirect(url_for('customer_details', customer_id=customer_id))
+    return redirect(url_for('main.customer_details', customer_id=customer_id))
 
-@app.route('/customer/<int:customer_id>/credential/<int:credential_id>/edit', methods=['GET', 'POST'])
+@main.route('/customer/<int:customer_id>/credential/<int:credential_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_credential(customer_id, credential_id):
     credential = Credential.query.filter_by(id=credential_id, customer_id=customer_id).first_or_404()
@@ -617,158 +1430,31 @@ def edit_credential(customer_id, credential_id):
         credential.notes = request.form.get('notes')
         
         db.session.commit()
+        invalidate_customer(customer_id)
         flash('Password updated successfully')
-        return redirect(url_for('customer_details', customer_id=customer_id))
+        return redirect(url_for('main.customer_details', customer_id=customer_id))
     
     return render_template('edit_credential.html', customer_id=customer_id, credential=credential)
 
-@app.route('/customer/<int:customer_id>/credential/<int:credential_id>/delete', methods=['POST'])
+@main.route('/customer/<int:customer_id>/credential/<int:credential_id>/delete', methods=['POST'])
 @login_required
 def delete_credential(customer_id, credential_id):
     credential = Credential.query.filter_by(id=credential_id, customer_id=customer_id).first_or_404()
     
     db.session.delete(credential)
+    record_deletes('credential', customer_id, [credential_id])
     db.session.commit()
+    invalidate_customer(customer_id)
     
     flash('Password deleted successfully')
-    return redirect(url_for('customer_details', customer_id=customer_id))
-
-def scan_network(ip_range=None, ports=None):
-    """
-    Scan the network for devices.
-    
-    Args:
-        ip_range (str): IP range in CIDR notation (e.g., '192.168.1.0/24')
-        ports (list): List of ports to scan
-        
-    Returns:
-        list: List of devices found
-    """
-    import socket
-    import struct
-    import threading
-    import time
-    
-    devices = []
-    
-    # Default to common ports if none specified
-    if not ports:
-        ports = [21, 22, 23, 25, 53, 80, 110, 139, 143, 443, 445, 3306, 3389, 5432, 8080]
-    
-    # If no IP range specified, try to detect it
-    if not ip_range:
-        try:
-            import netifaces
-            gateways = netifaces.gateways()
-            default_gateway = gateways['default'][netifaces.AF_INET]
-            interface = default_gateway[1]
-            
-            addrs = netifaces.ifaddresses(interface)
-            ip_info = addrs[netifaces.AF_INET][0]
-            ip = ip_info['addr']
-            subnet = ip_info['netmask']
-            
-            # Convert to CIDR notation
-            cidr = sum(bin(int(x)).count('1') for x in subnet.split('.'))
-            ip_range = f"{ip}/{cidr}"
-        except Exception as e:
-            print(f"Error detecting IP range: {e}")
-            # Fallback to a common range
-            ip_range = "192.168.1.0/24"
-    
-    # Parse IP range
-    try:
-        # Handle different IP range formats
-        if '/' in ip_range:
-            # CIDR notation (e.g., 192.168.1.0/24)
-            ip_parts = ip_range.split('/')
-            if len(ip_parts) != 2:
-                raise ValueError("Invalid IP range format. Use CIDR notation (e.g., 192.168.1.0/24)")
-            
-            network = ip_parts[0]
-            bits = int(ip_parts[1])
-            
-            # Convert IP to integer
-            ip_int = struct.unpack('!L', socket.inet_aton(network))[0]
-            
-            # Calculate network and broadcast addresses
-            mask = ~((1 << (32 - bits)) - 1) & 0xFFFFFFFF
-            network_int = ip_int & mask
-            broadcast_int = network_int | ~mask & 0xFFFFFFFF
-        else:
-            # Single IP or range (e.g., 192.168.1.1-192.168.1.254)
-            if '-' in ip_range:
-                start_ip, end_ip = ip_range.split('-')
-                network_int = struct.unpack('!L', socket.inet_aton(start_ip.strip()))[0]
-                broadcast_int = struct.unpack('!L', socket.inet_aton(end_ip.strip()))[0]
-            else:
-                # Single IP
-                ip_int = struct.unpack('!L', socket.inet_aton(ip_range.strip()))[0]
-                network_int = ip_int
-                broadcast_int = ip_int
-        
-        # Convert back to string for logging
-        network_str = socket.inet_ntoa(struct.pack('!L', network_int))
-        broadcast_str = socket.inet_ntoa(struct.pack('!L', broadcast_int))
-        
-        print(f"Scanning network {network_str} to {broadcast_str}")
-        
-        # Function to scan a single IP
-        def scan_ip(ip):
-            ip_str = socket.inet_ntoa(struct.pack('!L', ip))
-            
-            # Try to get hostname
-            try:
-                hostname = socket.gethostbyaddr(ip_str)[0]
-            except:
-                hostname = None
-            
-            # Check if any ports are open
-            open_ports = []
-            for port in ports:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(0.1)
-                result = sock.connect_ex((ip_str, port))
-                if result == 0:
-                    open_ports.append(port)
-                sock.close()
-            
-            if hostname or open_ports:
-                devices.append({
-                    'ip': ip_str,
-                    'hostname': hostname,
-                    'ports': open_ports
-                })
-        
-        # Create threads for scanning
-        threads = []
-        for i in range(network_int + 1, broadcast_int):
-            t = threading.Thread(target=scan_ip, args=(i,))
-            threads.append(t)
-            t.start()
-            
-            # Limit concurrent threads
-            if len(threads) >= 100:
-                for t in threads:
-                    t.join()
-                threads = []
-        
-        # Wait for remaining threads
-        for t in threads:
-            t.join()
-        
-    except Exception as e:
-        print(f"Error scanning network: {e}")
-        # Return a more helpful error message
-        raise ValueError(f"Error scanning network: {str(e)}")
-    
-    return devices
+    return redirect(url_for('main.customer_details', customer_id=customer_id))
 
-@app.route('/health')
+@main.route('/health')
 def health_check():
     try:
-        # Test database connection
-        db.session.execute('SELECT 1')
+        # Check out a pooled connection directly rather than through a session
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql('SELECT 1')
         return jsonify({
             'status': 'healthy',
             'database': 'connected'
@@ -792,7 +1478,39 @@ def require_debug_token(f):
         return f(*args, **kwargs)
     return decorated_function
 
-@app.route('/verify-db', methods=['GET'])
+@main.route('/cache-stats', methods=['GET'])
+@require_debug_token
+def cache_stats():
+    return jsonify({
+        'status': 'success',
+        'fragment_cache': get_fragment_cache().stats(),
+        'user_cache': get_user_cache().stats()
+    })
+
+@main.route('/metrics', methods=['GET'])
+@require_debug_token
+def metrics_api():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@main.route('/sql-profile', methods=['GET'])
+@require_debug_token
+def sql_profile():
+    """Recent per-request SQL profiles, newest first; ?n_plus_one=1 keeps flagged ones only."""
+    return jsonify({
+        'status': 'success',
+        'enabled': profiler.is_enabled(),
+        'profiles': profiler.recent(n_plus_one_only=request.args.get('n_plus_one') == '1')
+    })
+
+@main.route('/pool-stats', methods=['GET'])
+@require_debug_token
+def pool_stats_api():
+    return jsonify({
+        'status': 'success',
+        'pool': pool_stats(db.engine.pool)
+    })
+
+@main.route('/verify-db', methods=['GET'])
 @require_debug_token
 def verify_db():
     try:
@@ -824,11 +1542,13 @@ def verify_db():
             'message': str(e)
         }), 500
 
-@app.route('/run-migrations', methods=['GET'])
+@main.route('/run-migrations', methods=['GET'])
 @require_debug_token
 def run_migrations():
     try:
         logger.info("Running database migrations...")
+        init_migrate(current_app)
+        from flask_migrate import upgrade
         upgrade()
         logger.info("Migrations completed successfully")
         
@@ -843,7 +1563,7 @@ def run_migrations():
             'message': str(e)
         }), 500
 
-@app.route('/setup-admin', methods=['GET'])
+@main.route('/setup-admin', methods=['GET'])
 @require_debug_token
 def setup_admin():
     try:
@@ -901,7 +1621,7 @@ def setup_admin():
             'message': str(e)
         }), 500
 
-@app.route('/debug-admin', methods=['GET'])
+@main.route('/debug-admin', methods=['GET'])
 @require_debug_token
 def debug_admin():
     try:
@@ -929,7 +1649,90 @@ def debug_admin():
             'message': str(e)
         }), 500
 
+def init_migrate(app):
+    """Register Flask-Migrate, importing it and alembic only when migrations are needed."""
+    if 'migrate' not in app.extensions:
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create missing tables and apply outstanding migrations; run once per deploy."""
+    db.create_all()
+    init_migrate(current_app)
+    from flask_migrate import upgrade
+    upgrade()
+    click.echo('Database schema is up to date.')
+
+def install_schema_check(app):
+    """Create missing tables on the first request instead of at import."""
+    lock = threading.Lock()
+    checked = []
+    
+    @app.before_request
+    def ensure_schema():
+        if checked:
+            return
+        with lock:
+            if not checked:
+                started = time.perf_counter()
+                db.create_all()
+                checked.append(True)
+                logger.info(f"Schema checked in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+def create_app(config=None):
+    """
+    Build the Flask app without touching the database.
+    
+    The engine connects on first use. Missing tables are created before
+    the first request unless AUTO_CREATE_SCHEMA=0, in which case deploys
+    run `flask init-db` instead. Flask-Migrate is loaded only for the flask
+    command line and /run-migrations, and the scanner on the first scan.
+    
+    Args:
+        config (dict): Settings applied over the environment-derived ones
+    
+    Returns:
+        Flask: The configured app
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', os.urandom(24))
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['AUTO_CREATE_SCHEMA'] = os.environ.get('AUTO_CREATE_SCHEMA', '1') == '1'
+    app.config['SQL_PROFILER'] = SQL_PROFILER
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    
+    db.init_app(app)
+    login_manager.init_app(app)
+    FragmentCache().init_app(app)
+    app.extensions['user_cache'] = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+    app.register_blueprint(main)
+    app.cli.add_command(init_db_command)
+    if click.get_current_context(silent=True) is not None:
+        # Loaded by the flask command, whose `flask db` group needs Flask-Migrate
+        init_migrate(app)
+    if app.config['AUTO_CREATE_SCHEMA']:
+        install_schema_check(app)
+    
+    app.config['STARTUP_TIMINGS'] = {
+        'import_seconds': IMPORT_SECONDS,
+        'create_app_seconds': time.perf_counter() - started
+    }
+    metrics.init_app(app)
+    profiler.init_app(app, app.config['SQL_PROFILER'])
+    logger.info(f"App created in {app.config['STARTUP_TIMINGS']['create_app_seconds'] * 1000:.1f} ms, "
+                f"{IMPORT_SECONDS * 1000:.1f} ms after app.py started importing")
+    return app
+
+# Import cost up to here, reported with each app's startup timings
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+app = create_app()
+
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
     app.run(debug=True, port=8080) 
\ No newline at end of file
@@ -0,0 +1,417 @@
+"""
+Benchmarks for the scanner and the busiest routes.
+
+Scanner benchmarks run scan_network() against TCP listeners bound on
+loopback addresses (127.0.0.0/8), so they need no network. Linux routes
+the whole block to lo; elsewhere, add the addresses as aliases first.
+
+Route benchmarks drive index, customer_details and add_all_network_info
+through the Flask test client against a generated SQLite dataset, which
+is built once and reused while its size matches. Each run works on a
+copy, so the import pass never changes the dataset later runs measure.
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --compare results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import selectors
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loopback ranges scanned, with every LISTENER_EVERY-th host listening
+SCAN_RANGES = ['127.77.0.0/24', '127.77.0.0/22']
+LISTENER_EVERY = 16
+
+# Ports probed by the scanner benchmarks; listeners accept on the first two
+SCAN_PORTS = [18022, 18080, 18443]
+
+# Size of the generated route benchmark dataset
+DEFAULT_CUSTOMERS = 10000
+DEFAULT_DEVICES = 100000
+
+# Requests timed per route benchmark
+DEFAULT_ITERATIONS = 50
+
+# Devices posted per add_all_network_info request. Up to half repeat
+# addresses the customer already has (the default dataset gives each one
+# 10); the rest are new.
+DEVICES_PER_IMPORT = 50
+
+# Relative change in a compared metric reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+# Metrics compared between runs, and whether higher values are better
+COMPARED_METRICS = {
+    'hosts_per_second': True,
+    'probes_per_second': True,
+    'wall_seconds': False,
+    'p50_ms': False,
+    'p95_ms': False,
+    'queries_per_request': False
+}
+
+
+class LoopbackListeners:
+    """Accept-and-close TCP listeners on loopback addresses, served by one thread."""
+
+    def __init__(self, addresses, ports):
+        self.sockets = []
+        self.selector = selectors.DefaultSelector()
+        self._stop = threading.Event()
+        for address in addresses:
+            for port in ports:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.bind((address, port))
+                listener.listen(512)
+                listener.setblocking(False)
+                self.selector.register(listener, selectors.EVENT_READ)
+                self.sockets.append(listener)
+        self._thread = threading.Thread(target=self._serve, name='bench-listeners', daemon=True)
+
+    def _serve(self):
+        while not self._stop.is_set():
+            for key, _ in self.selector.select(timeout=0.1):
+                try:
+                    connection, _ = key.fileobj.accept()
+                    connection.close()
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        for listener in self.sockets:
+            self.selector.unregister(listener)
+            listener.close()
+        self.selector.close()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def bench_scan(ip_range, processes=1, rate=None, resolve_dns=False):
+    from network_scanner import TargetSpec, ScanStats, dns_cache, int_to_ip, scan_network
+
+    targets = TargetSpec(ip_range)
+    addresses = [int_to_ip(address) for index, address in enumerate(targets) if index % LISTENER_EVERY == 0]
+    dns_cache.clear()
+    if not resolve_dns:
+        # Loopback PTR lookups only measure the local resolver, so answer them from the cache
+        dns_cache.load({int_to_ip(address): f'bench-{address & 0xffff}' for address in targets})
+    with LoopbackListeners(addresses, SCAN_PORTS[:2]):
+        stats = ScanStats()
+        started = time.perf_counter()
+        devices = scan_network(ip_range, SCAN_PORTS, stats=stats, processes=processes, rate=rate)
+        wall = time.perf_counter() - started
+
+    found = {device['ip'] for device in devices if device['ports']}
+    return {
+        'hosts': len(targets),
+        'listening_hosts': len(addresses),
+        'found_hosts': len(found & set(addresses)),
+        'wall_seconds': round(wall, 3),
+        'hosts_per_second': round(len(targets) / wall, 1),
+        'probes_per_second': round(stats.probes / wall, 1),
+        'probes': stats.probes,
+        'timeouts': stats.timeouts,
+        'processes': processes,
+        'rate': rate,
+        'resolve_dns': resolve_dns
+    }
+
+
+def device_identity(device_id, customers):
+    """Return the (customer_id, ip_address) the generated dataset gives a device id."""
+    index = device_id - 1
+    customer_id = index % customers + 1
+    host = index // customers
+    return customer_id, f'10.{host // 250}.{host % 250}.{customer_id % 250 + 1}'
+
+
+def build_dataset(app_module, customers, devices):
+    """Fill an empty database with customers and devices spread evenly across them."""
+    app, db = app_module.app, app_module.db
+    from sqlalchemy import func, select
+
+    with app.app_context():
+        db.create_all()
+        if db.session.scalar(select(func.count(app_module.Customer.id))) == customers and \
+                db.session.scalar(select(func.count(app_module.NetworkInfo.id))) == devices:
+            return False
+        db.drop_all()
+        db.create_all()
+        now = datetime.utcnow()
+        db.session.execute(app_module.Customer.__table__.insert(), [
+            {'name': f'Customer {index:05d}', 'contact_person': f'Contact {index}', 'phone': '555-0100',
+             'email': f'customer{index}@example.com', 'created_at': now, 'updated_at': now}
+            for index in range(customers)
+        ])
+        rows = []
+        for index in range(devices):
+            customer_id, ip_address = device_identity(index + 1, customers)
+            rows.append({
+                'customer_id': customer_id,
+                'device_name': f'device-{index}',
+                'ip_address': ip_address,
+                'ip_int': app_module.ip_address_to_int(ip_address),
+                'mac_address': f'02:00:00:{index >> 16 & 255:02x}:{index >> 8 & 255:02x}:{index & 255:02x}',
+                'system_type': random.choice(['Switch', 'Camera', 'Workstation', 'Undefined']),
+                'updated_at': now
+            })
+        db.session.execute(app_module.NetworkInfo.__table__.insert(), rows)
+        db.session.commit()
+    return True
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+def time_requests(client, requests, counter, before_each=None, warm=False):
+    if warm:
+        # Render every page once first, so the timed pass reads the cache
+        for method, path, data in requests:
+            client.open(path, method=method, data=data)
+    timings = []
+    counter.count = 0
+    for method, path, data in requests:
+        if before_each:
+            before_each()
+        started = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        timings.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {path} returned {response.status_code}')
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+        'mean_ms': round(statistics.mean(timings) * 1000, 3),
+        'max_ms': round(max(timings) * 1000, 3),
+        'queries_per_request': round(counter.count / len(timings), 2)
+    }
+
+
+# Account the benchmarks log in as, created with the dataset
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench'
+
+
+def load_app(database, customers, devices):
+    """
+    Import the app against a SQLite file holding the generated dataset.
+
+    Returns:
+        tuple: The app module and setup details for the results' meta
+    """
+    os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    # Keep fragments in process so clearing them makes a request cold
+    os.environ.pop('FRAGMENT_CACHE_PATH', None)
+    sys.path.insert(0, APP_DIR)
+    import app as app_module
+    from werkzeug.security import generate_password_hash
+
+    started = time.perf_counter()
+    built = build_dataset(app_module, customers, devices)
+    setup_seconds = time.perf_counter() - started
+
+    app, db = app_module.app, app_module.db
+    # Per-request and per-scan INFO lines would swamp the results
+    for name in (app_module.__name__, 'scan_jobs', 'network_scanner'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    with app.app_context():
+        if not app_module.User.query.filter_by(username=BENCH_USERNAME).first():
+            db.session.add(app_module.User(username=BENCH_USERNAME, is_admin=True,
+                                           password_hash=generate_password_hash(BENCH_PASSWORD)))
+            db.session.commit()
+    return app_module, {'dataset_built': built, 'dataset_seconds': round(setup_seconds, 3)}
+
+
+def logged_in_client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': BENCH_USERNAME, 'password': BENCH_PASSWORD})
+    with client.session_transaction() as session:
+        if '_user_id' not in session:
+            raise RuntimeError('Could not log in the bench user')
+    return client
+
+
+def bench_routes(database, customers, devices, iterations):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    # add_all_network_info adds devices and renames known ones, so time
+    # everything against a copy and leave the shared dataset as built
+    handle, working_copy = tempfile.mkstemp(prefix='it_thing_bench_', suffix='.db')
+    os.close(handle)
+    if os.path.exists(database):
+        shutil.copyfile(database, working_copy)
+    app_module, setup = load_app(working_copy, customers, devices)
+    app, db = app_module.app, app_module.db
+    if setup['dataset_built']:
+        # Keep the new dataset for later runs before the benchmarks write to it
+        shutil.copyfile(working_copy, database)
+    client = logged_in_client(app)
+
+    counter = QueryCounter()
+    event.listen(Engine, 'before_cursor_execute', counter)
+
+    def cold():
+        # Drop rendered fragments so each request renders from the database
+        app.extensions['fragment_cache'].local.clear()
+
+    rng = random.Random(1)
+    customer_ids = [rng.randint(1, customers) for _ in range(iterations)]
+    index_requests = [('GET', '/', None)] * iterations
+    details_requests = [('GET', f'/customer/{customer_id}', None) for customer_id in customer_ids]
+
+    import_requests = []
+    for iteration, customer_id in enumerate(customer_ids):
+        known = [device_identity(device_id, customers)[1]
+                 for device_id in range(customer_id, devices + 1, customers)]
+        devices_json = []
+        for index in range(DEVICES_PER_IMPORT):
+            if index % 2 == 0 and index // 2 < len(known):
+                ip_address = known[index // 2]
+            else:
+                host = 10000 + iteration * DEVICES_PER_IMPORT + index
+                ip_address = f'10.{host // 250 % 256}.{host % 250}.{customer_id % 250 + 1}'
+            devices_json.append(json.dumps({'ip_address': ip_address, 'hostname': f'scan-{index}',
+                                            'mac_address': 'Unknown'}))
+        import_requests.append(('POST', f'/customer/{customer_id}/add_all_network_info',
+                                {'devices[]': devices_json, 'update_existing': '1'}))
+
+    results = {
+        'index_cold': time_requests(client, index_requests, counter, cold),
+        'index_warm': time_requests(client, index_requests, counter, warm=True),
+        'customer_details_cold': time_requests(client, details_requests, counter, cold),
+        'customer_details_warm': time_requests(client, details_requests, counter, warm=True),
+        'add_all_network_info': time_requests(client, import_requests, counter)
+    }
+    event.remove(Engine, 'before_cursor_execute', counter)
+
+    with app.app_context():
+        db.engine.dispose()
+    os.remove(working_copy)
+    for result in results.values():
+        result.update({'customers': customers, 'devices': devices})
+    return results, setup
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, threshold):
+    """Print metric changes against a baseline run and return the regressions."""
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        previous = baseline['results'].get(name)
+        if previous is None:
+            print(f'{name}: new')
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in result or not previous.get(metric):
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric]
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+            print(f'{name}.{metric}: {previous[metric]} -> {result[metric]} ({change:+.1%}){flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--only', choices=['scan', 'routes'], help='Run one group of benchmarks')
+    parser.add_argument('--ranges', nargs='+', default=SCAN_RANGES, help='Loopback ranges to scan')
+    parser.add_argument('--processes', type=int, default=1, help='Processes scan_network() may shard across')
+    parser.add_argument('--rate', type=float, help="Probes per second (default: the scanner's SCAN_RATE)")
+    parser.add_argument('--resolve-dns', action='store_true',
+                        help='Include reverse DNS lookups of the loopback addresses in scan timings')
+    parser.add_argument('--customers', type=int, default=DEFAULT_CUSTOMERS)
+    parser.add_argument('--devices', type=int, default=DEFAULT_DEVICES)
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--database', default=os.path.join(tempfile.gettempdir(), 'it_thing_bench.db'),
+                        help='SQLite file for the route dataset, reused between runs; runs use a copy')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Compare against a previous JSON results file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative change counted as a regression (default 0.10)')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, APP_DIR)
+    run = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'results': {}
+    }
+
+    if args.only in (None, 'scan'):
+        for ip_range in args.ranges:
+            name = f'scan_{ip_range.replace("/", "_")}'
+            run['results'][name] = bench_scan(ip_range, args.processes, args.rate, args.resolve_dns)
+            print(f'{name}: {json.dumps(run["results"][name])}')
+
+    if args.only in (None, 'routes'):
+        results, setup = bench_routes(os.path.abspath(args.database), args.customers, args.devices,
+                                      args.iterations)
+        run['meta'].update(setup)
+        for name, result in results.items():
+            run['results'][name] = result
+            print(f'{name}: {json.dumps(result)}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(run, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(baseline, run, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
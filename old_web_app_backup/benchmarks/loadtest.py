@@ -0,0 +1,324 @@
+"""
+Concurrent load test: simulated technicians browsing, editing and scanning.
+
+Each virtual user logs in, then repeatedly picks an action from the mix
+until the run ends. Latency is reported per route with throughput, so
+worker and pool sizes can be chosen from measurements.
+
+By default the app runs in process against a temporary copy of bench.py's
+generated dataset (test clients on threads, no sockets); edits and scans
+write to the database, and bench.py reuses the original between runs.
+--url targets a running server instead; start it on a copy of the same
+dataset so customer and device ids exist and the original stays untouched:
+
+    cp /tmp/it_thing_bench.db /tmp/it_thing_loadtest.db
+    DATABASE_URL=sqlite:////tmp/it_thing_loadtest.db flask --app app run --port 8080 --with-threads
+    python benchmarks/loadtest.py --url http://127.0.0.1:8080 --users 16 --duration 60
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench
+
+sys.path.insert(0, bench.APP_DIR)
+from scan_jobs import ACTIVE_STATES, FINISHED
+
+# Relative weights of each action in the default mix
+DEFAULT_MIX = 'browse=40,details=35,search=10,edit=12,scan=3'
+
+# Words searched for; all of them match records in the generated dataset
+SEARCH_TERMS = ['Customer', 'device', 'Contact', '10.0', 'customer1', 'Switch']
+
+# Loopback range scanned by the scan action, so no network is needed
+SCAN_RANGE = '127.77.0.0/28'
+SCAN_PORTS = '18022,18080'
+
+# Seconds between scan job status polls, and the longest a scan is followed
+SCAN_POLL_INTERVAL = 0.25
+SCAN_WAIT = 60
+
+
+class InProcessSession:
+    """One virtual user's Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, json_body=None):
+        response = self.client.open(path, method=method, data=data, json=json_body)
+        body = response.get_json(silent=True) if response.is_json else None
+        return response.status_code, body
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    """One virtual user's cookie-keeping HTTP client; redirects are not followed."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None, json_body=None):
+        headers = {}
+        payload = None
+        if json_body is not None:
+            payload = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            payload = urllib.parse.urlencode(data, doseq=True).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request = urllib.request.Request(self.base_url + path, data=payload, headers=headers, method=method)
+        try:
+            with self.opener.open(request, timeout=60) as response:
+                status, content_type, raw = response.status, response.headers.get_content_type(), response.read()
+        except urllib.error.HTTPError as e:
+            status, content_type, raw = e.code, e.headers.get_content_type(), e.read()
+        body = None
+        if content_type == 'application/json':
+            body = json.loads(raw or b'null')
+        return status, body
+
+
+class Results:
+    """Latencies and failures per route, shared by every virtual user."""
+
+    def __init__(self):
+        self.timings = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok):
+        with self._lock:
+            self.timings.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, wall):
+        routes = {}
+        with self._lock:
+            items = sorted(self.timings.items())
+            errors = dict(self.errors)
+        for route, timings in items:
+            routes[route] = {
+                'requests': len(timings),
+                'errors': errors.get(route, 0),
+                'per_second': round(len(timings) / wall, 2),
+                'p50_ms': round(bench.percentile(timings, 0.5) * 1000, 3),
+                'p95_ms': round(bench.percentile(timings, 0.95) * 1000, 3),
+                'p99_ms': round(bench.percentile(timings, 0.99) * 1000, 3),
+                'max_ms': round(max(timings) * 1000, 3)
+            }
+        # scan_job spans a submit and its polls, which are counted already
+        total = sum(stats['requests'] for route, stats in routes.items() if route != 'scan_job')
+        return {
+            'wall_seconds': round(wall, 3),
+            'requests': total,
+            'requests_per_second': round(total / wall, 2),
+            'errors': sum(errors.values()),
+            'routes': routes
+        }
+
+
+def parse_mix(spec):
+    """Parse 'action=weight,...' into {action: weight}."""
+    mix = {}
+    for term in spec.split(','):
+        action, _, weight = term.partition('=')
+        action = action.strip()
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action '{action}' (choose from {', '.join(ACTIONS)})")
+        mix[action] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError('The mix needs at least one action with a positive weight')
+    return mix
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, number, session, credentials, results, mix, customers, devices, deadline):
+        super().__init__(name=f'loadtest-user-{number}', daemon=True)
+        self.session = session
+        self.username, self.password = credentials
+        self.results = results
+        self.customers = customers
+        self.devices = devices
+        self.deadline = deadline
+        self.rng = random.Random(number)
+        self.actions = list(mix)
+        self.weights = list(mix.values())
+        self.edits = 0
+
+    def timed(self, route, method, path, data=None, json_body=None, expected=(200, 302)):
+        started = time.perf_counter()
+        try:
+            status, body = self.session.request(method, path, data, json_body)
+        except OSError:
+            status, body = None, None
+        self.results.record(route, time.perf_counter() - started, status in expected)
+        return status, body
+
+    def run(self):
+        status, _ = self.timed('login', 'POST', '/login',
+                               {'username': self.username, 'password': self.password}, expected=(302,))
+        if status != 302:
+            return
+        while time.monotonic() < self.deadline:
+            action = self.rng.choices(self.actions, self.weights)[0]
+            ACTIONS[action](self)
+
+    def browse(self):
+        self.timed('index', 'GET', '/')
+
+    def details(self):
+        customer_id = self.rng.randint(1, self.customers)
+        self.timed('customer_details', 'GET', f'/customer/{customer_id}')
+
+    def search(self):
+        query = urllib.parse.quote(self.rng.choice(SEARCH_TERMS))
+        self.timed('search', 'GET', f'/search?q={query}')
+
+    def edit(self):
+        device_id = self.rng.randint(1, self.devices)
+        customer_id, ip_address = bench.device_identity(device_id, self.customers)
+        path = f'/customer/{customer_id}/network/{device_id}/edit'
+        self.timed('edit_network_info_form', 'GET', path)
+        self.edits += 1
+        self.timed('edit_network_info', 'POST', path, {
+            'device_name': f'device-{device_id - 1}',
+            'ip_address': ip_address,
+            'system_type': 'Switch',
+            'notes': f'Load test edit {self.edits} by {self.name}'
+        }, expected=(302,))
+
+    def scan(self):
+        customer_id = self.rng.randint(1, self.customers)
+        started = time.perf_counter()
+        status, job = self.timed('scan_jobs', 'POST', '/scan-jobs', json_body={
+            'ip_range': SCAN_RANGE, 'ports': SCAN_PORTS, 'customer_id': customer_id
+        }, expected=(202, 429))
+        if status != 202:
+            return
+        path = f"/scan-jobs/{job['job_id']}"
+        while time.perf_counter() - started < SCAN_WAIT:
+            time.sleep(SCAN_POLL_INTERVAL)
+            status, job = self.timed('scan_job_status', 'GET', path, expected=(200,))
+            if status != 200 or job['status'] not in ACTIVE_STATES:
+                break
+        # Submit to finish, as a technician waiting on the result sees it
+        self.results.record('scan_job', time.perf_counter() - started,
+                            status == 200 and job['status'] == FINISHED)
+
+
+ACTIONS = {
+    'browse': VirtualUser.browse,
+    'details': VirtualUser.details,
+    'search': VirtualUser.search,
+    'edit': VirtualUser.edit,
+    'scan': VirtualUser.scan
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='Base URL of a running server (default: run the app in process)')
+    parser.add_argument('--users', type=int, default=8, help='Concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run for')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Action weights (default: {DEFAULT_MIX})')
+    parser.add_argument('--username', default=bench.BENCH_USERNAME)
+    parser.add_argument('--password', default=bench.BENCH_PASSWORD)
+    parser.add_argument('--customers', type=int, default=bench.DEFAULT_CUSTOMERS,
+                        help="Customers in the target's dataset")
+    parser.add_argument('--devices', type=int, default=bench.DEFAULT_DEVICES,
+                        help="Devices in the target's dataset")
+    parser.add_argument('--database', default=os.path.join(tempfile.gettempdir(), 'it_thing_bench.db'),
+                        help='SQLite file for the in-process dataset, shared with bench.py; runs use a copy')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    meta = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'revision': bench.git_revision(),
+        'target': args.url or 'in-process',
+        'users': args.users,
+        'duration': args.duration,
+        'mix': mix,
+        'cpus': os.cpu_count()
+    }
+    if args.url:
+        make_session = lambda: HttpSession(args.url)
+    else:
+        database = os.path.abspath(args.database)
+        handle, working_copy = tempfile.mkstemp(prefix='it_thing_loadtest_', suffix='.db')
+        os.close(handle)
+        if os.path.exists(database):
+            shutil.copyfile(database, working_copy)
+        app_module, setup = bench.load_app(working_copy, args.customers, args.devices)
+        if setup['dataset_built']:
+            # Keep the new dataset for later runs before the load writes to it
+            shutil.copyfile(working_copy, database)
+        meta.update(setup)
+        # Loopback PTR lookups only measure the local resolver, so answer them from the cache
+        from network_scanner import TargetSpec, dns_cache, int_to_ip
+        dns_cache.load({int_to_ip(address): f'bench-{address & 0xffff}' for address in TargetSpec(SCAN_RANGE)})
+        make_session = lambda: InProcessSession(app_module.app)
+
+    results = Results()
+    started = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    users = [
+        VirtualUser(number, make_session(), (args.username, args.password), results, mix,
+                    args.customers, args.devices, deadline)
+        for number in range(args.users)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    summary = results.summary(time.perf_counter() - started)
+
+    if not args.url:
+        from db_pool import pool_stats
+        with app_module.app.app_context():
+            summary['pool'] = pool_stats(app_module.db.engine.pool)
+            app_module.db.engine.dispose()
+        os.remove(working_copy)
+
+    print(f"{summary['requests']} requests in {summary['wall_seconds']}s from {args.users} users: "
+          f"{summary['requests_per_second']}/s, {summary['errors']} errors")
+    print(f"{'route':<24}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in summary['routes'].items():
+        print(f"{route:<24}{stats['requests']:>8}{stats['errors']:>8}{stats['per_second']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    if 'pool' in summary:
+        print(f"pool: {json.dumps(summary['pool'])}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'meta': meta, 'results': summary}, output, indent=2)
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Rendered fragments kept in memory per process
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 1024))
+
+# Seconds a rendered fragment may be served before it is rendered again,
+# even if nothing bumped its version
+FRAGMENT_CACHE_TTL = float(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+
+# Optional SQLite file shared by every worker process on this machine. When
+# set, fragments rendered by one worker are served by the others and version
+# bumps are seen by all of them. Without it each process keeps its own, and
+# a change made through one worker reaches the others' pages only when their
+# copies expire, up to FRAGMENT_CACHE_TTL later.
+FRAGMENT_CACHE_PATH = os.environ.get('FRAGMENT_CACHE_PATH')
+
+# Worker processes serving the app (gunicorn reads the same variable). With
+# more than one and no FRAGMENT_CACHE_PATH, the shared store defaults to a
+# file in the app's instance folder.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Scope bumped by every change, for pages that list all customers
+GLOBAL_SCOPE = 'global'
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a fixed time.
+
+    Counts hits, misses and evictions so callers can tell whether it is
+    paying for itself.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+class SharedStore:
+    """Fragments and version counters in a local SQLite file shared between processes."""
+
+    # Sets between sweeps of expired fragments
+    PURGE_EVERY = 256
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._sets = 0
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS fragments '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS versions '
+                '(scope TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+            )
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM fragments WHERE key = ? AND expires_at >= ?', (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO fragments (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, time.time() + ttl)
+            )
+            self._sets += 1
+            if self._sets % self.PURGE_EVERY == 0:
+                connection.execute('DELETE FROM fragments WHERE expires_at < ?', (time.time(),))
+
+    def versions(self, scopes):
+        placeholders = ', '.join('?' for _ in scopes)
+        rows = self._connect().execute(
+            f'SELECT scope, version FROM versions WHERE scope IN ({placeholders})', list(scopes)
+        ).fetchall()
+        found = dict(rows)
+        return [found.get(scope, 0) for scope in scopes]
+
+    def bump(self, scopes):
+        with self._connect() as connection:
+            connection.executemany(
+                'INSERT INTO versions (scope, version) VALUES (?, 1) '
+                'ON CONFLICT(scope) DO UPDATE SET version = version + 1',
+                [(scope,) for scope in scopes]
+            )
+
+
+class FragmentCache:
+    """
+    Cache of rendered HTML fragments, invalidated by version counters.
+
+    Each fragment is stored under its name, its parameters and the current
+    version of the scopes it depends on. Changing data bumps the version of
+    the scopes it touches, so the next read builds a new key and re-renders;
+    stale entries are never served and simply age out of the LRU.
+
+    Versions are only shared between processes through the SharedStore.
+    Run several workers without one and each sees its own bumps only, so
+    it can serve pages up to the TTL out of date; init_app() turns the store
+    on when WEB_CONCURRENCY says there are several workers.
+    """
+
+    def __init__(self, max_entries=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL, store_path=FRAGMENT_CACHE_PATH):
+        self.ttl = ttl
+        self.local = TTLCache(max_entries, ttl)
+        self.store = SharedStore(store_path) if store_path else None
+        self.shared_hits = 0
+        self.renders = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app, workers=WEB_CONCURRENCY):
+        """
+        Register as the app's fragment cache, under app.extensions['fragment_cache'].
+
+        Shares fragments through the instance folder when several workers
+        serve the app.
+        """
+        app.extensions['fragment_cache'] = self
+        if self.store is not None or workers <= 1:
+            return
+        os.makedirs(app.instance_path, exist_ok=True)
+        path = os.path.join(app.instance_path, 'fragment_cache.db')
+        self.store = SharedStore(path)
+        logger.info(f"{workers} workers configured, sharing rendered fragments through {path}")
+
+    def versions(self, scopes):
+        if self.store is not None:
+            return self.store.versions(scopes)
+        with self._lock:
+            return [self._versions.get(scope, 0) for scope in scopes]
+
+    def bump(self, *scopes):
+        """Invalidate every fragment that depends on any of the scopes."""
+        if self.store is not None:
+            self.store.bump(scopes)
+            return
+        with self._lock:
+            for scope in scopes:
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+
+    def get_or_render(self, name, scopes, render, params=()):
+        """
+        Return a cached fragment, or render and cache it.
+
+        Args:
+            name (str): Fragment name
+            scopes (list): Scopes whose changes invalidate the fragment
+            render (callable): Builds the fragment (a str) on a miss
+            params (tuple): Anything else the fragment's content depends on
+
+        Returns:
+            str: The fragment
+        """
+        versions = self.versions(scopes)
+        key = '|'.join([name] + [f'{scope}@{version}' for scope, version in zip(scopes, versions)]
+                       + [str(param) for param in params])
+        fragment = self.local.get(key, _MISSING)
+        if fragment is not _MISSING:
+            return fragment
+        if self.store is not None:
+            fragment = self.store.get(key)
+            if fragment is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                self.local.set(key, fragment)
+                return fragment
+
+        fragment = str(render())
+        with self._lock:
+            self.renders += 1
+        self.local.set(key, fragment)
+        if self.store is not None:
+            self.store.set(key, fragment, self.ttl)
+        return fragment
+
+    def stats(self):
+        stats = self.local.stats()
+        with self._lock:
+            stats.update({
+                'shared_store': self.store.path if self.store is not None else None,
+                'shared_hits': self.shared_hits,
+                'renders': self.renders
+            })
+        return stats
+
+
+def customer_scope(customer_id):
+    return f'customer:{customer_id}'
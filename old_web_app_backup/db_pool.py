@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+# Connections each worker process keeps open
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+
+# Extra connections a worker may open under load, closed again when returned
+MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+
+# Whole seconds a request waits for a free connection before giving up
+# (Flask-SQLAlchemy passes engine options through engine_from_config, which
+# reads this as an integer)
+POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+
+# Seconds after which a connection is replaced, to stay under server and
+# proxy idle timeouts (-1 keeps connections forever)
+POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+
+# Test each connection as it is checked out, so ones the server dropped are
+# replaced instead of failing the request
+POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+
+# Compiled SQL statements cached per engine
+STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 500))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that also records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            logger.warning(f"Timed out waiting for a database connection: {self.status()}")
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'pool_size': self.size(),
+                'max_overflow': self._max_overflow,
+                'timeout': self._timeout,
+                'checked_out': self.checkedout(),
+                'checked_in': self.checkedin(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+                'wait_seconds_avg': round(self.wait_seconds / self.checkouts, 6) if self.checkouts else None,
+                'wait_seconds_max': round(self.max_wait_seconds, 6)
+            }
+
+
+def is_memory_sqlite(database_uri):
+    return database_uri.startswith('sqlite') and (':memory:' in database_uri or
+                                                  database_uri in ('sqlite://', 'sqlite:///'))
+
+
+def engine_options(database_uri):
+    """
+    Build SQLALCHEMY_ENGINE_OPTIONS from the DB_* environment settings.
+
+    Args:
+        database_uri (str): The app's SQLALCHEMY_DATABASE_URI
+
+    Returns:
+        dict: Engine options for Flask-SQLAlchemy
+    """
+    options = {
+        'query_cache_size': STATEMENT_CACHE_SIZE,
+        'pool_pre_ping': POOL_PRE_PING
+    }
+    if is_memory_sqlite(database_uri):
+        # Flask-SQLAlchemy gives in-memory SQLite a single shared connection
+        return options
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': POOL_SIZE,
+        'max_overflow': MAX_OVERFLOW,
+        'pool_timeout': POOL_TIMEOUT,
+        'pool_recycle': POOL_RECYCLE
+    })
+    return options
+
+
+def pool_stats(pool):
+    """Return an engine pool's stats, or its status line if it is not instrumented."""
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {'status': pool.status()}
@@ -0,0 +1,261 @@
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the per-request query count buckets
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Upper bounds, in seconds, of the scan duration buckets
+SCAN_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    """A total that only goes up."""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that is set to its current reading."""
+
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with their sum and count."""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = key + (('le', _format_value(float(bound))),)
+            samples.append(f'{self.name}_bucket{_format_labels(labels)} {cumulative}')
+        samples.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+        samples.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return samples
+
+
+class Registry:
+    """
+    In-process metrics, rendered in the Prometheus text format.
+
+    Every worker process keeps its own registry, so a scrape shows the
+    worker that answered it; scrape each worker or sum them downstream.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Time to handle a request, by Flask endpoint.',
+    ('endpoint', 'method', 'status'))
+request_queries = registry.histogram(
+    'http_request_db_queries', 'SQL statements run while handling a request.',
+    ('endpoint',), QUERY_COUNT_BUCKETS)
+request_query_seconds = registry.histogram(
+    'http_request_db_seconds', 'Time spent in SQL statements while handling a request.', ('endpoint',))
+queries_total = registry.counter('db_queries_total', 'SQL statements run, in or out of requests.')
+query_seconds_total = registry.counter('db_query_seconds_total', 'Time spent in SQL statements.')
+template_seconds = registry.histogram(
+    'template_render_seconds', 'Time to render a Jinja template.', ('template',))
+startup_seconds = registry.gauge(
+    'app_startup_seconds', 'Time this process took to import app.py and build the app.', ('phase',))
+
+scans_total = registry.counter('scan_runs_total', 'Network scans run, by outcome.', ('outcome',))
+scan_seconds = registry.histogram('scan_duration_seconds', 'Wall time of network scans.', buckets=SCAN_BUCKETS)
+scan_hosts_total = registry.counter('scan_hosts_total', 'Addresses scanned.')
+scan_probes_total = registry.counter('scan_probes_total', 'TCP connect probes sent.')
+scan_timeouts_total = registry.counter('scan_timeouts_total', 'Probes that timed out.')
+scan_open_ports_total = registry.counter('scan_open_ports_total', 'Open ports found.')
+scan_hosts_rate = registry.gauge('scan_hosts_per_second', 'Hosts per second in the last finished scan.')
+scan_probes_rate = registry.gauge('scan_probes_per_second', 'Probes per second in the last finished scan.')
+
+_engine_events_installed = False
+
+
+def record_scan(stats, devices=None, failed=False):
+    """Record a finished scan from its ScanStats and the devices it found."""
+    if failed:
+        scans_total.inc(outcome='error')
+        return
+    elapsed = stats.elapsed
+    scans_total.inc(outcome='cancelled' if stats.cancelled else 'completed')
+    scan_seconds.observe(elapsed)
+    scan_hosts_total.inc(stats.hosts_scanned)
+    scan_probes_total.inc(stats.probes)
+    scan_timeouts_total.inc(stats.timeouts)
+    scan_open_ports_total.inc(sum(len(device.get('ports') or ()) for device in devices or ()))
+    if elapsed:
+        scan_hosts_rate.set(stats.hosts_scanned / elapsed)
+        scan_probes_rate.set(stats.probes / elapsed)
+
+
+def init_app(app):
+    """
+    Record request latency, SQL and template render times for a Flask app.
+
+    SQL statements are timed through engine events, so they are counted
+    for every engine in the process; those run outside a request only
+    reach the db_* totals.
+    """
+    from flask import before_render_template, g, has_app_context, has_request_context, request, template_rendered
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    global _engine_events_installed
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_seconds = 0.0
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('metrics_started')
+        if started is not None:
+            endpoint = request.endpoint or 'unmatched'
+            request_seconds.observe(time.perf_counter() - started, endpoint=endpoint,
+                                    method=request.method, status=str(response.status_code))
+            request_queries.observe(g.metrics_queries, endpoint=endpoint)
+            request_query_seconds.observe(g.metrics_query_seconds, endpoint=endpoint)
+        return response
+
+    if not _engine_events_installed:
+        _engine_events_installed = True
+
+        # The start time rides on the statement's execution context, so a
+        # statement that raises leaves nothing behind on the connection
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context.metrics_query_started = time.perf_counter()
+
+        @event.listens_for(Engine, 'after_cursor_execute')
+        def record_query(conn, cursor, statement, parameters, context, executemany):
+            started = getattr(context, 'metrics_query_started', None)
+            if started is None:
+                return
+            elapsed = time.perf_counter() - started
+            queries_total.inc()
+            query_seconds_total.inc(elapsed)
+            if has_request_context() and 'metrics_started' in g:
+                g.metrics_queries += 1
+                g.metrics_query_seconds += elapsed
+
+    def start_template_timer(sender, template, context, **extra):
+        if has_app_context():
+            g.setdefault('metrics_template_started', []).append(time.perf_counter())
+
+    def record_template(sender, template, context, **extra):
+        starts = g.get('metrics_template_started') if has_app_context() else None
+        if starts:
+            template_seconds.observe(time.perf_counter() - starts.pop(), template=template.name or 'string')
+
+    before_render_template.connect(start_template_timer, app, weak=False)
+    template_rendered.connect(record_template, app, weak=False)
+
+    timings = app.config.get('STARTUP_TIMINGS') or {}
+    for phase, seconds in timings.items():
+        startup_seconds.set(seconds, phase=phase.replace('_seconds', ''))
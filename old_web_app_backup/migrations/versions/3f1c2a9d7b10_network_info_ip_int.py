@@ -0,0 +1,78 @@
+"""Add NetworkInfo.ip_int and a (customer_id, ip_int) index
+
+Revision ID: 3f1c2a9d7b10
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+The tables themselves are still created by db.create_all() at startup, so
+this revision only adds what create_all() cannot add to an existing table.
+On a database create_all() built after this change the column and index
+already exist and only the backfill runs.
+
+"""
+import ipaddress
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = 'ix_network_info_customer_id_ip_int'
+
+# Rows updated per statement while backfilling
+BATCH_SIZE = 1000
+
+
+def _ip_to_int(ip_address):
+    # Matches app.ip_address_to_int, so backfilled and new rows agree
+    try:
+        return int(ipaddress.IPv4Address(ip_address.strip()))
+    except (AttributeError, ValueError):
+        return None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('network_info')}
+    indexes = {index['name'] for index in inspector.get_indexes('network_info')}
+
+    if 'ip_int' not in columns:
+        with op.batch_alter_table('network_info') as batch_op:
+            batch_op.add_column(sa.Column('ip_int', sa.BigInteger(), nullable=True))
+    if INDEX_NAME not in indexes:
+        op.create_index(INDEX_NAME, 'network_info', ['customer_id', 'ip_int'])
+
+    network_info = sa.table(
+        'network_info',
+        sa.column('id', sa.Integer),
+        sa.column('ip_address', sa.String),
+        sa.column('ip_int', sa.BigInteger)
+    )
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(network_info.c.id, network_info.c.ip_address)
+        .where(network_info.c.ip_int.is_(None))
+    ).fetchall()
+    updates = [
+        {'row_id': row_id, 'ip_int': _ip_to_int(ip_address)}
+        for row_id, ip_address in rows
+    ]
+    updates = [update for update in updates if update['ip_int'] is not None]
+    statement = (
+        network_info.update()
+        .where(network_info.c.id == sa.bindparam('row_id'))
+        .values(ip_int=sa.bindparam('ip_int'))
+    )
+    for start in range(0, len(updates), BATCH_SIZE):
+        connection.execute(statement, updates[start:start + BATCH_SIZE])
+
+
+def downgrade():
+    op.drop_index(INDEX_NAME, table_name='network_info')
+    with op.batch_alter_table('network_info') as batch_op:
+        batch_op.drop_column('ip_int')
@@ -0,0 +1,99 @@
+"""Make (customer_id, ip_address) unique on NetworkInfo
+
+Revision ID: 8a4e6b2c5d31
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-18 10:00:00.000000
+
+Earlier imports could record the same address twice for a customer. The
+oldest row for each address is kept and the later copies are deleted
+before the unique index is created. Fields the kept row leaves empty are
+filled from the later copies and differing notes are joined, so nothing
+typed into a copy is lost. If the copies hold different values for any
+other field (a login or password, say) the upgrade stops and lists them,
+to be resolved by hand before running it again.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6b2c5d31'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = 'uq_network_info_customer_id_ip_address'
+
+# Columns that identify a row or are maintained by the app, never merged
+UNMERGED_COLUMNS = {'id', 'customer_id', 'ip_address', 'ip_int', 'created_at', 'updated_at'}
+
+# Values scans and forms fill in when they know nothing better
+PLACEHOLDERS = {'', 'Unknown', 'Unknown Device', 'Undefined'}
+
+
+def _is_blank(value):
+    return value is None or (isinstance(value, str) and value.strip() in PLACEHOLDERS)
+
+
+def _merge_duplicates(connection):
+    """Fold later copies of each address into the oldest row, then delete them."""
+    network_info = sa.Table('network_info', sa.MetaData(), autoload_with=connection)
+    columns = [column.name for column in network_info.columns if column.name not in UNMERGED_COLUMNS]
+    duplicates = connection.execute(
+        sa.select(network_info.c.customer_id, network_info.c.ip_address)
+        .group_by(network_info.c.customer_id, network_info.c.ip_address)
+        .having(sa.func.count() > 1)
+    ).fetchall()
+
+    merges = []
+    conflicts = []
+    for customer_id, ip_address in duplicates:
+        rows = connection.execute(
+            sa.select(network_info)
+            .where(network_info.c.customer_id == customer_id)
+            .where(network_info.c.ip_address == ip_address)
+            .order_by(network_info.c.id)
+        ).mappings().fetchall()
+        kept = rows[0]
+        values = {}
+        for row in rows[1:]:
+            for column in columns:
+                current = values.get(column, kept[column])
+                value = row[column]
+                if _is_blank(value) or value == current:
+                    continue
+                if _is_blank(current):
+                    values[column] = value
+                elif column == 'notes':
+                    # A third copy may repeat a note already taken from the second
+                    if value not in current.split('\n\n'):
+                        values[column] = f'{current}\n\n{value}'
+                else:
+                    conflicts.append(f"customer {customer_id}, {ip_address}: {column} differs "
+                                     f"between rows {kept['id']} and {row['id']}")
+        merges.append((kept['id'], values, [row['id'] for row in rows[1:]]))
+
+    if conflicts:
+        raise RuntimeError(
+            'Duplicate network_info rows hold conflicting values. Edit or delete one row of '
+            'each pair, then run the upgrade again:\n' + '\n'.join(conflicts)
+        )
+
+    for kept_id, values, duplicate_ids in merges:
+        if values:
+            connection.execute(network_info.update().where(network_info.c.id == kept_id).values(**values))
+        connection.execute(network_info.delete().where(network_info.c.id.in_(duplicate_ids)))
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if INDEX_NAME in {index['name'] for index in inspector.get_indexes('network_info')}:
+        return
+
+    _merge_duplicates(op.get_bind())
+    op.create_index(INDEX_NAME, 'network_info', ['customer_id', 'ip_address'], unique=True)
+
+
+def downgrade():
+    op.drop_index(INDEX_NAME, table_name='network_info')
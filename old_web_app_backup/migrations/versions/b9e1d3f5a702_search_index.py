@@ -0,0 +1,39 @@
+"""Build the search index
+
+Revision ID: b9e1d3f5a702
+Revises: f2b8d4a6c913
+Create Date: 2026-10-18 13:00:00.000000
+
+On SQLite this creates the FTS5 search table and its triggers and fills it
+from existing rows; on PostgreSQL it creates the pg_trgm extension and GIN
+indexes, concurrently so writes are not blocked while they build. Searches
+use LIKE queries until this has run. search.py holds the definitions.
+
+"""
+import os
+import sys
+
+from alembic import op
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from search import drop_search_index, install_search_index
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9e1d3f5a702'
+down_revision = 'f2b8d4a6c913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        with op.get_context().autocommit_block():
+            install_search_index(op.get_bind())
+    else:
+        install_search_index(op.get_bind())
+
+
+def downgrade():
+    drop_search_index(op.get_bind())
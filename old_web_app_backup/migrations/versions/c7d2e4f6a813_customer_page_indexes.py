@@ -0,0 +1,38 @@
+"""Index customers by (name, id) and child tables by customer_id
+
+Revision ID: c7d2e4f6a813
+Revises: 8a4e6b2c5d31
+Create Date: 2026-10-18 11:00:00.000000
+
+(name, id) backs keyset pagination of the customer index; the customer_id
+indexes keep its per-customer credential and CCTV user counts from
+scanning the whole table.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d2e4f6a813'
+down_revision = '8a4e6b2c5d31'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_customer_name_id', 'customer', ['name', 'id']),
+    ('ix_credential_customer_id', 'credential', ['customer_id']),
+    ('ix_cctv_user_customer_id', 'cctv_user', ['customer_id']),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for name, table, columns in INDEXES:
+        if name not in {index['name'] for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
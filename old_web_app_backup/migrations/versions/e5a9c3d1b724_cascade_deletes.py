@@ -0,0 +1,88 @@
+"""Delete customer and scan run children with ON DELETE CASCADE
+
+Revision ID: e5a9c3d1b724
+Revises: c7d2e4f6a813
+Create Date: 2026-10-18 12:00:00.000000
+
+SQLite cannot alter a foreign key in place, so there each child table is
+rebuilt by batch mode. Foreign keys are switched off while that happens:
+dropping the old scan_run would otherwise fail, or cascade into
+scan_result once that has been rebuilt. They are checked again afterwards.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9c3d1b724'
+down_revision = 'c7d2e4f6a813'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table)
+FOREIGN_KEYS = [
+    ('network_info', 'customer_id', 'customer'),
+    ('credential', 'customer_id', 'customer'),
+    ('cctv_user', 'customer_id', 'customer'),
+    ('scan_run', 'customer_id', 'customer'),
+    ('scan_result', 'run_id', 'scan_run'),
+]
+
+# Names SQLite's unnamed foreign keys are given when batch mode reflects them
+NAMING_CONVENTION = {
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'
+}
+
+
+def _foreign_key(table, column):
+    inspector = sa.inspect(op.get_bind())
+    for foreign_key in inspector.get_foreign_keys(table):
+        if foreign_key['constrained_columns'] == [column]:
+            return foreign_key
+    return None
+
+
+def _set_ondelete(table, column, referred, ondelete):
+    existing = _foreign_key(table, column)
+    if existing is None or (existing.get('options') or {}).get('ondelete') == ondelete:
+        return
+    name = f'fk_{table}_{column}_{referred}'
+    with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint(existing['name'] or name, type_='foreignkey')
+        batch_op.create_foreign_key(name, referred, [column], ['id'], ondelete=ondelete)
+
+
+def _sqlite_foreign_keys(bind, enabled):
+    # The pragma is silently ignored inside a transaction, so finish the
+    # open one first; SQLite DDL here is not transactional anyway
+    dbapi_connection = bind.connection.dbapi_connection
+    if dbapi_connection.in_transaction:
+        dbapi_connection.commit()
+    bind.exec_driver_sql(f"PRAGMA foreign_keys={'ON' if enabled else 'OFF'}")
+
+
+def _set_all(ondelete):
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        for table, column, referred in FOREIGN_KEYS:
+            _set_ondelete(table, column, referred, ondelete)
+        return
+
+    _sqlite_foreign_keys(bind, False)
+    try:
+        for table, column, referred in FOREIGN_KEYS:
+            _set_ondelete(table, column, referred, ondelete)
+    finally:
+        _sqlite_foreign_keys(bind, True)
+    violations = bind.exec_driver_sql('PRAGMA foreign_key_check').fetchall()
+    if violations:
+        raise RuntimeError(f'Foreign key violations after rebuilding tables: {violations[:10]}')
+
+
+def upgrade():
+    _set_all('CASCADE')
+
+
+def downgrade():
+    _set_all(None)
@@ -0,0 +1,66 @@
+"""Add updated_at to synced tables and a tombstone table for deletes
+
+Revision ID: f2b8d4a6c913
+Revises: e5a9c3d1b724
+Create Date: 2026-10-18 13:00:00.000000
+
+Existing rows get their created_at where the table has one, otherwise the
+time of the upgrade, so the first sync after it sends everything once.
+Columns are added and dropped in place rather than by rebuilding tables:
+on SQLite, rebuilding customer would fire its ON DELETE CASCADE.
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b8d4a6c913'
+down_revision = 'e5a9c3d1b724'
+branch_labels = None
+depends_on = None
+
+TABLES = ['customer', 'network_info', 'credential', 'cctv_user']
+
+
+def upgrade():
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+    now = datetime.utcnow()
+
+    for table in TABLES:
+        columns = {column['name'] for column in inspector.get_columns(table)}
+        indexes = {index['name'] for index in inspector.get_indexes(table)}
+        if 'updated_at' not in columns:
+            op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+        if f'ix_{table}_updated_at' not in indexes:
+            op.create_index(f'ix_{table}_updated_at', table, ['updated_at'])
+
+        rows = sa.table(table, sa.column('updated_at', sa.DateTime))
+        value = sa.bindparam('now', now, type_=sa.DateTime)
+        if 'created_at' in columns:
+            rows.append_column(sa.column('created_at', sa.DateTime))
+            value = sa.func.coalesce(rows.c.created_at, value)
+        connection.execute(rows.update().where(rows.c.updated_at.is_(None)).values(updated_at=value))
+
+    if not inspector.has_table('tombstone'):
+        op.create_table(
+            'tombstone',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('kind', sa.String(length=20), nullable=False),
+            sa.Column('record_id', sa.Integer(), nullable=False),
+            sa.Column('customer_id', sa.Integer(), nullable=False),
+            sa.Column('deleted_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_tombstone_deleted_at', 'tombstone', ['deleted_at'])
+
+
+def downgrade():
+    op.drop_index('ix_tombstone_deleted_at', table_name='tombstone')
+    op.drop_table('tombstone')
+    for table in reversed(TABLES):
+        op.drop_index(f'ix_{table}_updated_at', table_name=table)
+        op.drop_column(table, 'updated_at')
@@ -0,0 +1,1088 @@
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ports probed when the caller does not specify any
+DEFAULT_PORTS = [21, 22, 23, 25, 53, 80, 110, 139, 143, 443, 445, 3306, 3389, 5432, 8080]
+
+# Maximum number of connection attempts in flight across the whole scan
+DEFAULT_CONCURRENCY = int(os.environ.get('SCAN_CONCURRENCY', 512))
+
+# Number of hosts scanned at once by the worker pool
+DEFAULT_WORKERS = int(os.environ.get('SCAN_WORKERS', 128))
+
+# Processes a large scan is split across (1 keeps everything in this process)
+DEFAULT_PROCESSES = int(os.environ.get('SCAN_PROCESSES', 1))
+
+# Ranges smaller than this are never split across processes
+SHARD_MIN_HOSTS = int(os.environ.get('SCAN_SHARD_MIN_HOSTS', 4096))
+
+# Seconds to wait for a TCP connect to a host we have no timing data for yet;
+# once hosts answer, timeouts follow the measured round-trip times instead
+CONNECT_TIMEOUT = float(os.environ.get('SCAN_INITIAL_TIMEOUT', 0.5))
+
+# Bounds for the adaptive per-host connect timeouts. RTT samples include
+# event loop scheduling delay, and a busy loop can handle an answer well
+# after it arrived, so the floor leaves room for that.
+MIN_TIMEOUT = float(os.environ.get('SCAN_MIN_TIMEOUT', 0.25))
+MAX_TIMEOUT = float(os.environ.get('SCAN_MAX_TIMEOUT', 3.0))
+
+# Upper limit on connection attempts per second (0 disables pacing)
+DEFAULT_RATE = float(os.environ.get('SCAN_RATE', 2000))
+
+# Whether scans find live hosts before running the full port sweep
+DISCOVERY_ENABLED = os.environ.get('SCAN_DISCOVERY', '1') != '0'
+
+# Ports used to check whether a host is up before the full sweep
+DISCOVERY_PORTS = [80, 443]
+
+# Kernel neighbour (ARP) table consulted during discovery
+NEIGHBOUR_TABLE = '/proc/net/arp'
+
+# Reverse DNS cache lifetimes (seconds) for resolved names and failed lookups
+DNS_POSITIVE_TTL = int(os.environ.get('SCAN_DNS_TTL', 3600))
+DNS_NEGATIVE_TTL = int(os.environ.get('SCAN_DNS_NEGATIVE_TTL', 300))
+
+# Seconds a scan waits for a reverse lookup before reporting the host without
+# a name; the answer is still cached when it arrives
+DNS_TIMEOUT = float(os.environ.get('SCAN_DNS_TIMEOUT', 2.0))
+
+# Number of blocking resolver calls allowed at once
+DNS_RESOLVER_THREADS = int(os.environ.get('SCAN_DNS_THREADS', 16))
+
+
+class ScanStats:
+    """Counters collected while a scan runs, used to tune the worker pool."""
+
+    def __init__(self):
+        self.workers = 0
+        self.concurrency = 0
+        self.hosts_total = 0
+        self.hosts_scanned = 0
+        self.hosts_alive = 0
+        self.devices_found = 0
+        self.probes = 0
+        self.timeouts = 0
+        self.rate_backoffs = 0
+        self.final_rate = 0.0
+        self.dns_lookups = 0
+        self.dns_cache_hits = 0
+        self.idle_time = 0.0
+        self.cancelled = False
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def hosts_per_second(self):
+        elapsed = self.elapsed
+        return self.hosts_scanned / elapsed if elapsed else 0.0
+
+    @property
+    def idle_ratio(self):
+        """Fraction of worker time spent waiting for work rather than scanning."""
+        busy_capacity = self.elapsed * self.workers
+        return self.idle_time / busy_capacity if busy_capacity else 0.0
+
+    def absorb(self, shard):
+        """Add the counters from a shard's to_dict() into this scan's totals."""
+        for field in ('workers', 'concurrency', 'hosts_scanned', 'hosts_alive', 'probes',
+                      'timeouts', 'rate_backoffs', 'final_rate', 'dns_lookups',
+                      'dns_cache_hits', 'idle_time'):
+            setattr(self, field, getattr(self, field) + shard[field])
+        self.cancelled = self.cancelled or shard['cancelled']
+
+    def to_dict(self):
+        return {
+            'workers': self.workers,
+            'concurrency': self.concurrency,
+            'hosts_total': self.hosts_total,
+            'hosts_scanned': self.hosts_scanned,
+            'hosts_alive': self.hosts_alive,
+            'devices_found': self.devices_found,
+            'probes': self.probes,
+            'timeouts': self.timeouts,
+            'rate_backoffs': self.rate_backoffs,
+            'final_rate': round(self.final_rate, 1),
+            'dns_lookups': self.dns_lookups,
+            'dns_cache_hits': self.dns_cache_hits,
+            'elapsed': round(self.elapsed, 3),
+            'hosts_per_second': round(self.hosts_per_second, 1),
+            'idle_time': round(self.idle_time, 3),
+            'idle_ratio': round(self.idle_ratio, 3),
+            'cancelled': self.cancelled
+        }
+
+
+class RttEstimator:
+    """
+    Per-host connect timeouts derived from observed round-trip times.
+
+    Follows the TCP retransmission timer (RFC 6298): each host keeps a smoothed
+    RTT and its variance, and its timeout is SRTT + 4 * RTTVAR. Hosts without
+    samples yet fall back to a padded network-wide estimate, or to the initial
+    timeout before anything has answered.
+    """
+
+    def __init__(self, initial_timeout=CONNECT_TIMEOUT, min_timeout=MIN_TIMEOUT,
+                 max_timeout=MAX_TIMEOUT):
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._hosts = {}
+        self._network = None
+
+    @staticmethod
+    def _update(estimate, sample):
+        if estimate is None:
+            return sample, sample / 2
+        srtt, rttvar = estimate
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+        srtt = 0.875 * srtt + 0.125 * sample
+        return srtt, rttvar
+
+    def observe(self, ip, rtt):
+        """Record the round-trip time of a connect that got an answer."""
+        self._hosts[ip] = self._update(self._hosts.get(ip), rtt)
+        self._network = self._update(self._network, rtt)
+
+    def knows(self, ip):
+        return ip in self._hosts
+
+    def timeout(self, ip):
+        estimate = self._hosts.get(ip)
+        if estimate is not None:
+            srtt, rttvar = estimate
+            value = srtt + 4 * rttvar
+        elif self._network is not None:
+            srtt, rttvar = self._network
+            # Unknown hosts may sit on a slower path than the ones seen so far
+            value = 2 * (srtt + 4 * rttvar)
+        else:
+            return self.initial_timeout
+        return min(self.max_timeout, max(self.min_timeout, value))
+
+
+class ProbeRateLimiter:
+    """
+    Token bucket pacing connection attempts, with AIMD backoff.
+
+    Only probes to hosts known to be up are fed back through record(): silence
+    from those means packets are being dropped, so the rate is halved when too
+    many of them time out and recovers gradually once they stop.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, window=50, backoff_threshold=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = max(1.0, rate / 20)
+        self.window = window
+        self.backoff_threshold = backoff_threshold
+        self.backoffs = 0
+        self._burst = max(1.0, rate / 20)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._sent = 0
+        self._timeouts = 0
+
+    async def acquire(self):
+        if not self.max_rate:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def record(self, timed_out):
+        if not self.max_rate:
+            return
+        self._sent += 1
+        self._timeouts += 1 if timed_out else 0
+        if self._sent < self.window:
+            return
+        if self._timeouts / self._sent > self.backoff_threshold:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.backoffs += 1
+            logger.info(f"Probe timeouts spiking, backing off to {self.rate:.0f} probes/s")
+        else:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+        self._sent = 0
+        self._timeouts = 0
+
+
+class ReverseDnsCache:
+    """
+    Thread-safe TTL cache of reverse DNS lookups shared by every scan.
+
+    Failed lookups are cached too (for a shorter time) so repeat scans of the
+    same network do not wait on the resolver for addresses without PTR records.
+    """
+
+    def __init__(self, positive_ttl=DNS_POSITIVE_TTL, negative_ttl=DNS_NEGATIVE_TTL,
+                 max_entries=65536, resolver_threads=DNS_RESOLVER_THREADS):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.resolver_threads = resolver_threads
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self, ip_str):
+        """Return (found, hostname) for a cached, unexpired entry."""
+        with self._lock:
+            entry = self._entries.get(ip_str)
+            if entry is None:
+                return False, None
+            hostname, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[ip_str]
+                return False, None
+            self._entries.move_to_end(ip_str)
+            return True, hostname
+
+    def set(self, ip_str, hostname):
+        ttl = self.positive_ttl if hostname else self.negative_ttl
+        with self._lock:
+            self._entries[ip_str] = (hostname, time.monotonic() + ttl)
+            self._entries.move_to_end(ip_str)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self, targets=None):
+        """Return unexpired entries as {ip: hostname}, optionally limited to a TargetSpec."""
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._entries.items())
+        return {
+            ip_str: hostname for ip_str, (hostname, expires_at) in entries
+            if expires_at >= now and (targets is None or ip_to_int(ip_str) in targets)
+        }
+
+    def load(self, entries):
+        """Add {ip: hostname} entries, e.g. ones learned by another process."""
+        for ip_str, hostname in entries.items():
+            self.set(ip_str, hostname)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.resolver_threads, thread_name_prefix='scan-dns'
+                )
+            return self._executor
+
+    async def resolve(self, ip_str, stats=None):
+        """Resolve an address, using the cache and the bounded resolver pool."""
+        found, hostname = self.get(ip_str)
+        if found:
+            if stats is not None:
+                stats.dns_cache_hits += 1
+            return hostname
+
+        if stats is not None:
+            stats.dns_lookups += 1
+        lookup = self._get_executor().submit(_reverse_lookup, ip_str)
+        lookup.add_done_callback(lambda done: self.set(ip_str, done.result()))
+        try:
+            # Shielded so giving up on the wait leaves the lookup running
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(lookup)), DNS_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+
+
+def ip_to_int(ip):
+    """Convert a dotted-quad IPv4 address to an integer."""
+    return struct.unpack('!L', socket.inet_aton(ip.strip()))[0]
+
+
+def int_to_ip(value):
+    """Convert an integer to a dotted-quad IPv4 address."""
+    return socket.inet_ntoa(struct.pack('!L', value))
+
+
+def detect_ip_range():
+    """
+    Detect the range of the network attached to the default gateway.
+
+    Returns:
+        str: The local network in CIDR notation, or a common default
+    """
+    try:
+        import netifaces
+        gateways = netifaces.gateways()
+        default_gateway = gateways['default'][netifaces.AF_INET]
+        interface = default_gateway[1]
+
+        addrs = netifaces.ifaddresses(interface)
+        ip_info = addrs[netifaces.AF_INET][0]
+        ip = ip_info['addr']
+        subnet = ip_info['netmask']
+
+        # Convert to CIDR notation
+        cidr = sum(bin(int(x)).count('1') for x in subnet.split('.'))
+        return f"{ip}/{cidr}"
+    except Exception as e:
+        logger.warning(f"Error detecting IP range: {e}")
+        # Fallback to a common range
+        return "192.168.1.0/24"
+
+
+def parse_ip_range(ip_range, hosts_only=True):
+    """
+    Parse an IP range into the first and last host addresses to scan.
+
+    Args:
+        ip_range (str): CIDR (192.168.1.0/24), range (192.168.1.1-192.168.1.254)
+            or single IP
+        hosts_only (bool): Leave out the network and broadcast addresses of
+            a CIDR block
+
+    Returns:
+        tuple: (first, last) host addresses as integers, inclusive
+    """
+    try:
+        if '/' in ip_range:
+            ip_parts = ip_range.split('/')
+            if len(ip_parts) != 2:
+                raise ValueError("Invalid IP range format. Use CIDR notation (e.g., 192.168.1.0/24)")
+
+            ip_int = ip_to_int(ip_parts[0])
+            bits = int(ip_parts[1])
+            if not 0 <= bits <= 32:
+                raise ValueError(f"Invalid prefix length: /{bits}")
+
+            # Calculate network and broadcast addresses
+            mask = ~((1 << (32 - bits)) - 1) & 0xFFFFFFFF
+            network_int = ip_int & mask
+            broadcast_int = network_int | ~mask & 0xFFFFFFFF
+
+            # /31 and /32 have no network or broadcast address to skip
+            if bits >= 31 or not hosts_only:
+                return network_int, broadcast_int
+            return network_int + 1, broadcast_int - 1
+
+        if '-' in ip_range:
+            start_ip, end_ip = ip_range.split('-')
+            first, last = ip_to_int(start_ip), ip_to_int(end_ip)
+            if first > last:
+                raise ValueError(f"Range start {start_ip.strip()} is after range end {end_ip.strip()}")
+            return first, last
+
+        ip_int = ip_to_int(ip_range)
+        return ip_int, ip_int
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Invalid IP range '{ip_range}': {e}")
+
+
+def _merge_ranges(ranges):
+    """Sort (first, last) ranges and merge any that overlap or touch."""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _subtract_ranges(ranges, excluded):
+    """Remove the merged ranges in excluded from the merged ranges in ranges."""
+    remaining = []
+    for first, last in ranges:
+        for skip_first, skip_last in excluded:
+            if skip_last < first or skip_first > last:
+                continue
+            if skip_first > first:
+                remaining.append((first, skip_first - 1))
+            first = skip_last + 1
+            if first > last:
+                break
+        if first <= last:
+            remaining.append((first, last))
+    return remaining
+
+
+def _split_terms(spec):
+    return [term.strip() for term in (spec or '').split(',') if term.strip()]
+
+
+class TargetSpec:
+    """
+    The addresses a scan covers.
+
+    Built from comma-separated CIDRs, start-end ranges and single IPs, minus an
+    exclusion list in the same format (excluded CIDRs drop the whole block).
+    Addresses are held as merged, sorted integer ranges and produced lazily,
+    so a spec costs the same memory whether it covers ten hosts or a /8, and
+    overlapping terms never yield an address twice.
+    """
+
+    def __init__(self, spec, exclude=None):
+        terms = _split_terms(spec)
+        if not terms:
+            raise ValueError("No IP range given")
+        included = _merge_ranges(parse_ip_range(term) for term in terms)
+        excluded = _merge_ranges(parse_ip_range(term, hosts_only=False) for term in _split_terms(exclude))
+        self.ranges = _subtract_ranges(included, excluded)
+        if not self.ranges:
+            raise ValueError(f"Every address in '{spec}' is excluded")
+        self._starts = [first for first, _ in self.ranges]
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        targets = cls.__new__(cls)
+        targets.ranges = _merge_ranges(ranges)
+        targets._starts = [first for first, _ in targets.ranges]
+        return targets
+
+    @property
+    def first(self):
+        return self.ranges[0][0]
+
+    @property
+    def last(self):
+        return self.ranges[-1][1]
+
+    def __iter__(self):
+        for first, last in self.ranges:
+            yield from range(first, last + 1)
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __contains__(self, ip):
+        index = bisect.bisect_right(self._starts, ip) - 1
+        return index >= 0 and ip <= self.ranges[index][1]
+
+    def __str__(self):
+        return ','.join(
+            int_to_ip(first) if first == last else f"{int_to_ip(first)}-{int_to_ip(last)}"
+            for first, last in self.ranges
+        )
+
+    def split(self, count):
+        """Split into at most count specs of nearly equal size, in address order."""
+        size = len(self)
+        count = max(1, min(count, size))
+        shards = []
+        ranges = list(self.ranges)
+        for index in range(count):
+            wanted = size // count + (1 if index < size % count else 0)
+            shard = []
+            while wanted:
+                first, last = ranges[0]
+                take = min(wanted, last - first + 1)
+                shard.append((first, first + take - 1))
+                wanted -= take
+                if first + take > last:
+                    ranges.pop(0)
+                else:
+                    ranges[0] = (first + take, last)
+            shards.append(TargetSpec.from_ranges(shard))
+        return shards
+
+
+# Probe outcomes: OPEN accepted the connection, CLOSED answered with a reset
+# (so the host is up), and None means no answer before the timeout
+OPEN = 'open'
+CLOSED = 'closed'
+
+
+class _Prober:
+    """Connection state shared by one scan: concurrency limit, timeouts and pacing."""
+
+    def __init__(self, concurrency, rtt, limiter, stats):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rtt = rtt
+        self.limiter = limiter
+        self.stats = stats
+
+    async def connect(self, ip, port):
+        """Attempt a non-blocking TCP connect and classify the outcome."""
+        loop = asyncio.get_running_loop()
+        known = self.rtt.knows(ip)
+        timed_out = False
+        async with self.semaphore:
+            await self.limiter.acquire()
+            timeout = self.rtt.timeout(ip)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, (int_to_ip(ip), port)), timeout)
+                state = OPEN
+            except ConnectionRefusedError:
+                state = CLOSED
+            except asyncio.TimeoutError:
+                state = None
+                timed_out = True
+            except OSError:
+                state = None
+            finally:
+                sock.close()
+
+        self.stats.probes += 1
+        if state is not None:
+            self.rtt.observe(ip, time.monotonic() - started)
+        if timed_out:
+            self.stats.timeouts += 1
+        if known:
+            self.limiter.record(timed_out)
+        return state
+
+
+def _reverse_lookup(ip_str):
+    try:
+        return socket.gethostbyaddr(ip_str)[0]
+    except (OSError, UnicodeError):
+        return None
+
+
+def read_neighbour_table(path=NEIGHBOUR_TABLE):
+    """
+    Read the kernel ARP cache.
+
+    Returns:
+        dict: MAC addresses of reachable neighbours keyed by integer IP;
+            empty when the table is unavailable (e.g. not running on Linux)
+    """
+    neighbours = {}
+    try:
+        with open(path) as table:
+            next(table, None)  # Header row
+            for line in table:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                ip_str, flags, mac = fields[0], fields[2], fields[3]
+                # 0x0 marks an incomplete entry that never got a reply
+                if int(flags, 16) == 0 or mac == '00:00:00:00:00:00':
+                    continue
+                neighbours[ip_to_int(ip_str)] = mac
+    except (OSError, ValueError) as e:
+        logger.debug(f"Neighbour table unavailable: {e}")
+    return neighbours
+
+
+async def _tcp_ping(ip, ports, prober):
+    """
+    Check whether a host is up by connecting to a few likely ports at once.
+
+    Returns as soon as any port answers, open or reset, and cancels the rest.
+
+    Returns:
+        tuple: (alive, open ports seen while pinging)
+    """
+    async def ping(port):
+        return port, await prober.connect(ip, port)
+
+    probes = [asyncio.create_task(ping(port)) for port in ports]
+    try:
+        for finished in asyncio.as_completed(probes):
+            port, state = await finished
+            if state is not None:
+                return True, [port] if state == OPEN else []
+        return False, []
+    finally:
+        for probe in probes:
+            probe.cancel()
+
+
+async def _run_pool(hosts, workers, handler, stats, cancel_event=None):
+    """Feed hosts through a fixed pool of workers that each call handler(ip)."""
+    work_queue = asyncio.Queue(maxsize=workers * 2)
+
+    async def produce():
+        for ip in hosts:
+            if cancel_event is not None and cancel_event.is_set():
+                stats.cancelled = True
+                break
+            await work_queue.put(ip)
+        for _ in range(workers):
+            await work_queue.put(None)
+
+    async def work():
+        # Each worker picks up the next host as soon as it finishes the last
+        # one, so a slow host only ever occupies its own slot
+        while True:
+            waiting_since = time.monotonic()
+            ip = await work_queue.get()
+            stats.idle_time += time.monotonic() - waiting_since
+            if ip is None:
+                return time.monotonic()
+            # Hosts already queued when the scan is cancelled are dropped too
+            if cancel_event is not None and cancel_event.is_set():
+                stats.cancelled = True
+                continue
+            await handler(ip)
+
+    producer = asyncio.create_task(produce())
+    finished_at = await asyncio.gather(*(work() for _ in range(workers)))
+    await producer
+
+    # Workers that ran out of hosts early sat idle until the pool drained
+    pool_end = time.monotonic()
+    stats.idle_time += sum(pool_end - worker_end for worker_end in finished_at)
+
+
+async def _scan_range(targets, ports, workers, concurrency, timeout, rate, stats,
+                      on_device=None, on_progress=None, cancel_event=None, discovery=True,
+                      priority=None):
+    # One prober shared by every (host, port) pair keeps the number of open
+    # sockets and the packet rate bounded regardless of range size or pool width
+    limiter = ProbeRateLimiter(rate)
+    # Unpaced probes can swamp the loop, so their timeouts never shrink
+    # below the initial one
+    min_timeout = MIN_TIMEOUT if rate else max(MIN_TIMEOUT, timeout)
+    prober = _Prober(concurrency, RttEstimator(timeout, min_timeout), limiter, stats)
+    devices = []
+    lookups = set()
+    seen_open = {}
+    macs = {}
+
+    # Hosts from an earlier scan go first in each pass, with the ports that
+    # were open last time probed first; they still have to answer to be found
+    priority = {ip: known for ip, known in (priority or {}).items() if ip in targets}
+
+    def priority_first(hosts):
+        return itertools.chain(sorted(priority), (ip for ip in hosts if ip not in priority))
+
+    # Hosts already counted as finished before their sweep
+    counted = set()
+
+    def host_done():
+        stats.hosts_scanned += 1
+        if on_progress:
+            on_progress(stats.hosts_scanned, stats.hosts_total)
+
+    async def resolve(device):
+        device['hostname'] = await dns_cache.resolve(device['ip'], stats)
+        devices.append(device)
+        if on_device:
+            on_device(device)
+
+    async def sweep(ip):
+        ip_str = int_to_ip(ip)
+        known_open = seen_open.get(ip, [])
+        preferred = priority.get(ip, [])
+        remaining = sorted(
+            (port for port in ports if port not in known_open),
+            key=lambda port: port not in preferred
+        )
+        results = await asyncio.gather(*(prober.connect(ip, port) for port in remaining))
+        open_ports = set(known_open) | {port for port, state in zip(remaining, results) if state == OPEN}
+
+        # Without discovery a host only counts as found if something is
+        # listening, or for a host an earlier scan saw, if anything answered
+        answered = open_ports or any(state is not None for state in results)
+        if discovery or open_ports or (ip in priority and answered):
+            device = {
+                'ip': ip_str,
+                'hostname': None,
+                'mac_address': macs.get(ip),
+                'ports': [port for port in ports if port in open_ports]
+            }
+            # Resolve in the background so the worker can move on
+            lookup = asyncio.create_task(resolve(device))
+            lookups.add(lookup)
+            lookup.add_done_callback(lookups.discard)
+        if ip not in counted:
+            host_done()
+
+    if discovery:
+        # Discovery pass: anything in the ARP cache is up; everything else
+        # gets a quick TCP ping and only live hosts move on to the full sweep
+        macs.update(read_neighbour_table())
+        alive = set(ip for ip in macs if ip in targets)
+
+        async def discover(ip):
+            if ip in alive:
+                return
+            is_alive, open_ports = await _tcp_ping(ip, DISCOVERY_PORTS, prober)
+            if is_alive:
+                alive.add(ip)
+                seen_open[ip] = open_ports
+            else:
+                host_done()
+
+        await _run_pool(priority_first(targets), workers, discover, stats, cancel_event)
+
+        # Pings also make the kernel ARP for each address, so firewalled
+        # hosts that dropped every SYN still show up in the table now
+        macs.update(read_neighbour_table())
+        for ip in macs:
+            if ip in targets and ip not in alive:
+                alive.add(ip)
+                counted.add(ip)
+        stats.hosts_alive = len(alive)
+        sweep_targets = sorted(alive, key=lambda ip: (ip not in priority, ip))
+    else:
+        sweep_targets = priority_first(targets)
+
+    await _run_pool(sweep_targets, workers, sweep, stats, cancel_event)
+    if lookups:
+        await asyncio.gather(*lookups)
+    stats.rate_backoffs = limiter.backoffs
+    stats.final_rate = limiter.rate
+    return devices
+
+
+def _normalize_mac(mac):
+    """Return a lower-case MAC address, or None for placeholders like 'Unknown'."""
+    if not mac:
+        return None
+    mac = mac.strip().lower().replace('-', ':')
+    parts = mac.split(':')
+    if len(parts) != 6 or not all(len(part) == 2 for part in parts):
+        return None
+    try:
+        int(mac.replace(':', ''), 16)
+    except ValueError:
+        return None
+    return mac
+
+
+def diff_scans(previous, current, scope=None):
+    """
+    Compare two sets of devices by IP address.
+
+    Devices whose 'ports' is None (e.g. records without scan data) are only
+    compared by MAC address.
+
+    Args:
+        previous (list): Earlier devices, as returned by scan_network()
+        current (list): Newly scanned devices
+        scope (TargetSpec): Optional addresses covered by the current scan;
+            earlier devices outside it are ignored rather than reported gone
+
+    Returns:
+        dict: 'new', 'gone' and 'changed' lists, each ordered by IP address
+    """
+    def in_scope(device):
+        if scope is None:
+            return True
+        try:
+            return ip_to_int(device['ip']) in scope
+        except (OSError, AttributeError):
+            # Hand-entered records may not hold a valid address
+            return False
+
+    before = {device['ip']: device for device in previous if in_scope(device)}
+    after = {device['ip']: device for device in current}
+
+    changed = []
+    for ip in before.keys() & after.keys():
+        old, new = before[ip], after[ip]
+        change = {}
+        if old.get('ports') is not None and new.get('ports') is not None:
+            opened = sorted(set(new['ports']) - set(old['ports']))
+            closed = sorted(set(old['ports']) - set(new['ports']))
+            if opened:
+                change['ports_opened'] = opened
+            if closed:
+                change['ports_closed'] = closed
+        old_mac = _normalize_mac(old.get('mac_address'))
+        new_mac = _normalize_mac(new.get('mac_address'))
+        if old_mac and new_mac and old_mac != new_mac:
+            change['mac_address'] = {'before': old_mac, 'after': new_mac}
+        if change:
+            change['ip'] = ip
+            changed.append(change)
+
+    def by_ip(device):
+        return ip_to_int(device['ip'])
+
+    return {
+        'new': sorted((after[ip] for ip in after.keys() - before.keys()), key=by_ip),
+        'gone': sorted((before[ip] for ip in before.keys() - after.keys()), key=by_ip),
+        'changed': sorted(changed, key=by_ip)
+    }
+
+
+# Shared by every scan in this process so rescans reuse earlier lookups
+dns_cache = ReverseDnsCache()
+
+
+def _scan_shard(index, targets, ports, options, dns_seed, events, cancel):
+    """Scan one shard in a worker process, relaying events back to the parent."""
+    dns_cache.load(dns_seed)
+    stats = ScanStats()
+    last_progress = [0.0]
+
+    def on_device(device):
+        events.put(('device', index, device))
+
+    def on_progress(done, total):
+        # Each put is a round trip to the manager, so keep progress coarse
+        now = time.monotonic()
+        if done < total and now - last_progress[0] < 0.25:
+            return
+        last_progress[0] = now
+        events.put(('progress', index, done))
+
+    devices = scan_network(
+        targets, ports, stats=stats, processes=1,
+        on_device=on_device if events is not None else None,
+        on_progress=on_progress if events is not None else None,
+        cancel_event=cancel, **options
+    )
+    learned = {ip_str: hostname for ip_str, hostname in dns_cache.snapshot().items() if ip_str not in dns_seed}
+    return devices, stats.to_dict(), learned
+
+
+def _scan_sharded(targets, ports, processes, stats, on_device, on_progress, cancel_event, options):
+    shards = targets.split(processes)
+
+    # Divide the global budgets so all shards together stay within them
+    options = dict(options)
+    options['workers'] = max(1, options['workers'] // len(shards))
+    options['concurrency'] = max(1, options['concurrency'] // len(shards))
+    if options['rate']:
+        options['rate'] = options['rate'] / len(shards)
+
+    # Spawned rather than forked: forking a threaded web worker is unsafe
+    context = multiprocessing.get_context('spawn')
+    relay = bool(on_device or on_progress or cancel_event)
+    manager = context.Manager() if relay else None
+    try:
+        events = manager.Queue() if relay else None
+        cancel = manager.Event() if relay else None
+        progress = [0] * len(shards)
+
+        def handle(event):
+            kind, index, payload = event
+            if kind == 'device' and on_device:
+                on_device(payload)
+            elif kind == 'progress' and on_progress:
+                progress[index] = payload
+                on_progress(sum(progress), stats.hosts_total)
+
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=context) as pool:
+            futures = [
+                pool.submit(_scan_shard, index, shard, ports, options,
+                            dns_cache.snapshot(shard), events, cancel)
+                for index, shard in enumerate(shards)
+            ]
+            pending = set(futures)
+            while relay and pending:
+                if cancel_event is not None and cancel_event.is_set():
+                    cancel.set()
+                try:
+                    handle(events.get(timeout=0.2))
+                except queue.Empty:
+                    pass
+                pending = {future for future in pending if not future.done()}
+            # Deliver whatever the last shards sent before finishing
+            while relay:
+                try:
+                    handle(events.get_nowait())
+                except queue.Empty:
+                    break
+            results = [future.result() for future in futures]
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+    devices = []
+    for shard_devices, shard_stats, learned in results:
+        devices.extend(shard_devices)
+        stats.absorb(shard_stats)
+        dns_cache.load(learned)
+    return devices
+
+
+def scan_network(ip_range=None, ports=None, concurrency=None, timeout=CONNECT_TIMEOUT,
+                 workers=None, stats=None, on_device=None, on_progress=None, cancel_event=None,
+                 discovery=None, rate=None, priority=None, processes=None, exclude=None):
+    """
+    Scan the network for devices.
+
+    Args:
+        ip_range (str): Comma-separated CIDRs (e.g., '192.168.1.0/24'),
+            start-end ranges and single IPs, or a TargetSpec
+        ports (list): List of ports to scan
+        concurrency (int): Maximum number of connection attempts in flight
+        timeout (float): Seconds to wait for connects until hosts have been
+            timed; later timeouts adapt to measured round-trip times
+        workers (int): Number of hosts scanned at once
+        stats (ScanStats): Optional object filled in with scan statistics
+        on_device (callable): Called with each device as soon as it is found
+        on_progress (callable): Called with (hosts done, hosts total) after each host
+        cancel_event (threading.Event): Stops the scan early once set
+        discovery (bool): Find live hosts first and sweep only those
+            (defaults to SCAN_DISCOVERY)
+        rate (float): Maximum connection attempts per second (0 for no limit)
+        priority (dict): Known hosts from an earlier scan, mapping IP to the
+            ports found open then; these go first in each pass and those
+            ports are probed first, but like any host they are only
+            reported if they answer
+        processes (int): Split ranges of at least SHARD_MIN_HOSTS addresses
+            across this many processes, each with its own event loop and a
+            share of the concurrency, worker and rate budgets (defaults to
+            SCAN_PROCESSES)
+        exclude (str): Comma-separated CIDRs, ranges and IPs to skip
+
+    Returns:
+        list: List of devices found, ordered by IP address
+    """
+    # Default to common ports if none specified
+    if not ports:
+        ports = DEFAULT_PORTS
+    concurrency = concurrency or DEFAULT_CONCURRENCY
+    rate = DEFAULT_RATE if rate is None else rate
+    if discovery is None:
+        discovery = DISCOVERY_ENABLED
+    stats = stats if stats is not None else ScanStats()
+
+    # If no IP range specified, try to detect it
+    if not ip_range:
+        ip_range = detect_ip_range()
+
+    targets = ip_range if isinstance(ip_range, TargetSpec) else TargetSpec(ip_range, exclude)
+    host_count = len(targets)
+    # Never start more workers than there are hosts to scan
+    workers = max(1, min(workers or DEFAULT_WORKERS, host_count))
+    processes = processes or DEFAULT_PROCESSES
+    sharded = processes > 1 and host_count >= SHARD_MIN_HOSTS
+
+    stats.hosts_total = host_count
+    stats.started_at = time.monotonic()
+    try:
+        if sharded:
+            logger.info(f"Scanning {host_count} addresses in {targets} across {processes} processes")
+            devices = _scan_sharded(targets, list(ports), processes, stats, on_device, on_progress,
+                                    cancel_event, {
+                                        'workers': workers,
+                                        'concurrency': concurrency,
+                                        'timeout': timeout,
+                                        'rate': rate,
+                                        'discovery': discovery,
+                                        'priority': priority
+                                    })
+        else:
+            logger.info(f"Scanning {host_count} addresses in {targets} with {workers} workers")
+            stats.workers = workers
+            stats.concurrency = concurrency
+            devices = asyncio.run(_scan_range(
+                targets, list(ports), workers, concurrency, timeout, rate, stats,
+                on_device=on_device, on_progress=on_progress, cancel_event=cancel_event,
+                discovery=discovery,
+                priority={ip_to_int(ip): list(known) for ip, known in (priority or {}).items()}
+            ))
+    except Exception as e:
+        logger.error(f"Error scanning network: {e}")
+        metrics.record_scan(stats, failed=True)
+        # Return a more helpful error message
+        raise ValueError(f"Error scanning network: {str(e)}")
+    finally:
+        stats.finished_at = time.monotonic()
+
+    stats.devices_found = len(devices)
+    metrics.record_scan(stats, devices)
+    logger.info(f"Scan finished: {stats.to_dict()}")
+    devices.sort(key=lambda device: ip_to_int(device['ip']))
+    return devices
+
+
+def iter_scan(ip_range=None, ports=None, max_buffered=256, progress_interval=0.25, **kwargs):
+    """
+    Run a scan in the background and yield its events as they happen.
+
+    Devices are never dropped; progress events are coalesced when the consumer
+    falls behind, so at most ``max_buffered`` events are held in memory. Closing
+    the generator (e.g. when an HTTP client disconnects) cancels the scan.
+
+    Args:
+        ip_range (str): IP range accepted by scan_network()
+        ports (list): List of ports to scan
+        max_buffered (int): Maximum number of undelivered events
+        progress_interval (float): Minimum seconds between progress events
+        **kwargs: Passed through to scan_network()
+
+    Yields:
+        dict: Events with an 'event' key of 'device', 'progress', 'done' or 'error'
+    """
+    events = queue.Queue(maxsize=max_buffered)
+    cancel_event = threading.Event()
+    stats = ScanStats()
+    last_progress = [0.0]
+
+    def deliver(event):
+        # Blocking here slows the scan down to the consumer's pace
+        while not cancel_event.is_set():
+            try:
+                events.put(event, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def on_device(device):
+        deliver({'event': 'device', 'device': device})
+
+    def on_progress(done, total):
+        now = time.monotonic()
+        if done < total and now - last_progress[0] < progress_interval:
+            return
+        last_progress[0] = now
+        try:
+            events.put_nowait({'event': 'progress', 'done': done, 'total': total})
+        except queue.Full:
+            pass
+
+    def run():
+        try:
+            scan_network(ip_range, ports, stats=stats, on_device=on_device,
+                         on_progress=on_progress, cancel_event=cancel_event, **kwargs)
+            deliver({'event': 'done', 'stats': stats.to_dict()})
+        except Exception as e:
+            deliver({'event': 'error', 'error': str(e)})
+
+    worker = threading.Thread(target=run, name='scan-stream', daemon=True)
+    worker.start()
+    try:
+        while True:
+            event = events.get()
+            yield event
+            if event['event'] in ('done', 'error'):
+                break
+    finally:
+        cancel_event.set()
+
+
+def format_ndjson(event):
+    """Serialize a scan event as a newline-delimited JSON record."""
+    return json.dumps(event) + '\n'
+
+
+def format_sse(event):
+    """Serialize a scan event as a Server-Sent Events message."""
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
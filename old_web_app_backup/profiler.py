@@ -0,0 +1,192 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Profile every request's SQL. Each statement is recorded, so leave this
+# off in production unless chasing a regression.
+SQL_PROFILER = os.environ.get('SQL_PROFILER') == '1'
+
+# Times one statement shape may run in a request before it is flagged as
+# an N+1 candidate
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_PROFILER_N_PLUS_ONE', 3))
+
+# Profiled requests kept for the debug endpoint
+PROFILE_HISTORY = int(os.environ.get('SQL_PROFILER_HISTORY', 100))
+
+# Response header carrying each request's summary
+SUMMARY_HEADER = 'X-SQL-Profile'
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|\$\d+')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize_statement(statement):
+    """
+    Reduce a SQL statement to its shape, so repeats with other values match.
+
+    Literals and driver placeholders become ?, IN lists of any length
+    become (?...) and whitespace is collapsed.
+    """
+    shape = _STRING.sub('?', statement)
+    shape = _PLACEHOLDER.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    shape = _IN_LIST.sub('(?...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+
+class RequestProfile:
+    """The statements one request ran, in order, with their timings."""
+
+    def __init__(self, method, path, endpoint):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.started_at = time.time()
+        self.statements = []
+
+    def add(self, statement, seconds, executemany=False):
+        self.statements.append((statement, seconds, executemany))
+
+    def summary(self, threshold=N_PLUS_ONE_THRESHOLD):
+        shapes = {}
+        for statement, seconds, _ in self.statements:
+            shape = normalize_statement(statement)
+            entry = shapes.setdefault(shape, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        n_plus_one = sorted(
+            (
+                {'statement': shape, 'count': count, 'time_ms': round(seconds * 1000, 3)}
+                for shape, (count, seconds) in shapes.items() if count >= threshold
+            ),
+            key=lambda candidate: -candidate['count']
+        )
+        return {
+            'method': self.method,
+            'path': self.path,
+            'endpoint': self.endpoint,
+            'queries': len(self.statements),
+            'distinct': len(shapes),
+            'time_ms': round(sum(seconds for _, seconds, _ in self.statements) * 1000, 3),
+            'n_plus_one': n_plus_one
+        }
+
+    def to_dict(self, threshold=N_PLUS_ONE_THRESHOLD):
+        data = self.summary(threshold)
+        data['started_at'] = self.started_at
+        data['statements'] = [
+            {'statement': statement, 'time_ms': round(seconds * 1000, 3), 'executemany': executemany}
+            for statement, seconds, executemany in self.statements
+        ]
+        return data
+
+
+class SQLProfiler:
+    """
+    Opt-in per-request SQL profiler.
+
+    Records every statement a request runs through SQLAlchemy, adds a short
+    summary header to the response and keeps the last PROFILE_HISTORY
+    profiles. Statement shapes repeated N_PLUS_ONE_THRESHOLD times or more
+    in one request are flagged as N+1 candidates and logged. Whether it is
+    on, and the profiles kept, belong to each app it is initialised with.
+    """
+
+    def __init__(self, history=PROFILE_HISTORY, threshold=N_PLUS_ONE_THRESHOLD):
+        self.history = history
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._engine_events_installed = False
+
+    def init_app(self, app, enabled=SQL_PROFILER):
+        from flask import g, request
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        state = app.extensions['sql_profiler'] = {
+            'enabled': enabled,
+            'profiles': deque(maxlen=self.history)
+        }
+        if not enabled:
+            return
+
+        @app.before_request
+        def start_profile():
+            # The path only: query strings can carry secrets such as the debug token
+            g.sql_profile = RequestProfile(request.method, request.path, request.endpoint)
+
+        @app.after_request
+        def finish_profile(response):
+            profile = g.pop('sql_profile', None)
+            if profile is None:
+                return response
+            summary = profile.summary(self.threshold)
+            response.headers[SUMMARY_HEADER] = (
+                f"queries={summary['queries']}; distinct={summary['distinct']}; "
+                f"time_ms={summary['time_ms']}; n_plus_one={len(summary['n_plus_one'])}"
+            )
+            if summary['n_plus_one']:
+                worst = summary['n_plus_one'][0]
+                logger.warning(f"Possible N+1 in {profile.method} {profile.path}: ran "
+                               f"{worst['count']} times: {worst['statement'][:200]}")
+            with self._lock:
+                state['profiles'].append(profile)
+            return response
+
+        if self._engine_events_installed:
+            return
+        self._engine_events_installed = True
+
+        # Timed on the execution context, which a failed statement discards
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def start_statement(conn, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context.profiler_started = time.perf_counter()
+
+        @event.listens_for(Engine, 'after_cursor_execute')
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            started = getattr(context, 'profiler_started', None)
+            if started is None:
+                return
+            elapsed = time.perf_counter() - started
+            profile = _current_profile()
+            if profile is not None:
+                profile.add(statement, elapsed, executemany)
+
+    def is_enabled(self, app=None):
+        """Return whether profiling is on for an app, by default the current one."""
+        return _state(app)['enabled']
+
+    def recent(self, n_plus_one_only=False, app=None):
+        """Return an app's kept profiles, newest first."""
+        with self._lock:
+            profiles = list(_state(app)['profiles'])
+        profiles.reverse()
+        data = [profile.to_dict(self.threshold) for profile in profiles]
+        if n_plus_one_only:
+            data = [profile for profile in data if profile['n_plus_one']]
+        return data
+
+
+def _state(app=None):
+    from flask import current_app
+    app = app or current_app
+    return app.extensions.get('sql_profiler') or {'enabled': False, 'profiles': ()}
+
+
+def _current_profile():
+    from flask import g, has_request_context
+    if not has_request_context():
+        return None
+    return g.get('sql_profile')
+
+
+profiler = SQLProfiler()
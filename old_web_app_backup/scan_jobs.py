@@ -0,0 +1,203 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Scans allowed to be queued or running at once, across all customers
+MAX_JOBS = int(os.environ.get('SCAN_MAX_JOBS', 4))
+
+# Scans allowed to be queued or running at once for a single customer
+MAX_JOBS_PER_CUSTOMER = int(os.environ.get('SCAN_MAX_JOBS_PER_CUSTOMER', 1))
+
+# Seconds a finished job stays available for status and result requests
+JOB_RETENTION = int(os.environ.get('SCAN_JOB_RETENTION', 3600))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+
+class ScanJobLimitError(Exception):
+    """Raised when a new scan would exceed the concurrent job limits."""
+
+
+class ScanJob:
+    """A scan submitted to run in the background."""
+
+    def __init__(self, ip_range, ports, customer_id=None, scan_kwargs=None, on_finish=None):
+        # The scanner is imported on first use so importing this module stays cheap
+        from network_scanner import ScanStats, TargetSpec
+
+        self.id = uuid.uuid4().hex
+        self.ip_range = ip_range
+        self.ports = ports
+        self.customer_id = customer_id
+        self.scan_kwargs = scan_kwargs or {}
+        self.on_finish = on_finish
+        self.status = QUEUED
+        self.done = 0
+        self.total = len(TargetSpec(ip_range, self.scan_kwargs.get('exclude')))
+        self.devices = []
+        self.stats = ScanStats()
+        self.error = None
+        self.result = {}
+        self.cancel_event = threading.Event()
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self._finished_monotonic = None
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATES
+
+    def to_dict(self, include_devices=False):
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'customer_id': self.customer_id,
+            'ip_range': self.ip_range,
+            'exclude': self.scan_kwargs.get('exclude'),
+            'progress': {
+                'done': self.done,
+                'total': self.total
+            },
+            'devices_found': len(self.devices),
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+        data.update(self.result)
+        if include_devices:
+            from network_scanner import ip_to_int
+            data['devices'] = sorted(self.devices, key=lambda device: ip_to_int(device['ip']))
+            data['stats'] = self.stats.to_dict()
+        return data
+
+
+class ScanJobManager:
+    """
+    Runs scans on a local thread pool, away from the request workers.
+
+    Limits how many scans may be queued or running overall and per customer,
+    so scan load cannot crowd out the rest of the app.
+
+    Jobs live in this process's memory only. Run the app with a single
+    worker process (threads are fine): with several, a status, results or
+    cancel request that reaches another worker gets a 404, and the job
+    limits apply to each worker separately. Finished scans for a customer
+    are kept in ScanRun either way.
+    """
+
+    def __init__(self, max_jobs=MAX_JOBS, max_jobs_per_customer=MAX_JOBS_PER_CUSTOMER,
+                 retention=JOB_RETENTION):
+        self.max_jobs = max_jobs
+        self.max_jobs_per_customer = max_jobs_per_customer
+        self.retention = retention
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='scan-job')
+
+    def submit(self, ip_range, ports, customer_id=None, on_finish=None, **scan_kwargs):
+        """
+        Queue a scan and return its job straight away.
+
+        Args:
+            ip_range (str): IP range accepted by scan_network()
+            ports (list): List of ports to scan
+            customer_id (int): Customer the scan belongs to, if any
+            on_finish (callable): Called with the job after a successful scan;
+                whatever dict it returns is merged into the job's status
+            **scan_kwargs: Passed through to scan_network()
+
+        Returns:
+            ScanJob: The queued job
+
+        Raises:
+            ScanJobLimitError: If the overall or per-customer limit is reached
+        """
+        job = ScanJob(ip_range, ports, customer_id, scan_kwargs, on_finish)
+        with self._lock:
+            self._prune()
+            active = [existing for existing in self._jobs.values() if existing.active]
+            if len(active) >= self.max_jobs:
+                raise ScanJobLimitError(f'Too many scans running (limit {self.max_jobs})')
+            if customer_id is not None:
+                customer_active = [existing for existing in active if existing.customer_id == customer_id]
+                if len(customer_active) >= self.max_jobs_per_customer:
+                    raise ScanJobLimitError(
+                        f'This customer already has {len(customer_active)} scan(s) running '
+                        f'(limit {self.max_jobs_per_customer})'
+                    )
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        logger.info(f"Queued scan job {job.id} for {ip_range}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Ask a job to stop; returns the job, or None if it does not exist."""
+        job = self.get(job_id)
+        if job is not None and job.active:
+            # Set here as well as by the scanner, which only notices the event
+            # while it still has hosts to hand out
+            job.stats.cancelled = True
+            job.cancel_event.set()
+        return job
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.retention
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job._finished_monotonic is not None and job._finished_monotonic < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _run(self, job):
+        from network_scanner import scan_network
+
+        if job.cancel_event.is_set():
+            self._finish(job, CANCELLED)
+            return
+
+        def on_progress(done, total):
+            job.done = done
+            job.total = total
+
+        job.status = RUNNING
+        job.started_at = datetime.utcnow()
+        try:
+            scan_network(
+                job.ip_range, job.ports, stats=job.stats,
+                on_device=job.devices.append, on_progress=on_progress,
+                cancel_event=job.cancel_event, **job.scan_kwargs
+            )
+            if job.stats.cancelled:
+                self._finish(job, CANCELLED)
+                return
+            if job.on_finish:
+                job.result = job.on_finish(job) or {}
+            self._finish(job, FINISHED)
+        except Exception as e:
+            logger.error(f"Scan job {job.id} failed: {e}")
+            job.error = str(e)
+            self._finish(job, FAILED)
+
+    def _finish(self, job, status):
+        job.finished_at = datetime.utcnow()
+        job._finished_monotonic = time.monotonic()
+        job.status = status
@@ -0,0 +1,313 @@
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+# Hits returned per page when the caller does not ask for a size
+DEFAULT_PER_PAGE = 20
+
+# Largest page of hits a caller can ask for
+MAX_PER_PAGE = 100
+
+# SQLite full-text table holding a copy of every searchable field
+FTS_TABLE = 'search_index'
+
+# Searchable records. Only these columns are ever copied into an index;
+# passwords, logins and credential usernames are deliberately left out.
+# {row} is replaced with 'new.'/'old.' in triggers and left empty in queries
+# and PostgreSQL index definitions. code keeps FTS rowids unique across
+# tables; columns are the ones whose updates are re-indexed.
+SOURCES = [
+    {
+        'kind': 'customer',
+        'code': 0,
+        'table': 'customer',
+        'columns': ['name', 'contact_person', 'phone', 'email'],
+        'customer_id': "{row}id",
+        'title': "{row}name",
+        'body': "coalesce({row}contact_person, '') || ' ' || coalesce({row}phone, '') || ' ' || "
+                "coalesce({row}email, '')"
+    },
+    {
+        'kind': 'device',
+        'code': 1,
+        'table': 'network_info',
+        'columns': ['customer_id', 'device_name', 'ip_address', 'mac_address', 'notes'],
+        'customer_id': "{row}customer_id",
+        'title': "{row}device_name",
+        'body': "{row}ip_address || ' ' || coalesce({row}mac_address, '') || ' ' || coalesce({row}notes, '')"
+    },
+    {
+        'kind': 'credential',
+        'code': 2,
+        'table': 'credential',
+        'columns': ['customer_id', 'service_name'],
+        'customer_id': "{row}customer_id",
+        'title': "coalesce({row}service_name, '')",
+        'body': "''"
+    }
+]
+
+def _field(source, name, row=''):
+    return source[name].format(row=row)
+
+
+def _haystack(source):
+    return f"{_field(source, 'title')} || ' ' || {_field(source, 'body')}"
+
+
+def _trigger_names():
+    return [f"{FTS_TABLE}_{source['table']}_{event}"
+            for source in SOURCES for event in ('insert', 'update', 'delete')]
+
+
+def _trigram_index_names():
+    return [f"ix_{source['table']}_search_trgm" for source in SOURCES]
+
+
+def install_search_index(connection):
+    """
+    Create the search index, or repair one whose triggers are missing.
+
+    Schema changes like this belong in migrations, not requests: call it
+    from an alembic revision (and again from any later revision that
+    rebuilds one of the SOURCES tables on SQLite, which drops its triggers).
+
+    On SQLite this is an FTS5 table with the trigram tokenizer, filled from
+    the existing rows and kept current by triggers, so bulk inserts and
+    deletes are indexed too. On PostgreSQL it is pg_trgm GIN indexes over
+    the searchable columns, built concurrently so writes carry on; the
+    connection must be in autocommit mode. Other databases need nothing.
+
+    Args:
+        connection: SQLAlchemy connection to the app's database
+    """
+    if connection.dialect.name == 'sqlite':
+        _install_fts5(connection)
+    elif connection.dialect.name == 'postgresql':
+        _install_trigram(connection)
+
+
+def drop_search_index(connection):
+    """Remove everything install_search_index() creates."""
+    if connection.dialect.name == 'sqlite':
+        for name in _trigger_names():
+            connection.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        connection.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+    elif connection.dialect.name == 'postgresql':
+        for name in _trigram_index_names():
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+def search_backend(connection):
+    """
+    Return the backend searches can use on this database right now.
+
+    Only reads the catalog, in one query, so it is cheap enough to run per
+    search and always reflects what migrations have installed.
+
+    Returns:
+        str: 'fts5', 'trigram' or 'like'
+    """
+    try:
+        if connection.dialect.name == 'sqlite':
+            names = [FTS_TABLE] + _trigger_names()
+            found = connection.execute(text(
+                f"SELECT count(*) FROM sqlite_master WHERE name IN ({_placeholders(names)})"
+            ), _bind(names)).scalar()
+            backend = 'fts5'
+        elif connection.dialect.name == 'postgresql':
+            names = _trigram_index_names()
+            found = connection.execute(text(
+                f"SELECT count(*) FROM pg_indexes WHERE indexname IN ({_placeholders(names)})"
+            ), _bind(names)).scalar()
+            backend = 'trigram'
+        else:
+            return 'like'
+    except DBAPIError as e:
+        logger.warning(f"Could not check the search index, falling back to LIKE queries: {e}")
+        return 'like'
+    return backend if found == len(names) else 'like'
+
+
+def _placeholders(names):
+    return ', '.join(f':name{index}' for index in range(len(names)))
+
+
+def _bind(names):
+    return {f'name{index}': name for index, name in enumerate(names)}
+
+
+def _install_fts5(connection):
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': FTS_TABLE}
+    ).first()
+    names = _trigger_names()
+    triggers = connection.execute(text(
+        f"SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN ({_placeholders(names)})"
+    ), _bind(names)).scalar()
+    if exists and triggers == len(names):
+        return
+
+    if exists:
+        # Rebuilding a table (as SQLite migrations do) drops its triggers,
+        # and any writes since then were missed, so re-index from scratch
+        logger.info("Search index triggers missing, rebuilding the SQLite search index...")
+        connection.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    else:
+        logger.info("Building the SQLite search index...")
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "kind UNINDEXED, record_id UNINDEXED, customer_id UNINDEXED, title, body, "
+            "tokenize = 'trigram')"
+        ))
+    for source in SOURCES:
+        _create_triggers(connection, source)
+        connection.execute(text(
+            f"INSERT INTO {FTS_TABLE} (rowid, kind, record_id, customer_id, title, body) "
+            f"SELECT id * {len(SOURCES)} + {source['code']}, '{source['kind']}', id, "
+            f"{_field(source, 'customer_id')}, {_field(source, 'title')}, {_field(source, 'body')} "
+            f"FROM {source['table']}"
+        ))
+
+
+def _create_triggers(connection, source):
+    table = source['table']
+
+    def insert_row(prefix):
+        return (
+            f"INSERT INTO {FTS_TABLE} (rowid, kind, record_id, customer_id, title, body) VALUES ("
+            f"{prefix}.id * {len(SOURCES)} + {source['code']}, '{source['kind']}', {prefix}.id, "
+            f"{_field(source, 'customer_id', prefix + '.')}, "
+            f"{_field(source, 'title', prefix + '.')}, "
+            f"{_field(source, 'body', prefix + '.')});"
+        )
+
+    def delete_row(prefix):
+        return f"DELETE FROM {FTS_TABLE} WHERE rowid = {prefix}.id * {len(SOURCES)} + {source['code']};"
+
+    columns = ', '.join(source['columns'])
+    connection.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_{table}_insert AFTER INSERT ON {table} "
+        f"BEGIN {insert_row('new')} END"
+    ))
+    connection.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_{table}_update AFTER UPDATE OF {columns} ON {table} "
+        f"BEGIN {delete_row('old')} {insert_row('new')} END"
+    ))
+    connection.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_{table}_delete AFTER DELETE ON {table} "
+        f"BEGIN {delete_row('old')} END"
+    ))
+
+
+def _install_trigram(connection):
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for source, name in zip(SOURCES, _trigram_index_names()):
+        connection.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {source['table']} "
+            f"USING gin (({_haystack(source)}) gin_trgm_ops)"
+        ))
+
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def search_records(session, query, page=1, per_page=DEFAULT_PER_PAGE):
+    """
+    Search customers, devices and credential service names.
+
+    Every whitespace-separated term must appear somewhere in a record's
+    searchable text (case-insensitive substring match, so partial IPs and
+    MAC addresses work). Hits are ranked best first.
+
+    Args:
+        session: SQLAlchemy session to query with
+        query (str): Search terms
+        page (int): 1-based page number
+        per_page (int): Hits per page, capped at MAX_PER_PAGE
+
+    Returns:
+        dict: 'results' (list of hit dicts with kind, record_id, customer_id,
+            customer_name, title and detail), 'has_next' and 'backend'
+    """
+    terms = [term for term in (query or '').split() if term]
+    per_page = max(1, min(per_page, MAX_PER_PAGE))
+    page = max(1, page)
+    backend = search_backend(session.connection())
+    if not terms:
+        return {'results': [], 'has_next': False, 'backend': backend}
+
+    params = {'limit': per_page + 1, 'offset': (page - 1) * per_page}
+    if backend == 'fts5':
+        sql = _fts5_query(terms, params)
+    else:
+        sql = _union_query(terms, params, backend)
+
+    rows = session.execute(text(sql), params).mappings().all()
+    results = [
+        {
+            'kind': row['kind'],
+            'record_id': row['record_id'],
+            'customer_id': row['customer_id'],
+            'customer_name': row['customer_name'],
+            'title': row['title'],
+            'detail': ' '.join(row['body'].split())
+        }
+        for row in rows[:per_page]
+    ]
+    return {'results': results, 'has_next': len(rows) > per_page, 'backend': backend}
+
+
+def _fts5_query(terms, params):
+    # The trigram tokenizer cannot match terms shorter than three characters,
+    # so those are checked with LIKE against the indexed copy instead
+    conditions = []
+    long_terms = [term for term in terms if len(term) >= 3]
+    if long_terms:
+        params['match'] = ' '.join('"' + term.replace('"', '""') + '"' for term in long_terms)
+        conditions.append(f"{FTS_TABLE} MATCH :match")
+    for index, term in enumerate(term for term in terms if len(term) < 3):
+        params[f'term{index}'] = _like_pattern(term)
+        conditions.append(f"(s.title || ' ' || s.body) LIKE :term{index} ESCAPE '\\'")
+    rank = f"bm25({FTS_TABLE}, 0, 0, 0, 10.0, 1.0)" if long_terms else "s.title"
+    return (
+        f"SELECT s.kind, s.record_id, s.customer_id, c.name AS customer_name, s.title, s.body "
+        f"FROM {FTS_TABLE} AS s JOIN customer AS c ON c.id = s.customer_id "
+        f"WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {rank} LIMIT :limit OFFSET :offset"
+    )
+
+
+def _union_query(terms, params, backend):
+    params['query'] = ' '.join(terms)
+    for index, term in enumerate(terms):
+        params[f'term{index}'] = _like_pattern(term if backend == 'trigram' else term.lower())
+
+    branches = []
+    for source in SOURCES:
+        haystack = _haystack(source)
+        if backend == 'trigram':
+            # Must match the indexed expression exactly for pg_trgm to be used
+            conditions = [f"({haystack}) ILIKE :term{index}" for index in range(len(terms))]
+            score = f"similarity({haystack}, :query)"
+        else:
+            conditions = [f"lower({haystack}) LIKE :term{index} ESCAPE '\\'" for index in range(len(terms))]
+            score = "0"
+        branches.append(
+            f"SELECT '{source['kind']}' AS kind, id AS record_id, "
+            f"{_field(source, 'customer_id')} AS customer_id, {_field(source, 'title')} AS title, "
+            f"{_field(source, 'body')} AS body, {score} AS score "
+            f"FROM {source['table']} WHERE {' AND '.join(conditions)}"
+        )
+    return (
+        f"SELECT hits.kind, hits.record_id, hits.customer_id, customer.name AS customer_name, "
+        f"hits.title, hits.body FROM ({' UNION ALL '.join(branches)}) AS hits "
+        f"JOIN customer ON customer.id = hits.customer_id "
+        f"ORDER BY hits.score DESC, hits.title LIMIT :limit OFFSET :offset"
+    )
@@ -0,0 +1,92 @@
+import os
+import socket
+import sys
+import tempfile
+
+import pytest
+
+# app.py builds its module-level app on import, so point it away from the
+# real database first
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='it_thing_tests_'), 'import.db')
+os.environ.pop('FRAGMENT_CACHE_PATH', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+import network_scanner
+from werkzeug.security import generate_password_hash
+
+TEST_USERNAME = 'tech'
+TEST_PASSWORD = 'password'
+
+
+@pytest.fixture
+def app_config():
+    """Extra settings for the app fixture; override in a test module to change them."""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    """A fresh app and schema on its own SQLite file, with an app context pushed."""
+    app = app_module.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}",
+        **app_config
+    })
+    with app.app_context():
+        app_module.db.create_all()
+        yield app
+        app_module.db.session.remove()
+        app_module.db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    """A test client logged in as an admin user."""
+    # A single hash round keeps logging in cheap; the default costs ~0.4s a test
+    password_hash = generate_password_hash(TEST_PASSWORD, method='pbkdf2:sha256:1')
+    app_module.db.session.add(app_module.User(username=TEST_USERNAME, is_admin=True, password_hash=password_hash))
+    app_module.db.session.commit()
+    client = app.test_client()
+    response = client.post('/login', data={'username': TEST_USERNAME, 'password': TEST_PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def customer(app):
+    customer = app_module.Customer(name='Acme')
+    app_module.db.session.add(customer)
+    app_module.db.session.commit()
+    return customer
+
+
+@pytest.fixture
+def loopback(monkeypatch):
+    """Keep scans of 127.0.0.0/24 away from the resolver and the host's ARP table."""
+    monkeypatch.setattr(network_scanner, 'read_neighbour_table', lambda path=None: {})
+    network_scanner.dns_cache.clear()
+    network_scanner.dns_cache.load({f'127.0.0.{host}': f'host-{host}' for host in range(256)})
+    yield
+    network_scanner.dns_cache.clear()
+
+
+@pytest.fixture
+def listener():
+    """A port accepting connections on 127.0.0.1 only."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+@pytest.fixture
+def closed_port():
+    """A loopback port nothing listens on, so connects are refused."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
@@ -0,0 +1,338 @@
+import json
+
+import pytest
+from sqlalchemy import select
+
+import app as app_module
+from app import (CCTVUser, Credential, Customer, NetworkInfo, ScanResult, ScanRun, Tombstone, customer_page, db,
+                 ip_address_to_int, page_cursor, parse_page_cursor, upsert_network_devices)
+from network_scanner import TargetSpec
+
+
+def add_customers(*names):
+    customers = [Customer(name=name) for name in names]
+    db.session.add_all(customers)
+    db.session.commit()
+    return customers
+
+
+def add_device(customer, ip_address, **fields):
+    device = NetworkInfo(customer_id=customer.id, device_name=fields.pop('device_name', 'device'),
+                         ip_address=ip_address, **fields)
+    db.session.add(device)
+    db.session.commit()
+    return device
+
+
+class TestNetworkInfo:
+    @pytest.mark.parametrize('ip_address, expected', [
+        ('10.0.0.1', 167772161),
+        (' 192.168.1.20 ', 3232235796),
+        ('10.0.0.256', None),
+        ('printer.local', None),
+        ('', None),
+        (None, None)
+    ])
+    def test_ip_address_to_int(self, ip_address, expected):
+        assert ip_address_to_int(ip_address) == expected
+
+    def test_ip_int_follows_the_address(self, customer):
+        device = add_device(customer, '10.0.0.9')
+        assert device.ip_int == ip_address_to_int('10.0.0.9')
+        device.ip_address = 'not an address'
+        db.session.commit()
+        assert device.ip_int is None
+
+    def test_devices_sort_numerically(self, customer):
+        for ip_address in ('10.0.0.10', '10.0.0.9', '10.0.0.100'):
+            add_device(customer, ip_address)
+        db.session.expire_all()
+        assert [device.ip_address for device in db.session.get(Customer, customer.id).network_info] == [
+            '10.0.0.9', '10.0.0.10', '10.0.0.100']
+
+    def test_in_targets(self, customer):
+        for ip_address in ('10.0.0.1', '10.0.0.5', '10.0.1.1', 'printer.local'):
+            add_device(customer, ip_address)
+        found = NetworkInfo.query.filter(NetworkInfo.in_targets(TargetSpec('10.0.0.0/24,10.0.1.1'))).all()
+        assert sorted(device.ip_address for device in found) == ['10.0.0.1', '10.0.0.5', '10.0.1.1']
+
+
+class TestCustomerDetails:
+    def test_devices_listed_in_address_order(self, client, customer):
+        for ip_address in ('10.0.0.10', '10.0.0.9'):
+            add_device(customer, ip_address, device_name=f'device-{ip_address}', system_type='Undefined')
+        page = client.get(f'/customer/{customer.id}').get_data(as_text=True)
+        assert page.index('device-10.0.0.9') < page.index('device-10.0.0.10')
+
+
+class TestCustomerPage:
+    @staticmethod
+    def key(customer):
+        return customer.name, customer.id
+
+    def test_pages_forward_by_name_then_id(self, app):
+        alpha, bravo, bravo_2, charlie, delta = add_customers('Alpha', 'Bravo', 'Bravo', 'Charlie', 'Delta')
+
+        customers, _, has_prev, has_next = customer_page(2)
+        assert customers == [alpha, bravo]
+        assert (has_prev, has_next) == (False, True)
+
+        customers, _, has_prev, has_next = customer_page(2, after=self.key(bravo))
+        assert customers == [bravo_2, charlie]
+        assert (has_prev, has_next) == (True, True)
+
+        customers, _, has_prev, has_next = customer_page(2, after=self.key(charlie))
+        assert customers == [delta]
+        assert (has_prev, has_next) == (True, False)
+
+    def test_pages_backward(self, app):
+        alpha, bravo, bravo_2, charlie, delta = add_customers('Alpha', 'Bravo', 'Bravo', 'Charlie', 'Delta')
+
+        customers, _, has_prev, has_next = customer_page(2, before=self.key(delta))
+        assert customers == [bravo_2, charlie]
+        assert (has_prev, has_next) == (True, True)
+
+        customers, _, has_prev, has_next = customer_page(2, before=self.key(bravo_2))
+        assert customers == [alpha, bravo]
+        assert (has_prev, has_next) == (False, True)
+
+    def test_paging_survives_deleting_the_cursor_customer(self, app):
+        alpha, bravo, charlie, delta = add_customers('Alpha', 'Bravo', 'Charlie', 'Delta')
+        after, before = self.key(bravo), self.key(charlie)
+        db.session.delete(bravo)
+        db.session.delete(charlie)
+        db.session.commit()
+
+        assert customer_page(2, after=after)[0] == [delta]
+        assert customer_page(2, before=before)[0] == [alpha]
+
+    def test_counts_records_per_customer(self, app):
+        alpha, bravo = add_customers('Alpha', 'Bravo')
+        add_device(alpha, '10.0.0.1')
+        add_device(alpha, '10.0.0.2')
+        db.session.add(Credential(customer_id=bravo.id, service_name='mail'))
+        db.session.commit()
+
+        _, counts, _, _ = customer_page(10)
+        assert counts[alpha.id] == {'devices': 2, 'credentials': 0, 'cctv_users': 0}
+        assert counts[bravo.id] == {'devices': 0, 'credentials': 1, 'cctv_users': 0}
+
+    def test_cursor_round_trip(self, app):
+        customer, = add_customers('Ünïcode & Co')
+        assert parse_page_cursor(page_cursor(customer)) == ('Ünïcode & Co', customer.id)
+
+    @pytest.mark.parametrize('value', [None, '', '12', 'not base64!', 'WzEsMl0', 'WyJhIix0cnVlXQ'])
+    def test_malformed_cursors_are_ignored(self, value):
+        assert parse_page_cursor(value) is None
+
+    def test_index_links_to_the_next_page(self, client):
+        alpha, bravo, charlie = add_customers('Alpha', 'Bravo', 'Charlie')
+        page = client.get('/', query_string={'per_page': 2}).get_data(as_text=True)
+        assert f'after={page_cursor(bravo)}' in page
+
+        page = client.get('/', query_string={'per_page': 2, 'after': page_cursor(bravo)}).get_data(as_text=True)
+        assert 'Charlie' in page and 'Alpha' not in page
+        assert f'before={page_cursor(charlie)}' in page
+
+
+class TestUpsertNetworkDevices:
+    SCANNED = [
+        {'ip_address': '10.0.0.1', 'hostname': 'router', 'mac_address': 'aa:bb:cc:dd:ee:01'},
+        {'ip_address': '10.0.0.2', 'hostname': 'Unknown', 'mac_address': 'Unknown'},
+        {'ip_address': '10.0.0.2', 'hostname': 'again', 'mac_address': None},
+        {'ip_address': ' ', 'hostname': 'blank'}
+    ]
+
+    def test_adds_new_devices_and_skips_known_ones(self, customer):
+        add_device(customer, '10.0.0.1', device_name='gateway', notes='Keep me')
+
+        assert upsert_network_devices(customer.id, self.SCANNED) == (1, 0, 1)
+        devices = {device.ip_address: device for device in NetworkInfo.query.filter_by(customer_id=customer.id)}
+        assert set(devices) == {'10.0.0.1', '10.0.0.2'}
+        assert devices['10.0.0.1'].device_name == 'gateway'
+        assert devices['10.0.0.2'].ip_int == ip_address_to_int('10.0.0.2')
+
+    def test_updates_known_devices_when_asked(self, customer):
+        add_device(customer, '10.0.0.1', device_name='gateway', notes='Keep me')
+        add_device(customer, '10.0.0.2', device_name='printer', mac_address='aa:bb:cc:dd:ee:02')
+
+        assert upsert_network_devices(customer.id, self.SCANNED, update_existing=True) == (0, 1, 1)
+        devices = {device.ip_address: device for device in NetworkInfo.query.filter_by(customer_id=customer.id)}
+        assert devices['10.0.0.1'].device_name == 'router'
+        assert devices['10.0.0.1'].mac_address == 'aa:bb:cc:dd:ee:01'
+        assert devices['10.0.0.1'].notes == 'Keep me'
+        # Placeholders from the scan never overwrite recorded values
+        assert devices['10.0.0.2'].device_name == 'printer'
+        assert devices['10.0.0.2'].mac_address == 'aa:bb:cc:dd:ee:02'
+
+    def test_unchanged_devices_are_not_counted_as_updated(self, customer):
+        add_device(customer, '10.0.0.1', device_name='router', mac_address='aa:bb:cc:dd:ee:01')
+        assert upsert_network_devices(customer.id, self.SCANNED[:1], update_existing=True) == (0, 0, 1)
+
+    def test_only_changed_fields_are_written(self, customer):
+        add_device(customer, '10.0.0.1', device_name='router', mac_address='aa:bb:cc:dd:ee:99')
+        scanned = [{'ip_address': '10.0.0.1', 'hostname': 'Unknown', 'mac_address': 'aa:bb:cc:dd:ee:01'}]
+        assert upsert_network_devices(customer.id, scanned, update_existing=True) == (0, 1, 0)
+        device = NetworkInfo.query.filter_by(customer_id=customer.id).one()
+        assert (device.device_name, device.mac_address) == ('router', 'aa:bb:cc:dd:ee:01')
+
+    def test_addresses_inserted_concurrently_count_as_skipped(self, customer, monkeypatch):
+        add_device(customer, '10.0.0.1', device_name='gateway')
+        # As if another request added 10.0.0.1 after the existing addresses were read
+        execute = db.session.execute
+
+        def hide_existing(statement, *args, **kwargs):
+            result = execute(statement, *args, **kwargs)
+            return [] if statement.is_select else result
+
+        monkeypatch.setattr(db.session, 'execute', hide_existing)
+
+        assert upsert_network_devices(customer.id, self.SCANNED) == (1, 0, 1)
+        assert NetworkInfo.query.filter_by(customer_id=customer.id).count() == 2
+
+    def test_other_databases_insert_without_returning(self, customer, monkeypatch):
+        add_device(customer, '10.0.0.1', device_name='gateway')
+        # MySQL has neither ON CONFLICT nor RETURNING
+        monkeypatch.setattr(db.session.get_bind().dialect, 'name', 'mysql')
+        assert upsert_network_devices(customer.id, self.SCANNED) == (1, 0, 1)
+        assert NetworkInfo.query.filter_by(customer_id=customer.id).count() == 2
+
+    def test_add_all_route_reports_counts(self, client, customer):
+        add_device(customer, '10.0.0.1', device_name='gateway')
+        response = client.post(f'/customer/{customer.id}/add_all_network_info', data={
+            'devices[]': [json.dumps(device) for device in self.SCANNED] + ['{not json'],
+            'update_existing': '1'
+        }, follow_redirects=True)
+        page = response.get_data(as_text=True)
+        assert 'Successfully added 1 new devices.' in page
+        assert 'Updated 1 existing devices.' in page
+        assert 'Skipped' not in page
+
+
+class TestBulkDelete:
+    @pytest.fixture
+    def devices(self, customer):
+        other, = add_customers('Globex')
+        return [add_device(customer, f'10.0.0.{host}') for host in (1, 2, 3)] + [add_device(other, '10.0.0.4')]
+
+    def remaining(self):
+        db.session.expire_all()
+        return sorted(device.ip_address for device in NetworkInfo.query)
+
+    def test_deletes_the_customers_records(self, client, customer, devices):
+        first, second, _, other = (device.id for device in devices)
+        response = client.post(f'/customer/{customer.id}/bulk-delete', json={
+            'kind': 'device', 'ids': [first, str(second), other, 999]})
+        assert response.json == {'kind': 'device', 'requested': 4, 'deleted': 2}
+        # Another customer's records are left alone
+        assert self.remaining() == ['10.0.0.3', '10.0.0.4']
+        tombstones = db.session.scalars(select(Tombstone.record_id).where(Tombstone.kind == 'device')).all()
+        assert sorted(tombstones) == [first, second]
+
+    def test_form_post_redirects_with_a_message(self, client, customer):
+        credential = Credential(customer_id=customer.id, service_name='mail')
+        db.session.add(credential)
+        db.session.commit()
+        response = client.post(f'/customer/{customer.id}/bulk-delete',
+                               data={'kind': 'credential', 'ids': [str(credential.id)]})
+        assert response.headers['Location'].endswith(f'/customer/{customer.id}#credentials')
+        assert Credential.query.count() == 0
+
+    @pytest.mark.parametrize('body, error', [
+        ([1, 2], 'Expected a JSON object with kind and ids'),
+        ('12', 'Expected a JSON object with kind and ids'),
+        ({'kind': 'password', 'ids': [1]}, "Unknown record type 'password'"),
+        ({'kind': 'device', 'ids': '12'}, 'Record ids must be a list of integers'),
+        ({'kind': 'device', 'ids': None}, 'Record ids must be a list of integers'),
+        ({'kind': 'device', 'ids': {'1': 1}}, 'Record ids must be a list of integers'),
+        ({'kind': 'device', 'ids': [True]}, 'Record ids must be a list of integers'),
+        ({'kind': 'device', 'ids': [1.0]}, 'Record ids must be a list of integers'),
+        ({'kind': 'device', 'ids': ['1', '-2']}, 'Record ids must be a list of integers'),
+        ({'kind': 'device', 'ids': ['²']}, 'Record ids must be a list of integers')
+    ])
+    def test_bad_bodies_are_rejected(self, client, customer, devices, body, error):
+        response = client.post(f'/customer/{customer.id}/bulk-delete', json=body)
+        assert response.status_code == 400
+        assert response.json == {'error': error}
+        assert len(self.remaining()) == 4
+
+    def test_bad_form_ids_are_rejected(self, client, customer, devices):
+        response = client.post(f'/customer/{customer.id}/bulk-delete',
+                               data={'kind': 'device', 'ids': ['1', 'two']}, follow_redirects=True)
+        assert 'Record ids must be a list of integers' in response.get_data(as_text=True)
+        assert len(self.remaining()) == 4
+
+    def test_unknown_customer(self, client):
+        assert client.post('/customer/999/bulk-delete', json={'kind': 'device', 'ids': [1]}).status_code == 404
+
+
+class TestDeleteCustomer:
+    def test_records_are_deleted_with_the_customer(self, client, customer):
+        other, = add_customers('Globex')
+        add_device(customer, '10.0.0.1')
+        add_device(other, '10.0.0.1')
+        run = ScanRun(customer_id=customer.id, ip_range='10.0.0.0/24', ports='22')
+        db.session.add_all([
+            Credential(customer_id=customer.id, service_name='mail'),
+            CCTVUser(customer_id=customer.id, username='viewer', password='secret'),
+            run
+        ])
+        db.session.flush()
+        db.session.add(ScanResult(run_id=run.id, ip_address='10.0.0.1', ports='22'))
+        db.session.commit()
+
+        response = client.post(f'/customer/{customer.id}/delete')
+        assert response.headers['Location'].endswith('/')
+        db.session.expire_all()
+        assert [device.customer_id for device in NetworkInfo.query] == [other.id]
+        for model in (Credential, CCTVUser, ScanRun, ScanResult):
+            assert model.query.count() == 0
+        tombstones = db.session.execute(select(Tombstone.kind, Tombstone.record_id)).all()
+        assert tombstones == [('customer', customer.id)]
+
+
+class TestSyncApi:
+    def test_unchanged_data_is_not_modified(self, client, customer):
+        response = client.get('/api/sync')
+        assert response.status_code == 200
+        assert response.json['full'] is True
+        assert [row['name'] for row in response.json['changes']['customer']] == ['Acme']
+        etag = response.headers['ETag']
+
+        response = client.get('/api/sync', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+
+    def test_changes_give_a_new_etag(self, client, customer):
+        etag = client.get('/api/sync').headers['ETag']
+        add_device(customer, '10.0.0.1')
+
+        response = client.get('/api/sync', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        device, = response.json['changes']['device']
+        assert device['ip_address'] == '10.0.0.1'
+        assert 'ip_int' not in device
+
+    def test_delta_from_cursor(self, client, customer, monkeypatch):
+        monkeypatch.setattr(app_module, 'SYNC_CURSOR_LAG', 0)
+        old = add_device(customer, '10.0.0.1')
+        old_id = old.id
+        cursor = client.get('/api/sync').json['cursor']
+
+        add_device(customer, '10.0.0.2')
+        client.post(f'/customer/{customer.id}/network/{old_id}/delete')
+        response = client.get('/api/sync', query_string={'since': cursor})
+        assert response.json['full'] is False
+        assert [row['ip_address'] for row in response.json['changes']['device']] == ['10.0.0.2']
+        assert [(row['kind'], row['id']) for row in response.json['deleted']] == [('device', old_id)]
+        assert response.json['cursor'] >= cursor
+
+    def test_old_cursor_gets_a_full_copy(self, client, customer):
+        response = client.get('/api/sync', query_string={'since': '2000-01-01T00:00:00'})
+        assert response.json['full'] is True
+        assert [row['name'] for row in response.json['changes']['customer']] == ['Acme']
+
+    def test_rejects_bad_cursor(self, client):
+        response = client.get('/api/sync?since=yesterday')
+        assert response.status_code == 400
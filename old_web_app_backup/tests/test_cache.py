@@ -0,0 +1,182 @@
+import json
+
+import pytest
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import CCTVUser, Credential, NetworkInfo, User, create_app, db, get_fragment_cache, get_user_cache
+from cache import GLOBAL_SCOPE, FragmentCache, TTLCache, customer_scope
+
+
+class TestTTLCache:
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+        assert cache.stats()['evictions'] == 1
+
+    def test_entries_expire(self):
+        cache = TTLCache()
+        cache.set('a', 1, ttl=-1)
+        assert cache.get('a', 'missing') == 'missing'
+        assert cache.stats()['hits'] == 0
+
+
+class TestFragmentCache:
+    def test_bump_rerenders_dependent_fragments(self):
+        cache = FragmentCache(store_path=None)
+        renders = []
+
+        def render(name):
+            return lambda: renders.append(name) or name
+
+        cache.get_or_render('details', [customer_scope(1)], render('one'))
+        cache.get_or_render('details', [customer_scope(1)], render('one'))
+        cache.get_or_render('details', [customer_scope(2)], render('two'))
+        cache.bump(customer_scope(1))
+        cache.get_or_render('details', [customer_scope(1)], render('one'))
+        cache.get_or_render('details', [customer_scope(2)], render('two'))
+        assert renders == ['one', 'two', 'one']
+
+    def test_shared_store_is_seen_by_other_processes(self, tmp_path):
+        path = str(tmp_path / 'fragments.db')
+        first, second = FragmentCache(store_path=path), FragmentCache(store_path=path)
+        assert first.get_or_render('index', [GLOBAL_SCOPE], lambda: 'v1') == 'v1'
+        assert second.get_or_render('index', [GLOBAL_SCOPE], lambda: 'v2') == 'v1'
+        second.bump(GLOBAL_SCOPE)
+        assert first.get_or_render('index', [GLOBAL_SCOPE], lambda: 'v2') == 'v2'
+
+    def test_each_app_has_its_own_cache(self, app):
+        other = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        assert get_fragment_cache() is not other.extensions['fragment_cache']
+        get_fragment_cache().bump(GLOBAL_SCOPE)
+        assert other.extensions['fragment_cache'].versions([GLOBAL_SCOPE]) == [0]
+
+
+@pytest.fixture
+def records(customer):
+    device = NetworkInfo(customer_id=customer.id, device_name='router', ip_address='10.0.0.1',
+                         system_type='Networking Hardware')
+    credential = Credential(customer_id=customer.id, service_name='mail')
+    cctv_user = CCTVUser(customer_id=customer.id, username='viewer', password='secret')
+    db.session.add_all([device, credential, cctv_user])
+    db.session.commit()
+    return {'customer': customer.id, 'device': device.id, 'credential': credential.id,
+            'cctv_user': cctv_user.id}
+
+
+# Every route that writes customer data, with a body that makes it succeed
+WRITE_ROUTES = [
+    ('/customer/add', {'data': {'name': 'Globex'}}),
+    ('/customer/{customer}/edit', {'data': {'name': 'Acme Ltd'}}),
+    ('/customer/{customer}/delete', {}),
+    ('/customer/{customer}/network/add', {'data': {'device_name': 'switch', 'ip_address': '10.0.0.2'}}),
+    ('/customer/{customer}/add_all_network_info',
+     {'data': {'devices[]': [json.dumps({'ip_address': '10.0.0.3', 'hostname': 'nas'})]}}),
+    ('/customer/{customer}/network/{device}/edit', {'data': {'device_name': 'gateway', 'ip_address': '10.0.0.1'}}),
+    ('/customer/{customer}/network/{device}/delete', {}),
+    ('/customer/{customer}/bulk-delete', {'json': {'kind': 'device', 'ids': ['{device}']}}),
+    ('/customer/{customer}/credential/add', {'data': {'service_name': 'vpn'}}),
+    ('/customer/{customer}/credential/{credential}/edit', {'data': {'service_name': 'webmail'}}),
+    ('/customer/{customer}/credential/{credential}/delete', {}),
+    ('/customer/{customer}/cctv/user/add', {'data': {'username': 'guard', 'password': 'pw'}}),
+    ('/customer/{customer}/cctv/user/{cctv_user}/edit', {'data': {'username': 'guard', 'password': 'pw'}}),
+    ('/customer/{customer}/cctv/user/{cctv_user}/delete', {})
+]
+
+
+class TestInvalidation:
+    @pytest.mark.parametrize('path, body', WRITE_ROUTES, ids=[path for path, _ in WRITE_ROUTES])
+    def test_write_routes_invalidate_cached_pages(self, client, records, path, body):
+        scopes = [GLOBAL_SCOPE, customer_scope(records['customer'])]
+        before = get_fragment_cache().versions(scopes)
+
+        body = json.loads(json.dumps(body).replace('"{device}"', str(records['device'])))
+        response = client.post(path.format(**records), **body)
+        assert response.status_code in (200, 302)
+
+        after = get_fragment_cache().versions(scopes)
+        assert after[0] > before[0]
+        if path != '/customer/add':
+            assert after[1] > before[1]
+
+    def test_pages_show_the_change(self, client, records):
+        customer_id = records['customer']
+        assert 'Acme' in client.get('/').get_data(as_text=True)
+        assert 'Acme' in client.get(f'/customer/{customer_id}').get_data(as_text=True)
+        client.post(f'/customer/{customer_id}/edit', data={'name': 'Initech'})
+        assert 'Initech' in client.get('/').get_data(as_text=True)
+        assert 'Initech' in client.get(f'/customer/{customer_id}').get_data(as_text=True)
+
+    def test_reads_are_served_from_the_cache(self, client, records):
+        client.get('/')
+        client.get(f"/customer/{records['customer']}")
+        renders = get_fragment_cache().renders
+        client.get('/')
+        client.get(f"/customer/{records['customer']}")
+        assert get_fragment_cache().renders == renders
+
+
+def get(client, path):
+    # Requests share the test's app context, and with it the user flask-login
+    # keeps in g; drop it so each request goes through the user loader
+    g.pop('_login_user', None)
+    return client.get(path)
+
+
+class TestUserCache:
+    @pytest.fixture
+    def user_queries(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if 'FROM user' in statement:
+                statements.append(statement)
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        yield statements
+        event.remove(Engine, 'before_cursor_execute', record)
+
+    def test_requests_reuse_the_loaded_user(self, client, user_queries):
+        for _ in range(3):
+            get(client, '/search')
+        assert len(user_queries) == 1
+        assert get_user_cache().stats()['entries'] == 1
+
+    def test_changing_the_user_drops_the_cached_copy(self, client, user_queries):
+        get(client, '/search')
+        user = User.query.one()
+        user_queries.clear()
+        user.is_admin = False
+        db.session.commit()
+        assert get_user_cache().stats()['entries'] == 0
+        get(client, '/search')
+        assert len(user_queries) == 1
+
+    def test_deleted_users_are_logged_out(self, client):
+        get(client, '/search')
+        db.session.delete(User.query.one())
+        db.session.commit()
+        assert get(client, '/search').status_code == 302
+
+    def test_logout_drops_the_cached_copy(self, client):
+        get(client, '/search')
+        get(client, '/logout')
+        assert get_user_cache().stats()['entries'] == 0
+
+    def test_each_app_has_its_own_cache(self, client):
+        other = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        assert other.extensions['user_cache'] is not get_user_cache()
+        assert other.extensions['user_cache'].stats()['entries'] == 0
+
+    def test_stats_route(self, client, monkeypatch):
+        monkeypatch.setenv('DEBUG_TOKEN', 'secret')
+        get(client, '/search')
+        assert client.get('/cache-stats').status_code == 401
+        stats = client.get('/cache-stats', query_string={'token': 'secret'}).json
+        assert stats['user_cache']['entries'] == 1
+        assert stats['fragment_cache']['shared_store'] is None
@@ -0,0 +1,83 @@
+import pytest
+
+import metrics
+from network_scanner import ScanStats
+
+
+def sample(name, **labels):
+    """Current value of one sample in the app's registry, or 0 if it is not there yet."""
+    prefix = name + metrics._format_labels(tuple(labels.items()))
+    for line in metrics.registry.render().splitlines():
+        if line.startswith(prefix + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0
+
+
+class TestRegistry:
+    def test_renders_prometheus_text(self):
+        registry = metrics.Registry()
+        requests = registry.counter('requests_total', 'Requests.', ('path',))
+        temperature = registry.gauge('temperature', 'Degrees.')
+        latency = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+        requests.inc(path='/a "quoted"\npath')
+        requests.inc(2, path='/b')
+        temperature.set(21.5)
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+
+        assert registry.render().splitlines() == [
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{path="/a \\"quoted\\"\\npath"} 1',
+            'requests_total{path="/b"} 2',
+            '# HELP temperature Degrees.',
+            '# TYPE temperature gauge',
+            'temperature 21.5',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3'
+        ]
+
+    def test_labels_must_match(self):
+        counter = metrics.Registry().counter('hits_total', 'Hits.', ('route',))
+        with pytest.raises(ValueError, match=r"hits_total takes labels \('route',\), got \('path',\)"):
+            counter.inc(path='/')
+
+    def test_record_scan(self):
+        stats = ScanStats()
+        stats.hosts_scanned, stats.probes, stats.timeouts = 4, 8, 2
+        before = [sample('scan_runs_total', outcome='completed'), sample('scan_probes_total'),
+                  sample('scan_open_ports_total'), sample('scan_runs_total', outcome='error')]
+        metrics.record_scan(stats, [{'ip': '10.0.0.1', 'ports': [22, 80]}, {'ip': '10.0.0.2', 'ports': []}])
+        metrics.record_scan(stats, failed=True)
+        after = [sample('scan_runs_total', outcome='completed'), sample('scan_probes_total'),
+                 sample('scan_open_ports_total'), sample('scan_runs_total', outcome='error')]
+        assert [a - b for a, b in zip(after, before)] == [1, 8, 2, 1]
+
+
+class TestMetricsRoute:
+    def test_requires_the_debug_token(self, client, monkeypatch):
+        monkeypatch.delenv('DEBUG_TOKEN', raising=False)
+        assert client.get('/metrics').status_code == 401
+        monkeypatch.setenv('DEBUG_TOKEN', 'secret')
+        assert client.get('/metrics', query_string={'token': 'wrong'}).status_code == 401
+
+    def test_reports_requests_queries_and_templates(self, client, customer, monkeypatch):
+        monkeypatch.setenv('DEBUG_TOKEN', 'secret')
+        labels = {'endpoint': 'main.customer_details', 'method': 'GET', 'status': '200'}
+        requests = sample('http_request_duration_seconds_count', **labels)
+        queries = sample('http_request_db_queries_sum', endpoint='main.customer_details')
+        renders = sample('template_render_seconds_count', template='customer_details_content.html')
+
+        client.get(f'/customer/{customer.id}')
+        response = client.get('/metrics', query_string={'token': 'secret'})
+        assert response.mimetype == 'text/plain'
+        assert sample('http_request_duration_seconds_count', **labels) == requests + 1
+        assert sample('http_request_db_queries_sum', endpoint='main.customer_details') > queries
+        assert sample('template_render_seconds_count', template='customer_details_content.html') == renders + 1
+        assert sample('app_startup_seconds', phase='create_app') > 0
+        assert sample('db_queries_total') > 0
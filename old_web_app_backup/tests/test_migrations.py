@@ -0,0 +1,83 @@
+import pytest
+from flask_migrate import upgrade
+from sqlalchemy import text
+
+import search
+from app import NetworkInfo, db, init_migrate
+
+# Revision before duplicate addresses were merged and made unique
+LEGACY_REVISION = '3f1c2a9d7b10'
+
+
+@pytest.fixture
+def legacy_db(app):
+    """
+    The schema as it stood at LEGACY_REVISION: no unique index on a customer's
+    addresses, so imports could record one twice.
+    """
+    with db.engine.begin() as connection:
+        connection.execute(text('DROP INDEX uq_network_info_customer_id_ip_address'))
+        connection.execute(text("INSERT INTO customer (id, name) VALUES (1, 'Acme')"))
+        connection.execute(text('CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL)'))
+        connection.execute(text(f"INSERT INTO alembic_version VALUES ('{LEGACY_REVISION}')"))
+    init_migrate(app)
+
+    def add_rows(*rows):
+        with db.engine.begin() as connection:
+            for row in rows:
+                connection.execute(text(
+                    'INSERT INTO network_info (customer_id, ip_address, device_name, login, notes) '
+                    'VALUES (1, :ip_address, :device_name, :login, :notes)'
+                ), {'login': None, 'notes': None, **row})
+
+    return add_rows
+
+
+def devices():
+    db.session.expire_all()
+    return NetworkInfo.query.order_by(NetworkInfo.id).all()
+
+
+def test_upgrade_merges_duplicate_addresses(legacy_db):
+    legacy_db(
+        {'ip_address': '10.0.0.1', 'device_name': 'Unknown Device', 'notes': 'Rack 1'},
+        {'ip_address': '10.0.0.1', 'device_name': 'router', 'login': 'admin', 'notes': 'Firmware 2.1'},
+        {'ip_address': '10.0.0.1', 'device_name': 'router', 'notes': 'Rack 1'},
+        {'ip_address': '10.0.0.2', 'device_name': 'printer'}
+    )
+
+    upgrade()
+
+    merged, printer = devices()
+    assert (merged.id, merged.ip_address, merged.device_name, merged.login) == (1, '10.0.0.1', 'router', 'admin')
+    assert merged.notes == 'Rack 1\n\nFirmware 2.1'
+    assert printer.ip_address == '10.0.0.2'
+    indexes = db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars().all()
+    assert 'uq_network_info_customer_id_ip_address' in indexes
+
+
+def test_upgrade_stops_on_conflicting_duplicates(legacy_db, capsys):
+    legacy_db(
+        {'ip_address': '10.0.0.1', 'device_name': 'router', 'login': 'admin'},
+        {'ip_address': '10.0.0.1', 'device_name': 'router', 'login': 'root'}
+    )
+
+    # Flask-Migrate logs the migration's error, through alembic's stderr handler, and exits
+    with pytest.raises(SystemExit):
+        upgrade()
+
+    assert 'customer 1, 10.0.0.1: login differs between rows 1 and 2' in capsys.readouterr().err
+    assert [device.login for device in devices()] == ['admin', 'root']
+    version = db.session.execute(text('SELECT version_num FROM alembic_version')).scalar()
+    assert version == LEGACY_REVISION
+
+
+def test_upgrade_builds_search_index(legacy_db):
+    legacy_db({'ip_address': '10.0.0.1', 'device_name': 'core-switch'})
+    assert search.search_backend(db.session.connection()) == 'like'
+    db.session.commit()
+
+    upgrade()
+
+    assert search.search_backend(db.session.connection()) == 'fts5'
+    assert [hit['title'] for hit in search.search_records(db.session, 'switch')['results']] == ['core-switch']
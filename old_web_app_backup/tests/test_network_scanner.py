@@ -0,0 +1,476 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import network_scanner
+from network_scanner import (CLOSED, DISCOVERY_PORTS, OPEN, ProbeRateLimiter, ReverseDnsCache, RttEstimator,
+                             ScanStats, TargetSpec, _Prober, _run_pool, diff_scans, int_to_ip, ip_to_int,
+                             read_neighbour_table, scan_network)
+
+
+class FakeNetwork:
+    """
+    Answers probes from a table instead of the network.
+
+    hosts maps an address in 10.0.0.0/24 to {port: OPEN or CLOSED}; anything
+    else times out. neighbours maps addresses to the MACs in the ARP table.
+    Use with the loopback fixture, which clears the DNS entries loaded here.
+    """
+
+    def __init__(self, monkeypatch, hosts, neighbours=None):
+        self.hosts = hosts
+        self.neighbours = {ip_to_int(ip): mac for ip, mac in (neighbours or {}).items()}
+        self.probes = []
+        network = self
+
+        async def connect(prober, ip, port):
+            ip_str = int_to_ip(ip)
+            network.probes.append((ip_str, port))
+            prober.stats.probes += 1
+            return network.hosts.get(ip_str, {}).get(port)
+
+        monkeypatch.setattr(_Prober, 'connect', connect)
+        monkeypatch.setattr(network_scanner, 'read_neighbour_table', lambda path=None: dict(self.neighbours))
+        network_scanner.dns_cache.load({f'10.0.0.{host}': None for host in range(256)})
+
+    def probed(self, ip):
+        return [port for probed_ip, port in self.probes if probed_ip == ip]
+
+
+def probe(ip, port, **kwargs):
+    async def run():
+        prober = _Prober(8, RttEstimator(**kwargs), ProbeRateLimiter(0), ScanStats())
+        return await prober.connect(ip_to_int(ip), port)
+    return asyncio.run(run())
+
+
+class TestScanEngine:
+    def test_probe_outcomes(self, listener, closed_port):
+        assert probe('127.0.0.1', listener) == OPEN
+        assert probe('127.0.0.1', closed_port) == CLOSED
+
+    def test_finds_open_ports(self, loopback, listener, closed_port):
+        stats = ScanStats()
+        devices = scan_network('127.0.0.1', [listener, closed_port], discovery=False, stats=stats)
+        assert devices == [{'ip': '127.0.0.1', 'hostname': 'host-1', 'mac_address': None, 'ports': [listener]}]
+        assert stats.probes == 2
+        assert stats.hosts_scanned == stats.devices_found == 1
+
+    def test_hosts_with_nothing_listening_are_left_out(self, loopback, listener):
+        # Only 127.0.0.1 listens; the other loopback addresses refuse
+        devices = scan_network('127.0.0.1-127.0.0.16', [listener], discovery=False)
+        assert [device['ip'] for device in devices] == ['127.0.0.1']
+
+    def test_devices_are_ordered_by_address(self, loopback, closed_port):
+        devices = scan_network('127.0.0.1-127.0.0.12', [closed_port], discovery=True)
+        assert [device['ip'] for device in devices] == [f'127.0.0.{host}' for host in range(1, 13)]
+
+    def test_reports_devices_as_they_are_found(self, loopback, listener):
+        found = []
+        progress = []
+        devices = scan_network('127.0.0.1-127.0.0.4', [listener], discovery=False,
+                               on_device=found.append, on_progress=lambda done, total: progress.append((done, total)))
+        assert found == devices
+        assert progress[-1] == (4, 4)
+
+    def test_cancelled_before_start(self, loopback, listener):
+        cancel = threading.Event()
+        cancel.set()
+        stats = ScanStats()
+        assert scan_network('127.0.0.1-127.0.0.4', [listener], discovery=False, stats=stats,
+                            cancel_event=cancel) == []
+        assert stats.cancelled
+
+    def test_invalid_range(self):
+        with pytest.raises(ValueError):
+            scan_network('127.0.0.300', [22])
+
+
+class TestWorkerPool:
+    def run_pool(self, hosts, workers, delays=None, cancel_event=None):
+        delays = delays or {}
+        stats = ScanStats()
+        finished = []
+        running = [0, 0]
+
+        async def handler(ip):
+            running[0] += 1
+            running[1] = max(running)
+            await asyncio.sleep(delays.get(ip, 0.001))
+            running[0] -= 1
+            finished.append(ip)
+
+        asyncio.run(_run_pool(hosts, workers, handler, stats, cancel_event))
+        return finished, running[1], stats
+
+    def test_every_host_is_handled_once(self):
+        finished, peak, _ = self.run_pool(range(50), 4)
+        assert sorted(finished) == list(range(50))
+        assert peak == 4
+
+    def test_slow_host_only_holds_its_own_worker(self):
+        # With join-per-batch the other hosts would wait for host 0
+        finished, _, stats = self.run_pool(range(20), 2, delays={0: 0.2})
+        assert finished[-1] == 0
+        assert len(finished) == 20
+        # One worker sat idle while the slow host finished
+        assert stats.idle_time >= 0.1
+
+    def test_cancel_stops_feeding_hosts(self):
+        cancel = threading.Event()
+        cancel.set()
+        finished, _, stats = self.run_pool(range(20), 2, cancel_event=cancel)
+        assert finished == []
+        assert stats.cancelled
+
+    def test_cancel_drops_queued_hosts(self):
+        cancel = threading.Event()
+        stats = ScanStats()
+        finished = []
+
+        async def handler(ip):
+            finished.append(ip)
+            if ip == 0:
+                cancel.set()
+            await asyncio.sleep(0.001)
+
+        asyncio.run(_run_pool(range(1000), 4, handler, stats, cancel))
+        # Only hosts already being handled when the cancel came finish
+        assert len(finished) < 8
+        assert stats.cancelled
+
+    def test_scan_uses_no_more_workers_than_hosts(self, loopback, listener):
+        stats = ScanStats()
+        scan_network('127.0.0.1-127.0.0.3', [listener], discovery=False, workers=64, stats=stats)
+        assert stats.workers == 3
+        assert stats.hosts_scanned == 3
+
+
+class TestReverseDnsCache:
+    def test_caches_names_and_failures(self):
+        cache = ReverseDnsCache()
+        cache.set('10.0.0.1', 'printer')
+        cache.set('10.0.0.2', None)
+        assert cache.get('10.0.0.1') == (True, 'printer')
+        assert cache.get('10.0.0.2') == (True, None)
+        assert cache.get('10.0.0.3') == (False, None)
+
+    def test_entries_expire(self):
+        # Failed lookups expire at once here, names keep
+        cache = ReverseDnsCache(positive_ttl=60, negative_ttl=-1)
+        cache.set('10.0.0.1', 'printer')
+        cache.set('10.0.0.2', None)
+        assert cache.get('10.0.0.1') == (True, 'printer')
+        assert cache.get('10.0.0.2') == (False, None)
+        assert cache.snapshot() == {'10.0.0.1': 'printer'}
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ReverseDnsCache(max_entries=2)
+        cache.set('10.0.0.1', 'a')
+        cache.set('10.0.0.2', 'b')
+        cache.get('10.0.0.1')
+        cache.set('10.0.0.3', 'c')
+        assert cache.snapshot() == {'10.0.0.1': 'a', '10.0.0.3': 'c'}
+
+    def test_snapshot_limited_to_targets(self):
+        cache = ReverseDnsCache()
+        cache.load({'10.0.0.1': 'a', '10.0.1.1': 'b'})
+        assert cache.snapshot(TargetSpec('10.0.0.0/24')) == {'10.0.0.1': 'a'}
+
+    def test_resolve_looks_up_each_address_once(self, monkeypatch):
+        lookups = []
+
+        def lookup(ip_str):
+            lookups.append(ip_str)
+            return f'host-{ip_str}'
+
+        monkeypatch.setattr(network_scanner, '_reverse_lookup', lookup)
+        cache = ReverseDnsCache()
+        stats = ScanStats()
+
+        async def resolve_twice():
+            return [await cache.resolve('10.0.0.1', stats) for _ in range(2)]
+
+        assert asyncio.run(resolve_twice()) == ['host-10.0.0.1'] * 2
+        assert lookups == ['10.0.0.1']
+        assert (stats.dns_lookups, stats.dns_cache_hits) == (1, 1)
+
+    def test_slow_lookup_is_cached_after_the_scan_gives_up(self, monkeypatch):
+        release = threading.Event()
+
+        def lookup(ip_str):
+            release.wait(5)
+            return 'slow-host'
+
+        monkeypatch.setattr(network_scanner, '_reverse_lookup', lookup)
+        monkeypatch.setattr(network_scanner, 'DNS_TIMEOUT', 0.05)
+        cache = ReverseDnsCache()
+        assert asyncio.run(cache.resolve('10.0.0.1')) is None
+        release.set()
+        cache._get_executor().shutdown(wait=True)
+        assert cache.get('10.0.0.1') == (True, 'slow-host')
+
+
+class TestDiscovery:
+    def test_reads_reachable_neighbours(self, tmp_path):
+        table = tmp_path / 'arp'
+        table.write_text(
+            'IP address       HW type     Flags       HW address            Mask     Device\n'
+            '10.0.0.1         0x1         0x2         aa:bb:cc:dd:ee:01     *        eth0\n'
+            '10.0.0.2         0x1         0x0         00:00:00:00:00:00     *        eth0\n'
+            '10.0.0.3         0x1         0x2         00:00:00:00:00:00     *        eth0\n'
+        )
+        assert read_neighbour_table(str(table)) == {ip_to_int('10.0.0.1'): 'aa:bb:cc:dd:ee:01'}
+        assert read_neighbour_table(str(tmp_path / 'missing')) == {}
+
+    def test_only_live_hosts_are_swept(self, loopback, monkeypatch):
+        network = FakeNetwork(monkeypatch, {
+            '10.0.0.1': {22: OPEN, 80: CLOSED},
+            '10.0.0.2': {443: CLOSED}
+        })
+        stats = ScanStats()
+        devices = scan_network('10.0.0.1-10.0.0.4', [22, 3389], discovery=True, stats=stats)
+        assert [(device['ip'], device['ports']) for device in devices] == [('10.0.0.1', [22]), ('10.0.0.2', [])]
+        assert stats.hosts_alive == 2
+        assert stats.hosts_scanned == 4
+        # Dead hosts only ever get the discovery pings
+        assert sorted(network.probed('10.0.0.3')) == sorted(DISCOVERY_PORTS)
+
+    def test_neighbours_skip_the_ping_and_keep_their_mac(self, loopback, monkeypatch):
+        network = FakeNetwork(monkeypatch, {}, neighbours={'10.0.0.2': 'aa:bb:cc:dd:ee:02'})
+        devices = scan_network('10.0.0.1-10.0.0.2', [22], discovery=True)
+        assert devices == [{'ip': '10.0.0.2', 'hostname': None, 'mac_address': 'aa:bb:cc:dd:ee:02', 'ports': []}]
+        assert network.probed('10.0.0.2') == [22]
+
+    def test_ports_found_open_by_the_ping_are_not_probed_again(self, loopback, monkeypatch):
+        network = FakeNetwork(monkeypatch, {'10.0.0.1': {80: OPEN}})
+        devices = scan_network('10.0.0.1', [22, 80], discovery=True)
+        assert devices[0]['ports'] == [80]
+        assert network.probed('10.0.0.1').count(80) == 1
+
+    def test_without_discovery_every_address_is_swept(self, loopback, monkeypatch):
+        network = FakeNetwork(monkeypatch, {'10.0.0.2': {22: CLOSED}})
+        assert scan_network('10.0.0.1-10.0.0.3', [22], discovery=False) == []
+        assert len(network.probes) == 3
+
+
+class TestRttEstimator:
+    def test_initial_timeout_before_any_answer(self):
+        rtt = RttEstimator(initial_timeout=0.5, min_timeout=0.01, max_timeout=3.0)
+        assert rtt.timeout('10.0.0.1') == 0.5
+        assert not rtt.knows('10.0.0.1')
+
+    def test_known_host_uses_its_own_estimate(self):
+        rtt = RttEstimator(initial_timeout=0.5, min_timeout=0.01, max_timeout=3.0)
+        rtt.observe('10.0.0.1', 0.1)
+        # First sample: SRTT = 0.1, RTTVAR = 0.05
+        assert rtt.knows('10.0.0.1')
+        assert rtt.timeout('10.0.0.1') == pytest.approx(0.3)
+
+    def test_unknown_host_gets_padded_network_estimate(self):
+        rtt = RttEstimator(initial_timeout=0.5, min_timeout=0.01, max_timeout=3.0)
+        rtt.observe('10.0.0.1', 0.1)
+        assert rtt.timeout('10.0.0.2') == pytest.approx(0.6)
+
+    def test_timeouts_are_clamped(self):
+        rtt = RttEstimator(initial_timeout=0.5, min_timeout=0.25, max_timeout=3.0)
+        rtt.observe('10.0.0.1', 0.001)
+        rtt.observe('10.0.0.2', 2.0)
+        assert rtt.timeout('10.0.0.1') == 0.25
+        assert rtt.timeout('10.0.0.2') == 3.0
+
+
+class TestProbeRateLimiter:
+    def test_backs_off_when_probes_time_out(self):
+        limiter = ProbeRateLimiter(rate=100, window=10)
+        for _ in range(10):
+            limiter.record(timed_out=True)
+        assert limiter.rate == 50
+        assert limiter.backoffs == 1
+
+    def test_recovers_gradually(self):
+        limiter = ProbeRateLimiter(rate=100, window=10)
+        for _ in range(10):
+            limiter.record(timed_out=True)
+        for _ in range(10):
+            limiter.record(timed_out=False)
+        assert limiter.rate == 60
+        for _ in range(100):
+            limiter.record(timed_out=False)
+        assert limiter.rate == 100
+
+    def test_never_drops_below_minimum_rate(self):
+        limiter = ProbeRateLimiter(rate=100, window=10)
+        for _ in range(200):
+            limiter.record(timed_out=True)
+        assert limiter.rate == limiter.min_rate == 5
+
+    def test_paces_connection_attempts(self):
+        limiter = ProbeRateLimiter(rate=100)
+
+        async def acquire(count):
+            for _ in range(count):
+                await limiter.acquire()
+
+        started = time.monotonic()
+        # A burst of 5 goes at once, the other 20 at 100 a second
+        asyncio.run(acquire(25))
+        assert time.monotonic() - started >= 0.15
+
+    def test_unpaced_limiter_ignores_feedback(self):
+        limiter = ProbeRateLimiter(rate=0, window=10)
+        for _ in range(20):
+            limiter.record(timed_out=True)
+        assert limiter.rate == 0
+        assert limiter.backoffs == 0
+
+
+class TestDiffScans:
+    def test_new_gone_and_changed(self):
+        previous = [
+            {'ip': '10.0.0.10', 'ports': [22], 'mac_address': 'AA-BB-CC-DD-EE-01'},
+            {'ip': '10.0.0.2', 'ports': [80], 'mac_address': None}
+        ]
+        current = [
+            {'ip': '10.0.0.10', 'ports': [22, 443], 'mac_address': 'aa:bb:cc:dd:ee:02'},
+            {'ip': '10.0.0.3', 'ports': [80], 'mac_address': None}
+        ]
+        diff = diff_scans(previous, current)
+        assert [device['ip'] for device in diff['new']] == ['10.0.0.3']
+        assert [device['ip'] for device in diff['gone']] == ['10.0.0.2']
+        assert diff['changed'] == [{
+            'ip': '10.0.0.10',
+            'ports_opened': [443],
+            'mac_address': {'before': 'aa:bb:cc:dd:ee:01', 'after': 'aa:bb:cc:dd:ee:02'}
+        }]
+
+    def test_results_are_ordered_by_address(self):
+        current = [{'ip': ip, 'ports': []} for ip in ('10.0.0.10', '10.0.0.9', '10.0.0.100')]
+        assert [device['ip'] for device in diff_scans([], current)['new']] == [
+            '10.0.0.9', '10.0.0.10', '10.0.0.100']
+
+    def test_same_mac_in_another_format_is_not_a_change(self):
+        previous = [{'ip': '10.0.0.1', 'ports': [22], 'mac_address': 'AA:BB:CC:DD:EE:FF'}]
+        current = [{'ip': '10.0.0.1', 'ports': [22], 'mac_address': 'aa-bb-cc-dd-ee-ff'}]
+        assert diff_scans(previous, current)['changed'] == []
+
+    def test_records_without_ports_compare_by_mac_only(self):
+        previous = [{'ip': '10.0.0.1', 'ports': None, 'mac_address': 'Unknown'}]
+        current = [{'ip': '10.0.0.1', 'ports': [22, 80], 'mac_address': 'aa:bb:cc:dd:ee:ff'}]
+        assert diff_scans(previous, current)['changed'] == []
+
+    def test_devices_outside_scope_are_not_gone(self):
+        previous = [
+            {'ip': '10.0.0.1', 'ports': [22]},
+            {'ip': '10.0.1.1', 'ports': [22]},
+            {'ip': 'not an address', 'ports': None}
+        ]
+        diff = diff_scans(previous, [], scope=TargetSpec('10.0.0.0/24'))
+        assert [device['ip'] for device in diff['gone']] == ['10.0.0.1']
+
+
+class TestRescan:
+    def test_known_hosts_go_first_with_their_open_ports_first(self, loopback, monkeypatch):
+        network = FakeNetwork(monkeypatch, {'10.0.0.6': {443: OPEN}, '10.0.0.2': {22: CLOSED}})
+        devices = scan_network('10.0.0.1-10.0.0.6', [22, 443], discovery=False, workers=1,
+                               priority={'10.0.0.6': [443]})
+        assert network.probes[:2] == [('10.0.0.6', 443), ('10.0.0.6', 22)]
+        assert [device['ip'] for device in devices] == ['10.0.0.6']
+
+    def test_known_host_that_answers_is_found_without_discovery(self, loopback, monkeypatch):
+        FakeNetwork(monkeypatch, {'10.0.0.1': {22: CLOSED}, '10.0.0.2': {22: CLOSED}})
+        devices = scan_network('10.0.0.1-10.0.0.2', [22], discovery=False, priority={'10.0.0.1': [22]})
+        assert devices == [{'ip': '10.0.0.1', 'hostname': None, 'mac_address': None, 'ports': []}]
+
+    @pytest.mark.parametrize('discovery', [True, False])
+    def test_known_host_that_went_away_is_not_found(self, loopback, monkeypatch, discovery):
+        FakeNetwork(monkeypatch, {})
+        stats = ScanStats()
+        devices = scan_network('10.0.0.1-10.0.0.4', [22], discovery=discovery, stats=stats,
+                               priority={'10.0.0.2': [22]})
+        assert devices == []
+        assert stats.hosts_scanned == 4
+        previous = [{'ip': '10.0.0.2', 'hostname': None, 'mac_address': None, 'ports': [22]}]
+        diff = diff_scans(previous, devices, TargetSpec('10.0.0.1-10.0.0.4'))
+        assert [device['ip'] for device in diff['gone']] == ['10.0.0.2']
+        assert diff['changed'] == []
+
+
+class TestSharding:
+    @pytest.fixture(autouse=True)
+    def shard_small_ranges(self, monkeypatch):
+        monkeypatch.setattr(network_scanner, 'SHARD_MIN_HOSTS', 1)
+
+    def test_shards_find_the_same_devices(self, loopback, listener):
+        found = []
+        progress = []
+        stats = ScanStats()
+        devices = scan_network('127.0.0.1-127.0.0.8', [listener], discovery=False, processes=2, workers=8,
+                               stats=stats, on_device=found.append,
+                               on_progress=lambda done, total: progress.append((done, total)))
+        assert devices == [{'ip': '127.0.0.1', 'hostname': 'host-1', 'mac_address': None, 'ports': [listener]}]
+        assert found == devices
+        assert progress[-1] == (8, 8)
+        assert stats.hosts_scanned == 8
+        # Each shard got half of the worker budget
+        assert stats.workers == 8
+
+    def test_cancel_reaches_the_shards(self, loopback, closed_port):
+        cancel = threading.Event()
+        cancel.set()
+        stats = ScanStats()
+        assert scan_network('127.0.0.0/24', [closed_port], discovery=False, processes=2,
+                            stats=stats, cancel_event=cancel) == []
+        assert stats.cancelled
+        assert stats.hosts_scanned < 254
+
+
+class TestTargetSpec:
+    def test_cidr_leaves_out_network_and_broadcast(self):
+        targets = TargetSpec('10.0.0.0/30')
+        assert str(targets) == '10.0.0.1-10.0.0.2'
+        assert len(targets) == 2
+
+    def test_overlapping_terms_are_merged(self):
+        targets = TargetSpec('10.0.0.1-10.0.0.10, 10.0.0.5-10.0.0.20,10.0.0.20')
+        assert targets.ranges == [(ip_to_int('10.0.0.1'), ip_to_int('10.0.0.20'))]
+        assert len(list(targets)) == len(targets) == 20
+
+    def test_excluded_cidr_drops_whole_block(self):
+        targets = TargetSpec('10.0.0.1-10.0.0.20', exclude='10.0.0.8/30,10.0.0.15')
+        assert str(targets) == '10.0.0.1-10.0.0.7,10.0.0.12-10.0.0.14,10.0.0.16-10.0.0.20'
+        assert len(targets) == 15
+
+    def test_contains(self):
+        targets = TargetSpec('10.0.0.1-10.0.0.5,10.0.1.1')
+        assert ip_to_int('10.0.0.5') in targets
+        assert ip_to_int('10.0.1.1') in targets
+        assert ip_to_int('10.0.0.6') not in targets
+        assert ip_to_int('10.0.0.0') not in targets
+
+    def test_split_covers_every_address_once_in_order(self):
+        targets = TargetSpec('10.0.0.1-10.0.0.10,10.0.1.1-10.0.1.6')
+        shards = targets.split(3)
+        assert [len(shard) for shard in shards] == [6, 5, 5]
+        assert [address for shard in shards for address in shard] == list(targets)
+
+    def test_split_never_makes_empty_shards(self):
+        assert len(TargetSpec('10.0.0.1-10.0.0.2').split(8)) == 2
+
+    def test_scan_skips_excluded_addresses(self, loopback, closed_port):
+        devices = scan_network('127.0.0.1-127.0.0.6,127.0.0.5', [closed_port], discovery=True,
+                               exclude='127.0.0.2-127.0.0.4')
+        assert [device['ip'] for device in devices] == ['127.0.0.1', '127.0.0.5', '127.0.0.6']
+
+    @pytest.mark.parametrize('spec, exclude', [
+        ('', None),
+        ('10.0.0.300', None),
+        ('10.0.0.9-10.0.0.1', None),
+        ('10.0.0.0/33', None),
+        ('10.0.0.0/30', '10.0.0.0/24')
+    ])
+    def test_invalid_specs_raise_value_error(self, spec, exclude):
+        with pytest.raises(ValueError):
+            TargetSpec(spec, exclude=exclude)
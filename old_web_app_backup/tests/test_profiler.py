@@ -0,0 +1,75 @@
+import pytest
+
+from app import create_app
+from profiler import SUMMARY_HEADER, RequestProfile, normalize_statement, profiler
+
+
+@pytest.fixture
+def app_config():
+    return {'SQL_PROFILER': True}
+
+
+@pytest.mark.parametrize('statement, shape', [
+    ("SELECT * FROM customer WHERE id = 12", 'SELECT * FROM customer WHERE id = ?'),
+    ("SELECT * FROM customer WHERE name = 'O''Brien'", 'SELECT * FROM customer WHERE name = ?'),
+    ('SELECT * FROM customer WHERE id = %(id_1)s', 'SELECT * FROM customer WHERE id = ?'),
+    ('SELECT * FROM customer WHERE id = $1', 'SELECT * FROM customer WHERE id = ?'),
+    ('SELECT *\n  FROM customer WHERE id IN (?, ?, ?)', 'SELECT * FROM customer WHERE id IN (?...)'),
+    ('SELECT * FROM table2 WHERE ratio > 0.5', 'SELECT * FROM table2 WHERE ratio > ?')
+])
+def test_normalize_statement(statement, shape):
+    assert normalize_statement(statement) == shape
+
+
+def test_repeated_shapes_are_flagged():
+    profile = RequestProfile('GET', '/', 'main.index')
+    for customer_id in range(3):
+        profile.add(f'SELECT * FROM network_info WHERE customer_id = {customer_id}', 0.001)
+    profile.add('SELECT * FROM customer', 0.002)
+    summary = profile.summary(threshold=3)
+    assert (summary['queries'], summary['distinct'], summary['time_ms']) == (4, 2, 5.0)
+    assert summary['n_plus_one'] == [
+        {'statement': 'SELECT * FROM network_info WHERE customer_id = ?', 'count': 3, 'time_ms': 3.0}]
+
+
+class TestProfiledApp:
+    def test_responses_carry_a_summary(self, client, customer):
+        response = client.get(f'/customer/{customer.id}')
+        assert response.headers[SUMMARY_HEADER].startswith('queries=')
+        assert 'n_plus_one=0' in response.headers[SUMMARY_HEADER]
+
+    def test_debug_endpoint_lists_recent_profiles(self, client, customer, monkeypatch):
+        monkeypatch.setenv('DEBUG_TOKEN', 'secret')
+        client.get('/')
+        client.get(f'/customer/{customer.id}')
+        data = client.get('/sql-profile', query_string={'token': 'secret'}).json
+        assert data['enabled'] is True
+        assert [profile['path'] for profile in data['profiles'][:2]] == [f'/customer/{customer.id}', '/']
+        assert all(profile['statements'] for profile in data['profiles'][:2])
+
+        # With a threshold of one every statement is flagged
+        monkeypatch.setattr(profiler, 'threshold', 1)
+        data = client.get('/sql-profile', query_string={'token': 'secret', 'n_plus_one': '1'}).json
+        assert data['profiles']
+        # The debug token is never recorded
+        assert all('secret' not in profile['path'] for profile in data['profiles'])
+
+    def test_profiles_belong_to_their_app(self, client):
+        client.get('/')
+        other = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        assert profiler.is_enabled(other) is False
+        assert profiler.recent(app=other) == []
+        assert profiler.recent()
+
+
+class TestUnprofiledApp:
+    @pytest.fixture
+    def app_config(self):
+        return {}
+
+    def test_nothing_is_recorded(self, client, monkeypatch):
+        monkeypatch.setenv('DEBUG_TOKEN', 'secret')
+        response = client.get('/')
+        assert SUMMARY_HEADER not in response.headers
+        data = client.get('/sql-profile', query_string={'token': 'secret'}).json
+        assert (data['enabled'], data['profiles']) == (False, [])
@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+import network_scanner
+from scan_jobs import CANCELLED, FAILED, FINISHED, RUNNING, ScanJobLimitError, ScanJobManager
+
+
+def wait_for(job, timeout=10):
+    deadline = time.monotonic() + timeout
+    while job.active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return job.status
+
+
+class TestScanJobManager:
+    def test_job_runs_in_the_background(self, loopback, listener):
+        manager = ScanJobManager()
+        job = manager.submit('127.0.0.1-127.0.0.4', [listener], discovery=False,
+                             on_finish=lambda job: {'run_id': 7})
+        assert manager.get(job.id) is job
+        assert wait_for(job) == FINISHED
+        data = job.to_dict(include_devices=True)
+        assert [device['ip'] for device in data['devices']] == ['127.0.0.1']
+        assert data['progress'] == {'done': 4, 'total': 4}
+        assert data['run_id'] == 7
+
+    def test_cancel_stops_a_running_job(self, loopback, closed_port):
+        manager = ScanJobManager()
+        # Paced to 50 probes a second so it is still running when cancelled
+        job = manager.submit('127.0.0.0/24', [closed_port], discovery=False, rate=50, workers=4)
+        deadline = time.monotonic() + 5
+        while job.status != RUNNING and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert manager.cancel(job.id) is job
+        assert job.stats.cancelled
+        assert wait_for(job, timeout=2) == CANCELLED
+        assert job.done < job.total
+
+    def test_failed_scan_records_the_error(self, monkeypatch):
+        def scan_network(*args, **kwargs):
+            raise ValueError('Error scanning network: boom')
+
+        monkeypatch.setattr(network_scanner, 'scan_network', scan_network)
+        job = ScanJobManager().submit('127.0.0.1', [22])
+        assert wait_for(job) == FAILED
+        assert job.error == 'Error scanning network: boom'
+
+    def test_limits(self, loopback, closed_port):
+        manager = ScanJobManager(max_jobs=2, max_jobs_per_customer=1)
+        slow = {'discovery': False, 'rate': 50, 'workers': 1}
+        first = manager.submit('127.0.0.0/24', [closed_port], customer_id=1, **slow)
+        with pytest.raises(ScanJobLimitError, match='customer already has 1 scan'):
+            manager.submit('127.0.0.1', [closed_port], customer_id=1)
+        second = manager.submit('127.0.0.0/24', [closed_port], customer_id=2, **slow)
+        with pytest.raises(ScanJobLimitError, match='Too many scans running'):
+            manager.submit('127.0.0.1', [closed_port])
+        for job in (first, second):
+            manager.cancel(job.id)
+            wait_for(job)
+
+    def test_finished_jobs_expire(self, loopback, listener):
+        manager = ScanJobManager(retention=0)
+        job = manager.submit('127.0.0.1', [listener], discovery=False)
+        wait_for(job)
+        manager.submit('127.0.0.1', [listener], discovery=False)
+        assert manager.get(job.id) is None
+
+    def test_cancel_unknown_job(self):
+        assert ScanJobManager().cancel('missing') is None
+
+
+class TestScanJobRoutes:
+    def test_submit_poll_and_fetch_results(self, client, customer, loopback, listener):
+        response = client.post('/scan-jobs', json={
+            'ip_range': '127.0.0.1-127.0.0.2', 'ports': [listener], 'customer_id': customer.id})
+        assert response.status_code == 202
+        status_url = response.headers['Location']
+        assert status_url.endswith(f"/scan-jobs/{response.json['job_id']}")
+
+        deadline = time.monotonic() + 10
+        while client.get(status_url).json['status'] != FINISHED and time.monotonic() < deadline:
+            time.sleep(0.02)
+        results = client.get(f'{status_url}/results').json
+        assert results['status'] == FINISHED
+        assert [device['ports'] for device in results['devices'] if device['ip'] == '127.0.0.1'] == [[listener]]
+        # Jobs for a customer are saved to its scan history when they finish
+        assert results['run_id'] is not None
+        assert 'diff' in results
+
+    def test_unknown_job(self, client):
+        assert client.get('/scan-jobs/missing').status_code == 404
+        assert client.get('/scan-jobs/missing/results').status_code == 404
+        assert client.post('/scan-jobs/missing/cancel').status_code == 404
+
+    @pytest.mark.parametrize('params, error', [
+        ({'ports': {'ssh': 22}}, 'Ports must be a list of port numbers or a comma-separated string'),
+        ({'ports': ['22', 'http']}, 'Ports must be a list of port numbers or a comma-separated string'),
+        ({'ports': [22, 70000]}, 'Ports must be between 1 and 65535'),
+        ({'ports': '0,22'}, 'Ports must be between 1 and 65535'),
+        ({'customer_id': 'acme'}, 'Customer ID must be an integer'),
+        ({'customer_id': [1]}, 'Customer ID must be an integer'),
+        ({'ip_range': '127.0.0.300'}, "Invalid IP range '127.0.0.300': illegal IP address string passed to inet_aton")
+    ])
+    def test_bad_parameters_are_rejected(self, client, params, error):
+        response = client.post('/scan-jobs', json={'ip_range': '127.0.0.1', **params})
+        assert response.status_code == 400
+        assert response.json['error'] == error
+
+    def test_unknown_customer(self, client):
+        response = client.post('/scan-jobs', json={'ip_range': '127.0.0.1', 'customer_id': 999})
+        assert response.status_code == 404
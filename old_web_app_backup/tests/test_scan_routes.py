@@ -0,0 +1,105 @@
+import json
+import threading
+
+from app import ScanResult, ScanRun, db
+from network_scanner import CLOSED, OPEN, format_ndjson, format_sse, iter_scan
+from test_network_scanner import FakeNetwork
+
+
+def ndjson_events(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def sse_events(response):
+    events = []
+    for message in response.get_data(as_text=True).split('\n\n'):
+        if message:
+            name, data = message.split('\n')
+            assert name.startswith('event: ') and data.startswith('data: ')
+            events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+class TestScanStream:
+    def test_iter_scan_yields_devices_then_done(self, loopback, listener):
+        events = list(iter_scan('127.0.0.1-127.0.0.4', [listener], discovery=False))
+        kinds = [event['event'] for event in events]
+        assert kinds.count('device') == 1
+        assert kinds[-1] == 'done'
+        assert events[-1]['stats']['hosts_scanned'] == 4
+        assert not events[-1]['stats']['cancelled']
+
+    def test_closing_the_stream_cancels_the_scan(self, loopback, closed_port):
+        # Paced to 50 probes a second, the whole /24 would take over ten seconds
+        events = iter_scan('127.0.0.0/24', [closed_port], discovery=False, rate=50, workers=4,
+                           progress_interval=0)
+        next(events)
+        scanners = [thread for thread in threading.enumerate() if thread.name == 'scan-stream']
+        events.close()
+        for thread in scanners:
+            thread.join(timeout=1)
+            assert not thread.is_alive()
+
+    def test_formats(self):
+        event = {'event': 'progress', 'done': 1, 'total': 2}
+        assert format_ndjson(event) == '{"event": "progress", "done": 1, "total": 2}\n'
+        assert format_sse(event) == 'event: progress\ndata: {"event": "progress", "done": 1, "total": 2}\n\n'
+
+    def test_ndjson_route(self, client, loopback, listener):
+        response = client.get('/scan-network', query_string={
+            'ip_range': '127.0.0.1-127.0.0.4', 'ports': str(listener), 'stream': 'ndjson'})
+        assert response.mimetype == 'application/x-ndjson'
+        assert response.headers['Cache-Control'] == 'no-cache'
+        events = ndjson_events(response)
+        devices = [event['device'] for event in events if event['event'] == 'device']
+        assert sorted(device['ip'] for device in devices) == [f'127.0.0.{host}' for host in range(1, 5)]
+        assert [device['ports'] for device in devices if device['ip'] == '127.0.0.1'] == [[listener]]
+        assert events[-1]['event'] == 'done'
+
+    def test_sse_route(self, client, loopback, listener):
+        response = client.get('/scan-network', query_string={
+            'ip_range': '127.0.0.1', 'ports': str(listener), 'stream': 'sse'})
+        assert response.mimetype == 'text/event-stream'
+        events = sse_events(response)
+        assert [name for name, _ in events if name != 'progress'] == ['device', 'done']
+        assert all(name == data['event'] for name, data in events)
+
+    def test_stream_reports_errors_as_events(self, client, loopback):
+        response = client.get('/scan-network', query_string={'ip_range': '127.0.0.300', 'stream': 'ndjson'})
+        assert response.status_code == 200
+        assert [event['event'] for event in ndjson_events(response)] == ['error']
+
+    def test_unstreamed_scan_returns_json(self, client, loopback, listener):
+        response = client.get('/scan-network', query_string={'ip_range': '127.0.0.1', 'ports': str(listener)})
+        assert [device['ports'] for device in response.json['devices']] == [[listener]]
+        assert response.json['stats']['hosts_scanned'] == 1
+
+
+class TestScanHistory:
+    def previous_run(self, customer, *hosts):
+        run = ScanRun(customer_id=customer.id, ip_range='10.0.0.0/29', ports='22,80')
+        db.session.add(run)
+        db.session.flush()
+        db.session.add_all([ScanResult(run_id=run.id, ip_address=ip, ports=ports) for ip, ports in hosts])
+        db.session.commit()
+        return run
+
+    def test_scan_is_recorded_with_a_diff(self, client, customer, loopback, monkeypatch):
+        FakeNetwork(monkeypatch, {'10.0.0.1': {22: OPEN, 80: CLOSED}})
+        response = client.get('/scan-network', query_string={
+            'ip_range': '10.0.0.0/29', 'ports': '22,80', 'customer_id': customer.id})
+        run = db.session.get(ScanRun, response.json['run_id'])
+        assert [(result.ip_address, result.port_list) for result in run.results] == [('10.0.0.1', [22])]
+        assert response.json['diff']['previous_run'] is None
+        assert [device['ip'] for device in response.json['diff']['network_info']['new']] == ['10.0.0.1']
+
+    def test_rescan_reports_hosts_that_went_away(self, client, customer, loopback, monkeypatch):
+        previous = self.previous_run(customer, ('10.0.0.1', '22'), ('10.0.0.2', '80'))
+        FakeNetwork(monkeypatch, {'10.0.0.1': {22: OPEN, 80: OPEN}})
+        response = client.get('/scan-network', query_string={
+            'ip_range': '10.0.0.0/29', 'ports': '22,80', 'customer_id': customer.id, 'rescan': '1'})
+        diff = response.json['diff']['previous_run']
+        assert response.json['diff']['previous_run_id'] == previous.id
+        assert [device['ip'] for device in diff['gone']] == ['10.0.0.2']
+        assert diff['changed'] == [{'ip': '10.0.0.1', 'ports_opened': [80]}]
+        assert diff['new'] == []
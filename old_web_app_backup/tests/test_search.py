@@ -0,0 +1,96 @@
+import pytest
+
+import search
+from app import Credential, Customer, NetworkInfo, db
+
+
+@pytest.fixture(params=['like', 'fts5'])
+def backend(request, app):
+    if request.param == 'fts5':
+        search.install_search_index(db.session.connection())
+        db.session.commit()
+    return request.param
+
+
+@pytest.fixture
+def records(backend):
+    acme = Customer(name='Acme Corp', contact_person='Wile Coyote', email='wile@acme.example')
+    globex = Customer(name='Globex')
+    db.session.add_all([acme, globex])
+    db.session.flush()
+    db.session.add_all([
+        NetworkInfo(customer_id=acme.id, device_name='core-switch', ip_address='10.0.0.2',
+                    mac_address='aa:bb:cc:dd:ee:02', notes='Rack 1'),
+        NetworkInfo(customer_id=globex.id, device_name='edge-router', ip_address='192.168.5.1'),
+        Credential(customer_id=acme.id, service_name='Office 365', username='admin', password='hunter2')
+    ])
+    db.session.commit()
+    return acme, globex
+
+
+def hits(query, **kwargs):
+    return [(hit['kind'], hit['title']) for hit in search.search_records(db.session, query, **kwargs)['results']]
+
+
+class TestSearchRecords:
+    def test_uses_the_installed_backend(self, backend):
+        assert search.search_backend(db.session.connection()) == backend
+
+    def test_matches_substrings_of_any_field(self, records):
+        assert hits('switch') == [('device', 'core-switch')]
+        assert hits('168.5') == [('device', 'edge-router')]
+        assert hits('ee:02') == [('device', 'core-switch')]
+        assert hits('coyote') == [('customer', 'Acme Corp')]
+
+    def test_every_term_must_match(self, records):
+        assert hits('switch rack') == [('device', 'core-switch')]
+        assert hits('switch globex') == []
+
+    def test_short_terms(self, records):
+        assert hits('core 10') == [('device', 'core-switch')]
+
+    def test_secrets_are_not_searchable(self, records):
+        assert hits('Office') == [('credential', 'Office 365')]
+        assert hits('hunter2') == []
+        assert hits('admin') == []
+
+    def test_special_characters_are_literal(self, records):
+        assert hits('%') == []
+        assert hits('"switch') == []
+
+    def test_writes_are_indexed(self, records):
+        acme, globex = records
+        db.session.delete(globex)
+        device = NetworkInfo.query.filter_by(device_name='core-switch').one()
+        device.device_name = 'distribution-switch'
+        db.session.commit()
+        assert hits('router') == []
+        assert hits('distribution') == [('device', 'distribution-switch')]
+
+    def test_pages(self, records):
+        first = search.search_records(db.session, 'e', page=1, per_page=2)
+        second = search.search_records(db.session, 'e', page=2, per_page=2)
+        assert first['has_next']
+        assert len(first['results']) == 2
+        assert not {hit['title'] for hit in first['results']} & {hit['title'] for hit in second['results']}
+
+    def test_empty_query(self, backend):
+        assert search.search_records(db.session, '  ') == {'results': [], 'has_next': False, 'backend': backend}
+
+
+class TestSearchRoute:
+    def test_links_hits_to_their_pages(self, client, records):
+        acme, _ = records
+        response = client.get('/search', query_string={'q': 'acme'})
+        assert response.json['query'] == 'acme'
+        urls = {hit['kind']: hit['url'] for hit in response.json['results']}
+        assert urls['customer'] == f'/customer/{acme.id}'
+
+        device = NetworkInfo.query.filter_by(device_name='core-switch').one()
+        results = client.get('/search', query_string={'q': 'switch'}).json['results']
+        assert [hit['url'] for hit in results] == [f'/customer/{acme.id}/network/{device.id}/edit']
+        results = client.get('/search', query_string={'q': 'office'}).json['results']
+        assert [hit['url'] for hit in results] == [f'/customer/{acme.id}#credentials']
+
+    def test_requires_login(self, app):
+        assert app.test_client().get('/search', query_string={'q': 'acme'}).status_code == 302